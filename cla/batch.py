@@ -0,0 +1,183 @@
+'''
+Batch classifiability analysis of many datasets.
+
+Datasets are fanned out to a pool of warm worker processes, i.e., each worker imports
+cla.metrics (and numpy, sklearn, statsmodels, rpy2 ...) once and then analyzes many files.
+Results are streamed back as each dataset finishes. A failing dataset produces an error
+row and does not stop the batch.
+
+Example
+-------
+from cla import batch
+df = batch.analyze_batch(glob.glob('data/*.csv'), n_jobs=16, output='result.parquet')
+
+or from the command line:
+
+cla batch data/*.csv --jobs 16 --format parquet
+'''
+
+import os
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from .progress import Tracker
+
+FORMATS = ['csv', 'parquet', 'json', 'jsonl']
+
+
+def _init_worker():
+    '''
+    Warm up a worker process: import the metric stack once and avoid BLAS oversubscription.
+    '''
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except Exception:
+        pass
+
+    from . import metrics  # noqa: F401
+
+
+def _row(path):
+    '''
+    A result row with the columns every dataset has, before it is analyzed
+    '''
+    return {'file': path, 'status': 'ok', 'error': '', 'elapsed': None,
+            'samples': None, 'features': None, 'classes': None}
+
+
+def analyze_dataset(path, keys=None):
+    '''
+    Compute the single-value metrics of one csv file. Never raises.
+
+    Return
+    ------
+    A dict row with file, status, error, elapsed, sample / feature / class counts and the metrics.
+    '''
+    from . import metrics
+
+    row = _row(path)
+    start = time.time()
+
+    try:
+        X, y = metrics.load_file(path)
+        row['samples'] = X.shape[0]
+        row['features'] = X.shape[1]
+        row['classes'] = len(set(y))
+        _, dic_s = metrics.get_metrics(X, y, keys=keys)
+        row.update(dic_s)
+    except Exception as e:
+        row['status'] = 'error'
+        row['error'] = repr(e) + '\n' + traceback.format_exc(limit=3)
+
+    row['elapsed'] = time.time() - start
+    return row
+
+
+def iter_batch(paths, n_jobs=None, keys=None, started=None):
+    '''
+    Analyze datasets in a process pool and yield result rows in completion order.
+
+    Parameters
+    ----------
+    paths : csv file paths. See metrics.load_file() for the format.
+    n_jobs : number of worker processes. None uses os.cpu_count(). 1 runs in this process.
+    keys : only compute these metrics (and their families). Default is all.
+    started : optional callable, called with each path when it is submitted to the pool
+        (all at once, before any worker picks them up), or right before it is analyzed
+        if n_jobs is 1
+    '''
+    paths = list(paths)
+
+    if n_jobs == 1:
+        for path in paths:
+            if started is not None:
+                started(path)
+            yield analyze_dataset(path, keys)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker) as pool:
+        futures = {}
+        for path in paths:
+            futures[pool.submit(analyze_dataset, path, keys)] = path
+            if started is not None:
+                started(path)
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:  # e.g., the worker process died
+                row = _row(futures[future])
+                row['status'] = 'error'
+                row['error'] = repr(e)
+                yield row
+
+
+def write_table(rows, path, fmt=None):
+    '''
+    Write result rows to path. fmt is one of FORMATS, or inferred from the file extension.
+    '''
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.')
+    if fmt not in FORMATS:
+        raise Exception('Unsupported format ' + str(fmt))
+
+    df = pd.DataFrame(rows)
+
+    if fmt == 'csv':
+        df.to_csv(path, index=False)
+    elif fmt == 'parquet':
+        df.to_parquet(path, index=False)  # requires pyarrow or fastparquet
+    elif fmt == 'json':
+        df.to_json(path, orient='records')
+    else:
+        df.to_json(path, orient='records', lines=True)
+
+
+def analyze_batch(paths, n_jobs=None, keys=None, output=None, fmt=None, checkpoint=10, progress=True):
+    '''
+    Analyze many datasets and collect the single-value metrics into one table.
+
+    Parameters
+    ----------
+    paths, n_jobs, keys : see iter_batch()
+    output : file to write the table to. None only returns the table.
+    fmt : output format, one of FORMATS. Default is inferred from output.
+    checkpoint : rewrite output every this many finished datasets, so that partial
+        results survive an interrupted batch. jsonl output is appended row by row instead.
+    progress : True for a tqdm bar, False, or progress callbacks. See cla.progress.
+
+    Return
+    ------
+    A DataFrame with one row per dataset, in completion order
+    '''
+    paths = list(paths)
+    if output is not None:
+        fmt = fmt or os.path.splitext(output)[1].lstrip('.')
+        if fmt not in FORMATS:
+            raise Exception('Unsupported format ' + str(fmt))
+        if fmt == 'jsonl':
+            open(output, 'w').close()
+
+    rows = []
+    tracker = Tracker(len(paths), progress, desc='batch')
+
+    for row in iter_batch(paths, n_jobs, keys, started=lambda path: tracker.started(file=path)):
+        rows.append(row)
+        tracker.finished(failed=row['status'] != 'ok', file=row['file'])
+
+        if output is not None:
+            if fmt == 'jsonl':
+                with open(output, 'a') as f:
+                    f.write(json.dumps(row, default=float) + '\n')
+            elif checkpoint and len(rows) % checkpoint == 0:
+                write_table(rows, output, fmt)
+
+    tracker.close()
+
+    if output is not None and fmt != 'jsonl':
+        write_table(rows, output, fmt)
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,300 @@
+'''
+Benchmarks of get_metrics, get_html, simulate and unify over a grid of data shapes.
+
+Each metric family is timed separately (the minimum of `repeat` runs) and, in a second pass,
+its peak traced memory is measured with tracemalloc. Data come from mvg() with a fixed seed,
+so that runs are comparable. Results are written as JSON and can be compared with a stored
+baseline to catch regressions. Runs offline. ECoL is skipped if R is not available.
+
+Example
+-------
+cla benchmark --preset quick --output bench.json
+cla benchmark --preset quick --output new.json --baseline bench.json --threshold 0.25
+
+or in Python:
+
+from cla import benchmark
+results = benchmark.run(preset='quick')
+regressions = benchmark.compare(results, benchmark.load('bench.json'))
+'''
+
+import io
+import sys
+import json
+import time
+import warnings
+import platform
+import datetime
+import tracemalloc
+import contextlib
+
+import numpy as np
+
+from . import metrics
+
+# n: total samples, p: features, classes: class counts
+PRESETS = {
+    'quick': {'n': [100, 1000], 'p': [2, 100], 'classes': [2], 'repeat': 3},
+    'standard': {'n': [100, 1000, 10000], 'p': [2, 100, 1000], 'classes': [2, 3], 'repeat': 1},
+    'full': {'n': [100, 1000, 10000, 50000], 'p': [2, 100, 1000, 8000], 'classes': [2, 3, 6],
+             'repeat': 1},
+}
+
+# skip grid cells with more than this many values (n * p), i.e., 400 MB of float64
+MAX_CELLS = 5e7
+
+# the other workloads are only run on small cells
+HTML_MAX_CELLS = 2e5
+
+
+def r_available():
+    '''
+    Whether ECoL can run, i.e., rpy2 and R are installed
+    '''
+    if not metrics.ENABLE_R:
+        return False
+    try:
+        import rpy2.robjects as robjects
+        robjects.r('1')
+        return True
+    except Exception:
+        return False
+
+
+def make_dataset(n, p, classes=2, md=1, seed=0):
+    '''
+    Simulated data with n samples, p features and the given number of classes.
+    Two-class data come from mvg(). For more classes, the class means are md apart.
+    '''
+    rng = np.random.default_rng(seed)
+    nobs = n // classes
+
+    with contextlib.redirect_stdout(io.StringIO()):  # mvg() warns about dims > 2
+        if classes == 2:
+            return metrics.mvg(nobs=nobs, md=md, dims=p, rng=rng)
+
+        X = np.vstack([rng.standard_normal((nobs, p)) + (k - (classes - 1) / 2) * md
+                       for k in range(classes)])
+        y = np.repeat(np.arange(classes), nobs)
+        return X, y
+
+
+def _family_key(family):
+    '''
+    A key prefix that selects exactly one metric family in Analysis.metrics()
+    '''
+    for prefix, f in metrics.KEY_FAMILIES:
+        if f == family:
+            return prefix
+
+
+@contextlib.contextmanager
+def _quiet():
+    '''
+    Silence the prints, progress bars and warnings of the measured workloads
+    '''
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()), \
+            warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+
+def _measure(fn, repeat=1, memory=True):
+    '''
+    Return (min wall time in seconds, peak traced memory in MB or None, error or None)
+    '''
+    times = []
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with _quiet():
+                fn()
+            times.append(time.perf_counter() - start)
+
+        peak = None
+        if memory:
+            tracemalloc.start()
+            try:
+                with _quiet():
+                    fn()
+                peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            finally:
+                tracemalloc.stop()
+
+        return min(times), peak, None
+    except Exception as e:
+        return (min(times) if times else None), None, repr(e)
+
+
+def _workloads(X, y, families):
+    '''
+    name -> callable, for one dataset
+    '''
+    jobs = {}
+    for family in families:
+        key = _family_key(family)
+        # a fresh Analysis per call, so that nothing is cached between repeats
+        jobs['family.' + family] = (
+            lambda key=key: metrics.Analysis(X, y, figures=False).metrics([key]))
+
+    jobs['get_metrics'] = lambda: metrics.get_metrics(X, y, keys=[_family_key(f) for f in families])
+
+    if X.size <= HTML_MAX_CELLS:
+        jobs['get_html'] = lambda: metrics.get_html(X, y)
+
+    return jobs
+
+
+def _sweeps():
+    '''
+    simulate() and unify workloads of a fixed small size
+    '''
+    from . import unify
+
+    def run_simulate():
+        metrics.simulate(np.linspace(0, 2, 3), repeat=2, nobs=50, dims=2, progress=False, seed=0)
+
+    def run_unify():
+        X, y = make_dataset(100, 10)
+        dic = unify.calculate_atom_metrics(X.mean(axis=0), X.std(axis=0), np.linspace(0, 4, 5),
+                                           repeat=2, nobs=50, show_curve=False, show_html=False,
+                                           progress=False, seed=0)
+        _, keys, _, M = unify.filter_metrics(dic, threshold=0.5, display=False)
+        scorer = unify.train_scorer(M, dic['d'], keys)
+        scorer.score(X, y)
+
+    return {'simulate': run_simulate, 'unify': run_unify}
+
+
+def run(preset='quick', n=None, p=None, classes=None, families=None, repeat=None,
+        memory=True, sweeps=True, progress=True):
+    '''
+    Run the benchmark grid.
+
+    Parameters
+    ----------
+    preset : a key of PRESETS. n, p, classes and repeat override its values.
+    families : metric families to time. Default is all, without ECoL if R is not available.
+    memory : also measure the peak traced memory, in a separate run of each workload
+    sweeps : also time simulate() and unify on a fixed small size
+
+    Return
+    ------
+    A dict with 'meta' (environment) and 'results' (a list of dicts with case, workload,
+    n, p, classes, time, peak_mb, status and error)
+    '''
+    grid = dict(PRESETS[preset])
+    for k, v in (('n', n), ('p', p), ('classes', classes), ('repeat', repeat)):
+        if v is not None:
+            grid[k] = v
+
+    has_r = r_available()
+    if families is None:
+        families = [f for f in metrics.METRIC_FAMILIES if f != 'ECoL' or has_r]
+
+    results = []
+
+    def record(case, name, shape, measured):
+        t, peak, err = measured
+        row = {'case': case, 'workload': name, 'time': t, 'peak_mb': peak,
+               'status': 'error' if err else 'ok', 'error': err or ''}
+        row.update(shape)
+        results.append(row)
+        if progress:
+            print('{:<22}{:<22}{:>10}{:>10}  {}'.format(
+                case, name, '-' if t is None else '%.3f' % t,
+                '-' if peak is None else '%.1f' % peak, row['status']), file=sys.stderr)
+
+    for k in grid['classes']:
+        for nn in grid['n']:
+            for pp in grid['p']:
+                case = 'n={},p={},k={}'.format(nn, pp, k)
+                shape = {'n': nn, 'p': pp, 'classes': k}
+
+                if nn * pp > MAX_CELLS:
+                    results.append(dict(shape, case=case, workload='*', time=None, peak_mb=None,
+                                        status='skipped', error='more than MAX_CELLS values'))
+                    continue
+
+                X, y = make_dataset(nn, pp, k)
+                for name, fn in _workloads(X, y, families).items():
+                    record(case, name, shape, _measure(fn, grid['repeat'], memory))
+
+    if sweeps:
+        for name, fn in _sweeps().items():
+            record('sweep', name, {'n': None, 'p': None, 'classes': None},
+                   _measure(fn, 1, memory))
+
+    if not has_r:
+        results.append({'case': '*', 'workload': 'family.ECoL', 'n': None, 'p': None,
+                        'classes': None, 'time': None, 'peak_mb': None,
+                        'status': 'skipped', 'error': 'R is not available'})
+
+    import sklearn
+    meta = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'preset': preset,
+        'grid': grid,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sklearn': sklearn.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'r_available': has_r,
+    }
+
+    return {'meta': meta, 'results': results}
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(current, baseline, threshold=0.25, min_time=0.05):
+    '''
+    Find workloads that got slower, use more memory or fail, compared with the baseline.
+
+    Parameters
+    ----------
+    threshold : allowed relative increase, e.g., 0.25 for 25%
+    min_time : ignore time changes of workloads faster than this (seconds) in the baseline,
+        which are dominated by noise
+
+    Return
+    ------
+    A list of dicts with case, workload, metric ('time' or 'peak_mb'), baseline, current and ratio.
+    A workload that was ok in the baseline and is now an error has metric 'status', baseline 'ok',
+    current 'error', ratio None and the error message.
+    '''
+    base = {(r['case'], r['workload']): r for r in baseline['results'] if r['status'] == 'ok'}
+
+    regressions = []
+    for r in current['results']:
+        b = base.get((r['case'], r['workload']))
+        if b is None:
+            continue
+
+        if r['status'] == 'error':
+            regressions.append({'case': r['case'], 'workload': r['workload'],
+                                'metric': 'status', 'baseline': 'ok', 'current': 'error',
+                                'ratio': None, 'error': r.get('error', '')})
+            continue
+        if r['status'] != 'ok':  # skipped
+            continue
+
+        for metric, floor in (('time', min_time), ('peak_mb', 0)):
+            old, new = b.get(metric), r.get(metric)
+            if old is None or new is None or old <= floor:
+                continue
+            if new > old * (1 + threshold):
+                regressions.append({'case': r['case'], 'workload': r['workload'],
+                                    'metric': metric, 'baseline': old, 'current': new,
+                                    'ratio': new / old})
+
+    return regressions
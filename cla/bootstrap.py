@@ -0,0 +1,190 @@
+'''
+Bootstrap confidence intervals for the single-value metrics of get_metrics().
+
+Resamples are stratified, i.e., each class is resampled with replacement within itself, so
+that every resample keeps the class sizes. They are drawn as one B x n index matrix.
+For two-class data, the metrics in vectorized.VECTORIZED_KEYS are evaluated for all resamples
+in one batched pass, with the resamples expressed as sample multiplicities. The other
+(model-based) metrics, e.g., classification.ACC or classification.BER, are computed by
+get_metrics() on each resample in a pool of worker processes.
+
+Example
+-------
+from cla import bootstrap
+ci, boot = bootstrap.bootstrap_ci(X, y, keys=['test.ES.max', 'classification.ACC'], B=500)
+ci['test.ES.max']  # {'estimate': ..., 'low': ..., 'high': ..., 'se': ...}
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy
+
+from .vectorized import VECTORIZED_KEYS, two_group_metrics
+
+CI_METHODS = ['percentile', 'bca']
+
+
+def stratified_indices(y, B, seed=None):
+    '''
+    Draw B stratified bootstrap resamples as a B x n index matrix.
+    Each class is resampled with replacement within itself.
+
+    Parameters
+    ----------
+    seed : int, SeedSequence or Generator
+    '''
+    rng = np.random.default_rng(seed)
+    y = np.asarray(y)
+
+    columns = []
+    for c in sorted(set(y)):
+        pos = np.flatnonzero(y == c)
+        columns.append(pos[rng.integers(0, len(pos), (B, len(pos)))])
+
+    return np.hstack(columns)
+
+
+def _counts(idx, n):
+    '''
+    B x n index matrix -> B x n sample multiplicities
+    '''
+    W = np.zeros((len(idx), n), dtype=int)
+    np.add.at(W, (np.arange(len(idx))[:, None], idx), 1)
+    return W
+
+
+def _resample_worker(args):
+    '''
+    Top-level function so that it can be pickled to worker processes
+    '''
+    from . import metrics
+
+    X, y, keys = args
+    try:
+        _, dic_s = metrics.get_metrics(X, y, keys=keys)
+    except Exception as e:
+        print('Bootstrap resample failed: ' + repr(e))
+        dic_s = {}
+    return [dic_s.get(k, np.nan) for k in keys]
+
+
+def _pooled_metrics(X, y, index_sets, keys, n_jobs=None):
+    '''
+    get_metrics() on X[idx], y[idx] for each idx in index_sets, in a process pool.
+    Return a len(index_sets) x len(keys) array.
+    '''
+    tasks = ((X[idx], y[idx], keys) for idx in index_sets)
+
+    if n_jobs == 1:
+        rows = [_resample_worker(t) for t in tasks]
+    else:
+        from .batch import _init_worker
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker) as pool:
+            rows = list(pool.map(_resample_worker, tasks, chunksize=4))
+
+    return np.array(rows, dtype=float).reshape(len(rows), len(keys))
+
+
+def _interval(estimate, boot, alpha, method, jack=None):
+    '''
+    Percentile or BCa interval of one metric.
+
+    Parameters
+    ----------
+    boot : B bootstrap replicates
+    jack : n jackknife (leave-one-out) replicates. Required by BCa.
+    '''
+    boot = boot[np.isfinite(boot)]
+    if len(boot) == 0:
+        return np.nan, np.nan
+
+    lower, upper = alpha / 2, 1 - alpha / 2
+
+    if method == 'bca' and np.isfinite(estimate):
+        # bias correction
+        prop = (boot < estimate).mean() + (boot == estimate).mean() / 2
+        z0 = scipy.stats.norm.ppf(np.clip(prop, 1 / (len(boot) + 1), len(boot) / (len(boot) + 1)))
+
+        # acceleration from the jackknife
+        jack = jack[np.isfinite(jack)]
+        dev = jack.mean() - jack
+        denom = 6 * (dev ** 2).sum() ** 1.5
+        a = (dev ** 3).sum() / denom if denom > 0 else 0.0
+
+        z = scipy.stats.norm.ppf([lower, upper])
+        lower, upper = scipy.stats.norm.cdf(z0 + (z0 + z) / (1 - a * (z0 + z)))
+
+    return np.percentile(boot, 100 * lower), np.percentile(boot, 100 * upper)
+
+
+def bootstrap_ci(X, y, keys=None, B=1000, alpha=0.05, method='percentile', seed=None, n_jobs=None):
+    '''
+    Bootstrap confidence intervals of single-value metrics.
+
+    Parameters
+    ----------
+    X, y : the dataset
+    keys : single-value metric keys of get_metrics(). Default is all.
+    B : number of stratified bootstrap resamples
+    alpha : 1 - confidence level
+    method : 'percentile' or 'bca' (bias-corrected and accelerated).
+        BCa also needs the n jackknife replicates of each metric, which costs n extra
+        get_metrics() calls for the model-based metrics.
+    seed : int, SeedSequence or Generator for the resamples
+    n_jobs : worker processes for the model-based metrics. None uses os.cpu_count().
+        1 runs in this process.
+
+    Return
+    ------
+    ci : a dict of key -> {'estimate', 'low', 'high', 'se'}
+    boot : a dict of key -> length-B array of bootstrap replicates
+    '''
+    from . import metrics
+
+    if method not in CI_METHODS:
+        raise Exception('Unsupported CI method ' + str(method))
+
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y)
+    n = len(y)
+
+    _, dic_s = metrics.get_metrics(X, y, keys=keys)
+    keys = [k for k in dic_s if keys is None or k in keys]
+
+    classes = list(set(y))
+    fast_keys = [k for k in keys if k in VECTORIZED_KEYS] if len(classes) == 2 else []
+    slow_keys = [k for k in keys if k not in fast_keys]
+
+    idx = stratified_indices(y, B, seed)
+    boot = {}
+    jack = {}
+
+    if fast_keys:
+        # same group orientation as get_metrics(), i.e., set(y) order
+        z = (y == classes[1]).astype(int)
+        Z = np.tile(z, (B, 1))
+        boot.update(two_group_metrics(X, Z, fast_keys, W=_counts(idx, n)))
+
+        if method == 'bca':
+            jack.update(two_group_metrics(X, np.tile(z, (n, 1)), fast_keys,
+                                          W=1 - np.eye(n, dtype=int)))
+
+    if slow_keys:
+        values = _pooled_metrics(X, y, idx, slow_keys, n_jobs)
+        boot.update({k: values[:, i] for i, k in enumerate(slow_keys)})
+
+        if method == 'bca':
+            loo = [np.delete(np.arange(n), i) for i in range(n)]
+            values = _pooled_metrics(X, y, loo, slow_keys, n_jobs)
+            jack.update({k: values[:, i] for i, k in enumerate(slow_keys)})
+
+    ci = {}
+    for k in keys:
+        estimate = dic_s[k]
+        low, high = _interval(estimate, np.asarray(boot[k], dtype=float),
+                              alpha, method, jack.get(k))
+        ci[k] = {'estimate': estimate, 'low': float(low), 'high': float(high),
+                 'se': float(np.nanstd(boot[k], ddof=1))}
+
+    return ci, boot
@@ -0,0 +1,122 @@
+'''
+Command line interface of the cla package.
+
+Usage
+-----
+cla batch data/*.csv --jobs 16 --format parquet
+python -m cla batch data/*.csv --output result.csv
+cla benchmark --preset quick --output bench.json --baseline old.json
+'''
+
+import sys
+import glob
+import argparse
+
+from . import batch
+
+
+def _expand(patterns):
+    '''
+    Expand glob patterns that the shell did not expand (e.g., on Windows)
+    '''
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if matches else [pattern])
+    return paths
+
+
+def run_batch(args):
+    paths = _expand(args.files)
+    output = args.output or 'cla_batch.' + args.format
+    keys = args.keys.split(',') if args.keys else None
+
+    df = batch.analyze_batch(paths, n_jobs=args.jobs, keys=keys,
+                             output=output, fmt=args.format,
+                             progress=not args.quiet)
+
+    failed = (df['status'] != 'ok').sum() if len(df) else 0
+    print('Analyzed {} datasets ({} failed). Results saved to {}'.format(
+        len(df), failed, output), file=sys.stderr)
+    return 1 if failed == len(df) and len(df) else 0
+
+
+def _ints(s):
+    return [int(v) for v in s.split(',')]
+
+
+def run_benchmark(args):
+    from . import benchmark
+
+    families = args.families.split(',') if args.families else None
+    results = benchmark.run(preset=args.preset, n=args.n, p=args.p, classes=args.classes,
+                            families=families, repeat=args.repeat, memory=not args.no_memory,
+                            sweeps=not args.no_sweeps, progress=not args.quiet)
+    benchmark.save(results, args.output)
+    print('Results saved to ' + args.output, file=sys.stderr)
+
+    if not args.baseline:
+        return 0
+
+    regressions = benchmark.compare(results, benchmark.load(args.baseline),
+                                    threshold=args.threshold, min_time=args.min_time)
+    for r in regressions:
+        if r['metric'] == 'status':
+            print('REGRESSION {case} {workload} status: ok -> error: {error}'.format(**r),
+                  file=sys.stderr)
+            continue
+        print('REGRESSION {case} {workload} {metric}: {baseline:.4g} -> {current:.4g} '
+              '({ratio:.2f}x)'.format(**r), file=sys.stderr)
+    print('{} regressions against {}'.format(len(regressions), args.baseline), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cla', description='Classifiability analysis.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('batch', help='compute the metrics of many csv datasets into one table')
+    p.add_argument('files', nargs='+', help='csv files or glob patterns')
+    p.add_argument('--jobs', '-j', type=int, default=None,
+                   help='number of worker processes (default: number of CPUs)')
+    p.add_argument('--format', '-f', choices=batch.FORMATS, default='csv',
+                   help='output format (default: csv)')
+    p.add_argument('--output', '-o', default=None,
+                   help='output file (default: cla_batch.<format>)')
+    p.add_argument('--keys', '-k', default=None,
+                   help='comma-separated metric keys to compute (default: all)')
+    p.add_argument('--quiet', '-q', action='store_true', help='do not show progress')
+    p.set_defaults(func=run_batch)
+
+    p = subparsers.add_parser('benchmark', help='time get_metrics and related workloads over data shapes')
+    p.add_argument('--preset', choices=['quick', 'standard', 'full'], default='quick',
+                   help='data shape grid (default: quick)')
+    p.add_argument('--n', type=_ints, default=None, help='comma-separated sample sizes')
+    p.add_argument('--p', type=_ints, default=None, help='comma-separated feature counts')
+    p.add_argument('--classes', type=_ints, default=None, help='comma-separated class counts')
+    p.add_argument('--families', default=None,
+                   help='comma-separated metric families (default: all)')
+    p.add_argument('--repeat', type=int, default=None, help='timing runs per workload')
+    p.add_argument('--output', '-o', default='cla_benchmark.json',
+                   help='output json file (default: cla_benchmark.json)')
+    p.add_argument('--baseline', '-b', default=None,
+                   help='a previous output to compare with. Exits with 1 on regressions.')
+    p.add_argument('--threshold', type=float, default=0.25,
+                   help='allowed relative increase of time or memory (default: 0.25)')
+    p.add_argument('--min-time', type=float, default=0.05,
+                   help='ignore time changes of workloads faster than this in seconds (default: 0.05)')
+    p.add_argument('--no-memory', action='store_true', help='do not measure peak memory')
+    p.add_argument('--no-sweeps', action='store_true', help='do not time simulate and unify')
+    p.add_argument('--quiet', '-q', action='store_true', help='do not show progress')
+    p.set_defaults(func=run_benchmark)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+'''
+Expected values of single-value metrics under the Gaussian design of mvg() and mvgx().
+
+Both simulators draw nobs samples per class, with independent features whose class means are
+md_j / 2 stds below and above mu (mvgx() with factors=None). Every per-feature statistic of
+cohen_d, T_IND, ANOVA and correlate's Pearson r is then a monotone function of the pooled
+two-sample t statistic, which follows a noncentral t distribution with 2 nobs - 2 degrees of
+freedom and noncentrality md_j sqrt(nobs / 2). MANOVA's Wilks F of two classes follows a
+noncentral F distribution. The expectations of these metrics, including the max / min over
+features, are integrals over known distributions, so their reference curves need no simulation.
+
+T_IND switches to Welch's t test when the Bartlett and Levene tests reject equal variances.
+With equal class sizes, Welch's statistic equals the pooled one, and only its p-value uses
+fewer (random) degrees of freedom. The p-values here use the pooled degrees of freedom.
+
+The other metrics (classifiers, BER, rank tests, IG, Spearman / Kendall, ECoL) have no closed
+form and are still simulated. BER in particular is GaussianNB's error on uniform samples of
+a +-10 std box, not the Bayes error of the design.
+
+Example
+-------
+from cla import expected
+
+dic = expected.expected_metrics(np.linspace(0, 4, 9), nobs=100, effects=expected.mvg_effects(2))
+'''
+
+import sys
+
+import numpy as np
+import scipy.stats
+
+# metric family -> its single-value keys that expected_metrics() computes.
+# A family whose keys are all computed does not need to be simulated.
+EXPECTED_FAMILIES = {
+    'cohen_d': ['test.ES.max'],
+    'T_IND': ['test.student.min', 'test.student.min.log10', 'test.student.T.max'],
+    'ANOVA': ['test.ANOVA.min', 'test.ANOVA.min.log10', 'test.ANOVA.F.max'],
+    'correlate': ['correlation.r.max', 'correlation.r2.max', 'correlation.r.p.min'],
+    'MANOVA': ['test.MANOVA', 'test.MANOVA.log10', 'test.MANOVA.F'],
+}
+
+# families with other single-value keys (correlate's rho and tau) that are still simulated
+PARTIAL_FAMILIES = ['correlate']
+
+
+def mvg_effects(dims=2):
+    '''
+    Per-feature mean difference of mvg(), in units of md.
+    For dims = 2, only the first feature differs between the classes.
+    '''
+    if dims == 2:
+        return np.array([1.0, 0.0])
+    return np.ones(dims)
+
+
+def mvgx_effects(s):
+    '''
+    Per-feature mean difference of mvgx(factors=None), in units of md. All features differ.
+    '''
+    return np.ones(len(s))
+
+
+def _expect_max(dists, counts, funcs, absolute=False, n_grid=1001, eps=1e-12):
+    '''
+    E[f(M)] for each f in funcs, where M is the max of independent variables, counts[g] of
+    which follow the frozen scipy distribution dists[g] (or their absolute values).
+
+    The cdf of M is the product of the cdfs, evaluated on a grid that combines an even grid
+    over the support and the quantiles of the max of each group. Each grid cell carries its
+    exact probability mass, and f is evaluated at the cell midpoint.
+    '''
+    def log_cdf(dist, x):
+        # scipy's noncentral t returns nan far in its tails, where the probability is ~0
+        sf = np.nan_to_num(dist.sf(x))
+        cdf = np.nan_to_num(dist.cdf(x))
+        if absolute:
+            lower = np.nan_to_num(dist.cdf(-x))
+            sf, cdf = sf + lower, cdf - lower
+        with np.errstate(divide='ignore'):  # in the lower tail, 1 - sf would lose the small cdf
+            return np.where(sf > 0.5, np.log(np.maximum(cdf, 0)), np.log1p(-np.minimum(sf, 1)))
+
+    G = len(dists)
+    u = np.linspace(0, 1, n_grid)[1:-1]
+
+    lo = 0.0 if absolute else max(d.ppf(eps ** (1 / c)) for d, c in zip(dists, counts))
+    hi = max(max(d.isf(eps / (2 * G * c)), -d.ppf(eps / (2 * G * c))) if absolute else
+             d.isf(eps / (G * c)) for d, c in zip(dists, counts))
+
+    points = [np.linspace(lo, hi, n_grid)]
+    for d, c in zip(dists, counts):
+        q = u ** (1 / c)  # quantiles of the max of c copies
+        points.append(d.ppf(q))
+        if absolute:
+            points.append(d.ppf((1 + q) / 2))
+            points.append(-d.ppf((1 - q) / 2))
+    x = np.concatenate(points)
+    x = np.unique(np.clip(x[np.isfinite(x)], lo, hi))
+
+    cdf = np.exp(sum(c * log_cdf(d, x) for d, c in zip(dists, counts)))
+    mass = np.diff(cdf)
+    mid = (x[1:] + x[:-1]) / 2
+
+    return [np.sum(f(mid) * mass) / np.sum(mass) for f in funcs]
+
+
+def expected_metrics(mds, nobs=100, effects=None):
+    '''
+    Expected single-value metrics of get_metrics() on mvg() / mvgx() data.
+
+    Parameters
+    ----------
+    mds : between-class mean distances, in stds
+    nobs : number of samples per class
+    effects : per-feature mean difference in units of md, e.g., mvg_effects(dims) or
+        mvgx_effects(s). Features must be independent.
+
+    Return
+    ------
+    A dict of metric key -> array over mds, for the keys of EXPECTED_FAMILIES.
+    The MANOVA keys are only included if MANOVA tests all features, i.e., for
+    2 <= features <= 2 nobs - 3.
+    '''
+    effects = mvg_effects() if effects is None else np.asarray(effects, dtype=float)
+    p = len(effects)
+    dof = 2 * nobs - 2
+    t = scipy.stats.t(dof)
+
+    # functions of M = max |T| over features
+    abs_keys = {
+        'test.ES.max': lambda M: M * np.sqrt(2 / nobs),
+        'test.student.min': lambda M: 2 * t.sf(M),
+        'test.student.min.log10': lambda M: (np.log(2) + t.logsf(M)) / np.log(10),
+        'test.ANOVA.F.max': lambda M: M ** 2,
+        'correlation.r.max': lambda M: M / np.sqrt(M ** 2 + dof),
+        'correlation.r2.max': lambda M: M ** 2 / (M ** 2 + dof),
+    }
+    same = {'test.ANOVA.min': 'test.student.min', 'test.ANOVA.min.log10': 'test.student.min.log10',
+            'correlation.r.p.min': 'test.student.min'}
+    manova = 2 <= p <= 2 * nobs - 3
+
+    dic = {k: [] for fam in EXPECTED_FAMILIES.values() for k in fam}
+    if not manova:
+        for k in EXPECTED_FAMILIES['MANOVA']:
+            dic.pop(k)
+
+    for md in mds:
+        ncp, counts = np.unique(np.abs(md * effects) * np.sqrt(nobs / 2), return_counts=True)
+
+        dists = [scipy.stats.nct(dof, v) if v > 0 else t for v in ncp]
+        values = _expect_max(dists, counts, list(abs_keys.values()), absolute=True)
+        for k, v in zip(abs_keys, values):
+            dic[k].append(v)
+        for k, k2 in same.items():
+            dic[k].append(dic[k2][-1])
+
+        # T = mean of class 0 - mean of class 1, so its noncentrality is negative
+        dists = [scipy.stats.nct(dof, -v) if v > 0 else t for v in ncp]
+        dic['test.student.T.max'].append(_expect_max(dists, counts, [lambda M: M])[0])
+
+        if manova:
+            # Hotelling's T^2 of two classes, as an exact F
+            df1, df2 = p, 2 * nobs - p - 1
+            nc = nobs / 2 * md ** 2 * np.sum(effects ** 2)
+            F = scipy.stats.ncf(df1, df2, nc) if nc > 0 else scipy.stats.f(df1, df2)
+
+            def pvalue(x):
+                pv = scipy.stats.f.sf(x, df1, df2)
+                return np.where(pv == 0, sys.float_info.epsilon, pv)  # as MANOVA() does
+
+            pv, log10 = _expect_max([F], [1], [pvalue, lambda x: np.log10(pvalue(x))])
+            dic['test.MANOVA'].append(pv)
+            dic['test.MANOVA.log10'].append(log10)
+            dic['test.MANOVA.F'].append(df2 * (df1 + nc) / (df1 * (df2 - 2)) if df2 > 2 else
+                                        _expect_max([F], [1], [lambda x: x])[0])
+
+    return {k: np.array(v) for k, v in dic.items()}
+
+
+def covered_families(dic):
+    '''
+    The metric families whose single-value keys are all in dic, e.g., the result of
+    expected_metrics(). A family that keeps other keys (correlate's rho and tau) is not covered.
+    '''
+    return [fam for fam, keys in EXPECTED_FAMILIES.items()
+            if fam not in PARTIAL_FAMILIES and all(k in dic for k in keys)]
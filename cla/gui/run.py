@@ -13,7 +13,9 @@ The Flask quickstart docs explain this in the "Externally Visible Server" sectio
 import os
 import sys
 import uuid
-from flask import Flask, render_template, request
+import threading
+from collections import OrderedDict
+from flask import Flask, render_template, request, Response, abort
 from flaskwebgui import FlaskUI
 
 if __package__:
@@ -27,6 +29,11 @@ else:
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # limit to 5MB
 
+# figures of recent progressive reports, rendered on demand by /figure/<report_id>/<idx>
+REPORTS = OrderedDict()
+MAX_REPORTS = 20
+REPORTS_LOCK = threading.Lock()  # requests are served by concurrent threads
+
 def generate(d, n):
 
     d = int(d)
@@ -44,7 +51,30 @@ def generate(d, n):
     return fn
 
 
-def analyze(csv, save_local=False):
+def analyze(csv, save_local=False, progressive=True):
+    '''
+    progressive : return the numbers right away and let the browser fetch each figure
+        from /figure/<report_id>/<idx>. Figures are rendered on first request.
+    '''
+
+    if progressive and not save_local:
+
+        if os.path.isfile(csv) == False:
+            return 'File ' + csv + ' does not exist.'
+
+        X, y = metrics.load_file(csv)
+        report_id = str(uuid.uuid4())
+        html, batch = metrics.get_lazy_html(
+            X, y, figure_url='/figure/' + report_id + '/{}')
+
+        with REPORTS_LOCK:
+            REPORTS[report_id] = batch
+            while len(REPORTS) > MAX_REPORTS:
+                REPORTS.popitem(last=False)  # drop the oldest report
+
+        return html
+
+    html = metrics.analyze_file(csv)
 
     # store html result into a local html file
 
@@ -54,11 +84,11 @@ def analyze(csv, save_local=False):
             "/" + str(uuid.uuid4()) + ".html"
 
         with open(fn, 'w') as f:
-            f.write(metrics.analyze_file(csv))
+            f.write(html)
 
         # fn is the local save path
 
-    return metrics.analyze_file(csv)  # return the html content
+    return html  # return the html content
 
 # routes
 
@@ -73,6 +103,15 @@ def about_page():
     return "Created by Dr. Zhang (oo@zju.edu.cn)"
 
 
+@app.route("/figure/<report_id>/<int:idx>")
+def figure(report_id, idx):
+    with REPORTS_LOCK:
+        batch = REPORTS.get(report_id)
+    if batch is None or idx >= len(batch):
+        abort(404)
+    return Response(batch.image(idx), mimetype=batch.mimetype)
+
+
 @app.route("/submit", methods=['GET', 'POST'])
 def run_cla():
     if request.method == 'POST':
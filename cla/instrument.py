@@ -0,0 +1,218 @@
+'''
+Timing and memory instrumentation of the metric computations.
+
+Code regions are marked with span(name, cat). A span costs nothing unless a Recorder is
+active or a hook is registered. Analysis records a span per metric family, per group of
+binary subproblems, for the dr projection and for building and rendering the HTML report.
+ECoL records its R conversion and its R computation as separate spans.
+
+Each record holds the wall time, the process CPU time and, if the recorder traces memory,
+the peak allocation above the allocation at the span start (by tracemalloc, which also
+sees numpy arrays, but not the memory allocated by R).
+
+Example
+-------
+from cla import instrument, metrics
+
+with instrument.Recorder(memory=True) as rec:
+    dic, dic_s = metrics.get_metrics(X, y)
+
+rec.timings()               # name -> {'wall', 'cpu', 'peak_mb', 'count'}
+rec.save_trace('trace.json')  # open in chrome://tracing or https://ui.perfetto.dev
+
+# or observe every span
+instrument.add_hook(on_end=lambda r: print(r['name'], r['wall']))
+'''
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+import contextlib
+
+_hooks = []  # (on_start, on_end) pairs
+
+# per-thread stacks of active recorders and of open spans
+_local = threading.local()
+
+
+def _state():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+        _local.frames = []
+    return _local
+
+
+def add_hook(on_start=None, on_end=None):
+    '''
+    Register callbacks for every span, in any thread.
+
+    Parameters
+    ----------
+    on_start : called with (name, cat) when a span opens
+    on_end : called with the span record (a dict, see Recorder) when it closes
+
+    Return
+    ------
+    A handle for remove_hook()
+    '''
+    handle = (on_start, on_end)
+    _hooks.append(handle)
+    return handle
+
+
+def remove_hook(handle):
+    _hooks.remove(handle)
+
+
+def _flush_peak(frames):
+    '''
+    Fold the tracemalloc peak since the last flush into all open spans, then reset it,
+    so that nested spans each get their own peak.
+    '''
+    _, peak = tracemalloc.get_traced_memory()
+    for f in frames:
+        if f['peak'] is not None:
+            f['peak'] = max(f['peak'], peak)
+    tracemalloc.reset_peak()
+
+
+@contextlib.contextmanager
+def span(name, cat='cla', **args):
+    '''
+    Record a code region in the active recorders and report it to the hooks.
+
+    Parameters
+    ----------
+    name : e.g., a metric family
+    cat : category, e.g., 'metric', 'r' or 'render'
+    args : extra fields stored with the record, e.g., the data shape
+    '''
+    state = _state()
+    if not state.recorders and not _hooks:
+        yield
+        return
+
+    for on_start, _ in _hooks:
+        if on_start is not None:
+            on_start(name, cat)
+
+    recorders = list(state.recorders)
+    memory = any(r.memory for r in recorders) and tracemalloc.is_tracing()
+    if memory:
+        _flush_peak(state.frames)
+
+    frame = {'base': tracemalloc.get_traced_memory()[0] if memory else 0,
+             'peak': 0 if memory else None}
+    state.frames.append(frame)
+
+    start, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+
+        if memory and tracemalloc.is_tracing():
+            _flush_peak(state.frames)
+        state.frames.pop()
+
+        record = {'name': name, 'cat': cat, 'start': start, 'wall': wall, 'cpu': cpu,
+                  'peak_mb': (frame['peak'] - frame['base']) / 2 ** 20 if memory else None,
+                  'depth': len(state.frames), 'tid': threading.get_ident(), 'args': args}
+
+        for r in recorders:
+            r.records.append(record)
+
+        for _, on_end in _hooks:
+            if on_end is not None:
+                on_end(record)
+
+
+class Recorder:
+    '''
+    Collect the spans of the code run while it is active (as a context manager, in this thread).
+
+    Each record is a dict of name, cat, start (perf_counter seconds), wall and cpu (seconds),
+    peak_mb (or None), depth (nesting level), tid and args.
+    Entering an already active recorder again is allowed and records nothing twice.
+    '''
+
+    def __init__(self, memory=False):
+        '''
+        Parameters
+        ----------
+        memory : whether to measure the peak allocation of each span by tracemalloc.
+            Tracing slows down allocation-heavy Python code, so wall times are inflated.
+        '''
+        self.memory = memory
+        self.records = []
+        self._depth = 0
+        self._started_tracing = False
+
+    def __enter__(self):
+        if self._depth == 0:
+            if self.memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            _state().recorders.append(self)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            _state().recorders.remove(self)
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        return False
+
+    def timings(self, cat=None):
+        '''
+        Aggregate the records by name.
+
+        Parameters
+        ----------
+        cat : only include this category
+
+        Return
+        ------
+        A dict of name -> {'cat', 'wall', 'cpu', 'peak_mb', 'count'}. wall and cpu are summed
+        over the records of the same name, peak_mb is the maximum.
+        '''
+        dic = {}
+        for r in self.records:
+            if cat is not None and r['cat'] != cat:
+                continue
+            t = dic.setdefault(r['name'], {'cat': r['cat'], 'wall': 0.0, 'cpu': 0.0,
+                                           'peak_mb': None, 'count': 0})
+            t['wall'] += r['wall']
+            t['cpu'] += r['cpu']
+            t['count'] += 1
+            if r['peak_mb'] is not None:
+                t['peak_mb'] = max(t['peak_mb'] or 0.0, r['peak_mb'])
+        return dic
+
+    def trace(self):
+        '''
+        The records as a Chrome trace (the Trace Event Format), viewable in
+        chrome://tracing or Perfetto
+        '''
+        t0 = min((r['start'] for r in self.records), default=0)
+        pid = os.getpid()
+
+        events = []
+        for r in self.records:
+            args = dict(r['args'], cpu_ms=r['cpu'] * 1e3)
+            if r['peak_mb'] is not None:
+                args['peak_mb'] = r['peak_mb']
+            events.append({'name': r['name'], 'cat': r['cat'], 'ph': 'X',
+                           'ts': (r['start'] - t0) * 1e6, 'dur': r['wall'] * 1e6,
+                           'pid': pid, 'tid': r['tid'], 'args': args})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f, default=str)
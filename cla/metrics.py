@@ -1,7 +1,6 @@
 import sys
 import os
 import math
-import re
 import json
 import scipy
 import matplotlib
@@ -10,25 +9,30 @@ import matplotlib.ticker as mticker
 import numpy as np
 import pandas as pd
 import seaborn as sns
-from tqdm import tqdm
+import joblib
 
 from sklearn.metrics import *  # we use global() to access the imported functions
 from sklearn.preprocessing import MinMaxScaler
 # from scipy.integrate import quad
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, TruncatedSVD
+from sklearn.utils.extmath import randomized_svd
+from sklearn.random_projection import SparseRandomProjection
 from sklearn.model_selection import train_test_split, GridSearchCV
 from sklearn.svm import SVC, LinearSVC
 from sklearn.feature_selection import mutual_info_classif, chi2
 from sklearn.naive_bayes import GaussianNB
-from sklearn.linear_model import LogisticRegressionCV
+from sklearn.linear_model import LogisticRegression, LogisticRegressionCV
 from sklearn.preprocessing import OneHotEncoder
-from statsmodels.multivariate import manova
 from statsmodels.stats.contingency_tables import mcnemar, cochrans_q
 
 import rpy2
 
 if __package__:
-    from .vis.plt2base64 import plt2html
+    from .vis.render import new_figure, fig2html, draw2html, FigureBatch, figures_enabled
+    from .instrument import span, Recorder
+    from .progress import Tracker
+    from .store import SimulationStore
+    from .expected import expected_metrics, mvg_effects, covered_families
     from .vis.plotComponents2D import plotComponents2D
     from .vis.feature_importance import plot_feature_importance
     from .vis.unsupervised_dimension_reductions import unsupervised_dimension_reductions
@@ -37,7 +41,11 @@ else:
     if VIS_DIR not in sys.path:
         sys.path.append(VIS_DIR)
 
-    from plt2base64 import plt2html
+    from render import new_figure, fig2html, draw2html, FigureBatch, figures_enabled
+    from instrument import span, Recorder
+    from progress import Tracker
+    from store import SimulationStore
+    from expected import expected_metrics, mvg_effects, covered_families
     from plotComponents2D import plotComponents2D
     from feature_importance import plot_feature_importance
     from unsupervised_dimension_reductions import unsupervised_dimension_reductions
@@ -59,6 +67,22 @@ if ENABLE_R:
     except Exception as e:
         print(e)
 
+def random_generator(seed=None):
+    '''
+    Return the random number generator of the stochastic functions.
+
+    Parameters
+    ----------
+    seed : None - the np.random module, whose functions draw from the global state,
+            i.e., the legacy behavior that follows np.random.seed().
+        int or SeedSequence - a new numpy Generator seeded by it.
+        Generator - returned as is.
+    '''
+    if seed is None:
+        return np.random
+    return np.random.default_rng(seed)
+
+
 # generate and plot 2D multivariate gaussian data set
 
 
@@ -67,6 +91,7 @@ def mvg(
     # distance between means, respect to std, i.e. (mu2 - mu1) / std, or how many stds is the difference.
     md=2,
     dims=2,  # 1 or 2
+    rng=None,  # None (global np.random state), seed or numpy Generator
 ):
     '''
     Draw samples from two multivarite Gaussian distributions with different 𝜇 and Σ values.
@@ -76,6 +101,7 @@ def mvg(
     Theoretically, cohen's d effect size is related to md (distance between means, divided by std) and nobs
     '''
 
+    rng = random_generator(rng)
     N = nobs
 
     if (dims == 2):
@@ -90,8 +116,8 @@ def mvg(
         cov1 = np.array([[s1[0], 0], [0, s1[1]]])
         cov2 = np.array([[s2[0], 0], [0, s2[1]]])
 
-        xc1 = np.random.multivariate_normal(mu1, cov1, N)
-        xc2 = np.random.multivariate_normal(mu2, cov2, N)
+        xc1 = rng.multivariate_normal(mu1, cov1, N)
+        xc2 = rng.multivariate_normal(mu2, cov2, N)
 
         y = np.concatenate((np.zeros(N), np.ones(N))).astype(int)
         X = np.vstack((xc1, xc2))
@@ -99,16 +125,16 @@ def mvg(
     elif (dims == 1):
 
         s = 1
-        xc1 = np.random.randn(N) * s - md * s / 2
-        xc2 = np.random.randn(N) * s + md * s / 2
+        xc1 = rng.standard_normal(N) * s - md * s / 2
+        xc2 = rng.standard_normal(N) * s + md * s / 2
 
         X = np.concatenate((xc1, xc2)).reshape(-1, 1)
         y = np.concatenate((np.zeros(N), np.ones(N))).astype(int)
 
     else:
 
-        xc1 = np.random.randn(N, dims) - md / 2
-        xc2 = np.random.randn(N, dims) + md / 2
+        xc1 = rng.standard_normal((N, dims)) - md / 2
+        xc2 = rng.standard_normal((N, dims)) + md / 2
 
         X = np.vstack((xc1, xc2))
         y = np.concatenate((np.zeros(N), np.ones(N))).astype(int)
@@ -120,11 +146,74 @@ def mvg(
     return X, y
 
 
+MVGX_METHODS = ['direct', 'mvn']
+
+
+def _standard_normal(rng, size, dtype=None):
+    '''
+    Standard normal draws in dtype. Generators draw float32 natively.
+    '''
+    if isinstance(rng, np.random.Generator):
+        return rng.standard_normal(size, dtype=dtype or np.float64)
+    return rng.standard_normal(size).astype(dtype or np.float64, copy=False)
+
+
+def _marginal_std(s, factors=None):
+    if factors is None:
+        return s
+    return np.sqrt(s ** 2 + (factors ** 2).sum(axis=1))
+
+
+def fit_factors(X, y=None, n_factors=10, random_state=0):
+    '''
+    Fit a low-rank-plus-diagonal (factor) covariance L L^T + diag(s^2) to X by a randomized
+    SVD, in O(n * d * k) without forming the d x d covariance. Use it to simulate correlated
+    data like X with mvgx(mu, s, factors=L).
+
+    Parameters
+    ----------
+    y : if given, the covariance is fitted to the within-class deviations, so that the class
+        differences of X do not leak into the noise model
+    n_factors : k, the rank of the low-rank part. Clipped to min(n, d) - 1.
+
+    Return
+    ------
+    mu : the mean vector of X
+    s : the residual (diagonal) std vector
+    L : d x k loadings
+    '''
+    X = np.asarray(X, dtype=float)
+    mu = X.mean(axis=0)
+
+    if y is None:
+        Xc = X - mu
+        dof = len(X) - 1
+    else:
+        y = np.asarray(y)
+        Xc = X.copy()
+        for c in set(y):
+            Xc[y == c] -= Xc[y == c].mean(axis=0)
+        dof = len(X) - len(set(y))
+
+    k = max(1, min(n_factors, min(Xc.shape) - 1))
+    _, S, Vt = randomized_svd(Xc, k, random_state=random_state)
+    L = Vt.T * (S / np.sqrt(dof))
+
+    var = (Xc ** 2).sum(axis=0) / dof
+    s = np.sqrt(np.maximum(var - (L ** 2).sum(axis=1), 0))
+
+    return mu, s, L
+
+
 def mvgx(
     mu,  # mean, row vector
     s,  # std, row vector
     md=2,
-    nobs=15
+    nobs=15,
+    rng=None,
+    factors=None,
+    dtype=None,
+    method='direct'
 ):
     '''
     Generate simulated high-dim (e.g., spectroscopic profiling) data
@@ -136,6 +225,14 @@ def mvgx(
     s : the standard deviation vector. must be row vector
     md : distance between means, respect to std, i.e. (mu2 - mu1) / std, or how many stds is the difference.
     nobs : number of observations / samples per class
+    rng : None (the global np.random state), a seed or a numpy Generator. See random_generator().
+    factors : None, or a d x k loading matrix L for a low-rank-plus-diagonal covariance
+        L L^T + diag(s^2), e.g., fitted to a target dataset by fit_factors(). md is then in
+        units of the marginal std, sqrt(s^2 + row sums of L^2).
+    dtype : e.g., np.float32 to halve the memory of wide data. Default is float64.
+    method : 'direct' draws mu + s * Z (+ Z_k L^T) in O(nobs * d * k).
+        'mvn' factorizes the dense d x d covariance by np.random.multivariate_normal,
+        i.e., the original sampler, which is O(d^3) per call.
 
     Example
     -------
@@ -147,21 +244,70 @@ def mvgx(
     )
     '''
 
+    rng = random_generator(rng)
     mu = np.array(mu)
     s = np.array(s)
 
     N = nobs
-    cov = np.diag(s**2)
+    scale = _marginal_std(s, factors)
 
-    mu1 = mu - s * md / 2
-    mu2 = mu + s * md / 2
-
-    xc1 = np.random.multivariate_normal(mu1, cov, N)
-    xc2 = np.random.multivariate_normal(mu2, cov, N)
+    mu1 = mu - scale * md / 2
+    mu2 = mu + scale * md / 2
 
     y = np.concatenate((np.zeros(N), np.ones(N))).astype(int)
-    X = np.vstack((xc1, xc2))
 
+    if method == 'mvn':
+        cov = np.diag(s**2)
+        if factors is not None:
+            cov = cov + factors @ factors.T
+
+        xc1 = rng.multivariate_normal(mu1, cov, N)
+        xc2 = rng.multivariate_normal(mu2, cov, N)
+
+        X = np.vstack((xc1, xc2))
+        return X.astype(dtype or np.float64, copy=False), y
+
+    if method != 'direct':
+        raise Exception('Unsupported method ' + str(method))
+
+    X = _standard_normal(rng, (2 * N, len(s)), dtype)
+    X *= s.astype(X.dtype)
+    if factors is not None:
+        X += _standard_normal(rng, (2 * N, factors.shape[1]), dtype) @ factors.T.astype(X.dtype)
+    X[:N] += mu1.astype(X.dtype)
+    X[N:] += mu2.astype(X.dtype)
+
+    return X, y
+
+
+def mvgx_batch(mu, s, mds, nobs=15, rng=None, factors=None, dtype=None):
+    '''
+    Draw one mvgx() dataset per md in a single batch.
+
+    Return
+    ------
+    X : len(mds) x 2nobs x d array. X[i] is the dataset of mds[i].
+    y : the 2nobs labels shared by all datasets
+    '''
+    rng = random_generator(rng)
+    mu = np.array(mu)
+    s = np.array(s)
+    mds = np.asarray(mds, dtype=float)
+
+    N = nobs
+    B = len(mds)
+
+    X = _standard_normal(rng, (B, 2 * N, len(s)), dtype)
+    X *= s.astype(X.dtype)
+    if factors is not None:
+        X += _standard_normal(rng, (B, 2 * N, factors.shape[1]), dtype) @ factors.T.astype(X.dtype)
+
+    shift = (mds[:, None] * _marginal_std(s, factors)[None, :] / 2).astype(X.dtype)  # B x d
+    X += mu.astype(X.dtype)
+    X[:, :N] -= shift[:, None, :]
+    X[:, N:] += shift[:, None, :]
+
+    y = np.concatenate((np.zeros(N), np.ones(N))).astype(int)
     return X, y
 
 
@@ -186,16 +332,48 @@ def load_file(pathname):
     y = M[:, -1].astype(int)
     return X, y
 
+def _finish_figure(draw, show=False, save_fig=''):
+    '''
+    Draw, save (optional), encode and show (optional) a metric figure.
+    draw() creates the figure by new_figure(show) from values it holds, and returns it.
+    Returns an HTML img tag.
+
+    Unless the figure is saved or shown, a lazy FigureBatch keeps draw and only calls it
+    when the figure is requested. See get_lazy_html().
+    '''
+
+    if not (show or (save_fig != '' and save_fig is not None)):
+        return draw2html(draw)
+
+    fig = draw()
+
+    if (save_fig != '' and save_fig is not None):
+        if not save_fig.endswith('.jpg'):
+            save_fig += '.jpg'
+        fig.savefig(save_fig)
+        print('figure saved to ' + save_fig)
+
+    IMG = fig2html(fig)
+
+    if show:
+        plt.show()
+
+    return IMG
+
 #
 # plot contour of multivariate Gaussian distributions
 
 
-def plot_gaussian_contour(X, y, mu1, s1, mu2, s2, alpha=0.4):
+def plot_gaussian_contour(X, y, mu1, s1, mu2, s2, alpha=0.4, ax=None):
     '''
     Plot contour of multivariate Gaussian distributions   
+
+    ax : the axes to draw on. If None, a new pyplot figure is created.
     '''
 
-    plt.figure()  # figsize = (9, 6)
+    if ax is None:
+        plt.figure()  # figsize = (9, 6)
+        ax = plt.gca()
 
     X1 = X[:, 0]
     if (X.shape[1] > 1):
@@ -213,17 +391,17 @@ def plot_gaussian_contour(X, y, mu1, s1, mu2, s2, alpha=0.4):
     pos[:, :, 1] = Xg2
 
     rv1 = scipy.stats.multivariate_normal(mu1, s1)
-    c1 = plt.contour(Xg1, Xg2, rv1.pdf(pos), alpha=alpha, cmap='Reds')
-    plt.clabel(c1, inline=True, fontsize=10)
+    c1 = ax.contour(Xg1, Xg2, rv1.pdf(pos), alpha=alpha, cmap='Reds')
+    ax.clabel(c1, inline=True, fontsize=10)
 
     rv2 = scipy.stats.multivariate_normal(mu2, s2)
-    c2 = plt.contour(Xg1, Xg2, rv2.pdf(pos), alpha=alpha, cmap='Reds')
-    plt.clabel(c2, inline=True, fontsize=10)
+    c2 = ax.contour(Xg1, Xg2, rv2.pdf(pos), alpha=alpha, cmap='Reds')
+    ax.clabel(c2, inline=True, fontsize=10)
 
     # print('C1: X~N(', mu1, ',', s1, ')')
     # print('C2: X~N(', mu2, ',', s2, ')')
 
-    return plt.gca()
+    return ax
 
 
 def select_features(X, y, metric, metric_name='', N=30, feature_names=None):
@@ -251,12 +429,13 @@ def select_features(X, y, metric, metric_name='', N=30, feature_names=None):
     return idx
 
 
-def BER(X, y, nobs=10000, NSigma=10, show=False, save_fig=''):
+def BER(X, y, nobs=10000, NSigma=10, show=False, save_fig='', rng=None):
     """
     We draw random samples from the bayes distribution models to calculate BER
 
     nobs - number of observations, i.e., sample size
     NSgima - the sampling range
+    rng - None (the global np.random state), a seed or a numpy Generator for the samples
     """
 
     nb = GaussianNB(priors=[0.5, 0.5])  # we have no strong prior assumption.
@@ -286,11 +465,8 @@ def BER(X, y, nobs=10000, NSigma=10, show=False, save_fig=''):
     lb = np.minimum(mu1 - NSigma*s1, mu2 - NSigma*s2)
     ub = np.maximum(mu1 + NSigma*s1, mu2 + NSigma*s2)
 
-    # we use M random samples to calculate BER
-    XM = np.zeros((nobs, X.shape[1]))
-    for i in range(nobs):
-        rnd = np.random.random(X.shape[1])
-        XM[i, :] = lb + (ub - lb) * rnd
+    # we use M random samples to calculate BER. Row by row, this is the same stream as nobs draws of X.shape[1].
+    XM = lb + (ub - lb) * random_generator(rng).random((nobs, X.shape[1]))
 
     # quad(lambda x: guassian, -3std, 3std) ...
 
@@ -306,28 +482,21 @@ def BER(X, y, nobs=10000, NSigma=10, show=False, save_fig=''):
     BER = 1 - sum_of_max_prob/len(y_pred)
     IMG = ''
 
-    if X.shape[1] == 2:
+    if X.shape[1] == 2 and (show or save_fig or figures_enabled()):
         # for 2-dimensional data, plot the contours
-        ax = plot_gaussian_contour(X, y, nb.theta_[0], np.sqrt(
-            nb.var_[0]), nb.theta_[1], np.sqrt(nb.var_[1]), alpha=0.3)
-        plotComponents2D(X, y, set(y), use_markers=False, ax=ax)
-        plt.legend()
-        title = ' $ \mu $ = ' + str(np.round(nb.theta_, 3)) + \
-            ', $\sigma^2$ = ' + str(np.round(nb.var_, 3)).replace('\n', '')
-        plt.title(title)
-
-        if (save_fig != '' and save_fig is not None):
-            if not save_fig.endswith('.jpg'):
-                save_fig += '.jpg'
-            plt.savefig(save_fig)
-            print('figure saved to ' + save_fig)
-
-        IMG = plt2html(plt)
-
-        if show:
-            plt.show()
-        else:
-            plt.close()
+        def draw():
+            fig = new_figure(show)
+            ax = fig.add_subplot()
+            plot_gaussian_contour(X, y, nb.theta_[0], np.sqrt(
+                nb.var_[0]), nb.theta_[1], np.sqrt(nb.var_[1]), alpha=0.3, ax=ax)
+            plotComponents2D(X, y, set(y), use_markers=False, ax=ax)
+            ax.legend()
+            title = ' $ \mu $ = ' + str(np.round(nb.theta_, 3)) + \
+                ', $\sigma^2$ = ' + str(np.round(nb.var_, 3)).replace('\n', '')
+            ax.set_title(title)
+            return fig
+
+        IMG = _finish_figure(draw, show, save_fig)
 
     return BER, IMG  # , BER2
 
@@ -337,17 +506,14 @@ def Mean_KLD(P, Q):
     Calculate the mean KL divergence between ground truth and predicted one-hot encodings for an entire data set.
     P and Q must be both m x K numpy arrays. m = sample number, K = class number
     '''
-    klds = []
-    for idx, ground_truth in enumerate(P):
-        prediction = Q[idx]
-        # If 2nd param is not None, then compute the Kullback-Leibler divergence. S = sum(pk * log(pk / qk), axis=axis).
-        kld = scipy.stats.entropy(ground_truth, prediction)
+    # If 2nd param is not None, then compute the Kullback-Leibler divergence. S = sum(pk * log(pk / qk), axis=axis).
+    # All rows at once, instead of one scipy call per sample.
+    klds = scipy.stats.entropy(P, Q, axis=1).tolist()
 
-        # from scipy.special import rel_entr
-        # #calculate (Q || P)
-        # sum(rel_entr(Q, P))
+    # from scipy.special import rel_entr
+    # #calculate (Q || P)
+    # sum(rel_entr(Q, P))
 
-        klds.append(kld)
     return np.mean(klds), klds
 
 
@@ -572,9 +738,99 @@ def classify_with_svm(X, y):
 ########### End of SVM / LR Section ##########
 
 
-def CLF(X, y, verbose=False, show=False, save_fig=''):
+class CLFCache:
+    '''
+    Reuse the regularization strength chosen by LogisticRegressionCV in CLF across similar
+    datasets, e.g., the repeats and neighboring mds of a simulation sweep.
+
+    Datasets are keyed by their shape, class count and md bucket (md // md_step).
+    The first fit of a key searches the full regularization path. Later fits only search a
+    narrow C grid around the previous choice, which may come from a neighboring md bucket,
+    and fall back to the full path if the optimum is on the edge of the narrow grid.
+    Once the last `stable` choices agree within a factor of 10 ** tol, CV is skipped and a
+    plain LogisticRegression is fitted with their median C.
+
+    Example
+    -------
+    cache = CLFCache()
+    dic = simulate(np.linspace(0, 2, 20), repeat=10, clf_cache=cache)
+    cache.fits  # {'full': ..., 'narrow': ..., 'reused': ...}
+    '''
+
+    def __init__(self, md_step=0.5, stable=3, tol=0.5, skip_cv=True):
+        '''
+        Parameters
+        ----------
+        md_step : width of the md buckets
+        stable : number of agreeing choices after which CV is skipped
+        tol : allowed spread of those choices, in log10(C)
+        skip_cv : if False, always run (narrow) CV
+        '''
+        self.md_step = md_step
+        self.stable = stable
+        self.tol = tol
+        self.skip_cv = skip_cv
+        self.history = {}  # key -> list of chosen C
+        self.fits = {'full': 0, 'narrow': 0, 'reused': 0}
+
+    def key(self, X, y, md=None):
+        bucket = None if md is None else int(np.floor(md / self.md_step))
+        return X.shape, len(set(y)), bucket
+
+    def previous(self, key):
+        '''
+        The chosen Cs of key, or else of a neighboring md bucket
+        '''
+        if key in self.history:
+            return self.history[key]
+
+        shape, k, bucket = key
+        if bucket is not None:
+            for b in (bucket - 1, bucket + 1):
+                if (shape, k, b) in self.history:
+                    return self.history[(shape, k, b)]
+        return []
+
+    def fit(self, X, y, cv, md=None):
+        '''
+        Fit a logistic regression model, reusing previous C choices. The model has a C_ attribute.
+        '''
+        key = self.key(X, y, md)
+        Cs = self.previous(key)
+
+        if self.skip_cv and len(Cs) >= self.stable:
+            recent = np.log10(Cs[-self.stable:])
+            if recent.max() - recent.min() <= self.tol:
+                self.fits['reused'] += 1
+                C = 10 ** np.median(recent)
+                clf = LogisticRegression(C=C, max_iter=1000).fit(X, y)
+                clf.C_ = np.array([C])
+                return clf
+
+        clf = None
+        if Cs:
+            # LogisticRegressionCV's default path is np.logspace(-4, 4, 10). Stay within it.
+            grid = np.unique(np.clip(Cs[-1] * np.logspace(-1, 1, 5), 1e-4, 1e4))
+            clf = LogisticRegressionCV(Cs=grid, cv=cv, max_iter=1000).fit(X, y)
+            C = np.median(clf.C_)
+            if (C == grid[0] and C > 1e-4) or (C == grid[-1] and C < 1e4):
+                clf = None  # the optimum may lie outside the narrow grid
+            else:
+                self.fits['narrow'] += 1
+
+        if clf is None:
+            self.fits['full'] += 1
+            clf = LogisticRegressionCV(cv=cv, max_iter=1000).fit(X, y)
+
+        self.history.setdefault(key, []).append(float(np.median(clf.C_)))
+        return clf
+
+
+def CLF(X, y, verbose=False, show=False, save_fig='', cache=None, md=None):
     '''
     X,y - features and labels
+    cache - a CLFCache to reuse the regularization strength of similar datasets. Default is None.
+    md - the between-class distance of simulated data, used as the cache key
     '''
 
     dic = {}
@@ -610,8 +866,11 @@ def CLF(X, y, verbose=False, show=False, save_fig=''):
     # CV requires to be not greater than this value.
 
     try:
-        clf = LogisticRegressionCV(cv=min(3, min(grp_samples)), max_iter=1000).fit(
-            X, y)  # ridge(L2) regularization
+        if cache is None:
+            clf = LogisticRegressionCV(cv=min(3, min(grp_samples)), max_iter=1000).fit(
+                X, y)  # ridge(L2) regularization
+        else:
+            clf = cache.fit(X, y, cv=min(3, min(grp_samples)), md=md)
     except Exception as e:
         print('Exception in LogisticRegressionCV().', e)
         return None, None, None
@@ -622,57 +881,49 @@ def CLF(X, y, verbose=False, show=False, save_fig=''):
     IMG = ''
 
     # visualize the decision boundary in a 2D plane if X has two features
-    if (X.shape[1] == 2):
-
-        plt.figure()
-
-        # plt.scatter(data['X1'], data['X2'], s=50, c=clf.predict_proba(data[['X1', 'X2']])[:,0], cmap='seismic')
-        plt.scatter(X[:, 0], X[:, 1], s=50,
-                    c=clf.decision_function(X), cmap='seismic')
-
-        # plot the decision function
-        ax = plt.gca()  # get current axes
-        xlim = ax.get_xlim()
-        ylim = ax.get_ylim()
-
-        # create grid to evaluate model
-        xx = np.linspace(xlim[0], xlim[1], 30)
-        yy = np.linspace(ylim[0], ylim[1], 30)
-        YY, XX = np.meshgrid(yy, xx)
-        xy = np.vstack([XX.ravel(), YY.ravel()]).T
-        Z = clf.decision_function(xy).reshape(XX.shape)
-
-        # plot decision boundary and margins
-        _ = ax.contour(XX, YY, Z, colors='k', levels=[-1, 0, 1], alpha=0.5,
-                         linestyles=['--', '-', '--'])
-
-        # in some cases, there can be multiple unconnected decision boundaries
-
-        # for i in range(len(out.collections[1].get_paths())):
-        #    vertice_set.append(out.collections[1].get_paths()[i].vertices)
-
-        # plot support vectors if using SVM
-        if (hasattr(clf, "support_vectors_")):
-            ax.scatter(clf.support_vectors_[:, 0], clf.support_vectors_[:, 1], s=100,
-                       linewidth=1, facecolors='none', edgecolors='k')
-            # title = 'kernel = ' + best_params['kernel'] + ", C = " + str(best_params['C']) + " , acc = " + str(round(clf.score(X, y),3))
-            #
-            # if 'gamma' in best_params:
-            #    title += ", $\gamma$ = " + str(best_params['gamma'])
-            # ax.set_title(title)
-
-        if (save_fig != '' and save_fig != None):
-            if save_fig.endswith('.jpg') == False:
-                save_fig += '.jpg'
-            plt.savefig(save_fig)
-            print('figure saved to ' + save_fig)
-
-        IMG = plt2html(plt)
-
-        if show:
-            plt.show()
-        else:
-            plt.close()
+    if X.shape[1] == 2 and (show or save_fig or figures_enabled()):
+
+        def draw():
+            fig = new_figure(show)
+            ax = fig.add_subplot()
+
+            # plt.scatter(data['X1'], data['X2'], s=50, c=clf.predict_proba(data[['X1', 'X2']])[:,0], cmap='seismic')
+            ax.scatter(X[:, 0], X[:, 1], s=50,
+                       c=clf.decision_function(X), cmap='seismic')
+
+            # plot the decision function
+            xlim = ax.get_xlim()
+            ylim = ax.get_ylim()
+
+            # create grid to evaluate model
+            xx = np.linspace(xlim[0], xlim[1], 30)
+            yy = np.linspace(ylim[0], ylim[1], 30)
+            YY, XX = np.meshgrid(yy, xx)
+            xy = np.vstack([XX.ravel(), YY.ravel()]).T
+            Z = clf.decision_function(xy).reshape(XX.shape)
+
+            # plot decision boundary and margins
+            _ = ax.contour(XX, YY, Z, colors='k', levels=[-1, 0, 1], alpha=0.5,
+                             linestyles=['--', '-', '--'])
+
+            # in some cases, there can be multiple unconnected decision boundaries
+
+            # for i in range(len(out.collections[1].get_paths())):
+            #    vertice_set.append(out.collections[1].get_paths()[i].vertices)
+
+            # plot support vectors if using SVM
+            if (hasattr(clf, "support_vectors_")):
+                ax.scatter(clf.support_vectors_[:, 0], clf.support_vectors_[:, 1], s=100,
+                           linewidth=1, facecolors='none', edgecolors='k')
+                # title = 'kernel = ' + best_params['kernel'] + ", C = " + str(best_params['C']) + " , acc = " + str(round(clf.score(X, y),3))
+                #
+                # if 'gamma' in best_params:
+                #    title += ", $\gamma$ = " + str(best_params['gamma'])
+                # ax.set_title(title)
+
+            return fig
+
+        IMG = _finish_figure(draw, show, save_fig)
 
     y_pred = clf.predict(X)
     clf_metrics.append(globals()["accuracy_score"](y, y_pred))
@@ -731,10 +982,41 @@ def CLF(X, y, verbose=False, show=False, save_fig=''):
     return dic, IMG, LOG
 
 
-def SVM_Margin_Width(X, y, scale=True, show=False):
+# above this sample count, SVM_Margin_Width(solver='auto') uses the primal liblinear solver
+SVM_LARGE_N = 5000
+
+
+def _svm_width(X, y, solver):
+    '''
+    Fit a linear SVM with hinge loss and C = 1 and return the model and its margin width 2 / ||w||
+    '''
+    if solver == 'liblinear':
+        # a large intercept_scaling keeps liblinear's penalty on the intercept small,
+        # so that the solution matches libsvm's
+        model = LinearSVC(loss='hinge', C=1.0, dual=True,
+                          intercept_scaling=10, max_iter=20000).fit(X, y)
+    else:
+        model = SVC(kernel='linear').fit(X, y)  # C = 1
+
+    return model, 2 / np.linalg.norm(model.coef_[0], ord=2)
+
+
+def SVM_Margin_Width(X, y, scale=True, show=False, solver='auto', max_samples=None,
+                     n_subsamples=3, random_state=0, return_err=False):
     '''
     SVM hyperplane margin width
 
+    Parameters
+    ----------
+    solver : 'libsvm' - SVC(kernel='linear'), exact, but scales quadratically to cubically with n
+        'liblinear' - LinearSVC with the same hinge loss and C, scales linearly with n
+        'auto' - liblinear if there are more than SVM_LARGE_N samples, otherwise libsvm
+    max_samples : if set and exceeded, the width is the mean over n_subsamples stratified
+        subsamples of max_samples samples each
+    return_err : also return the approximation error of subsampling, i.e., the standard error
+        of the mean width over the subsamples (0 if not subsampled). With fewer samples the
+        soft margin tends to be wider, so compare widths computed with the same max_samples.
+
     Note
     ----
     When the between-class distance is small (< 3std), there are many overlaps, 
@@ -742,55 +1024,166 @@ def SVM_Margin_Width(X, y, scale=True, show=False):
     This metric is only linear after the distance is big enough.
     '''
 
+    y = np.asarray(y)
+
     if scale:
         X = MinMaxScaler().fit_transform(X)
 
-    svc_model = SVC(kernel='linear')  # C = 10
-    svc_model = svc_model.fit(X, y)
+    if solver == 'auto':
+        solver = 'liblinear' if len(y) > SVM_LARGE_N else 'libsvm'
+    if solver not in ('libsvm', 'liblinear'):
+        raise Exception('Unsupported SVM solver ' + str(solver))
+
+    err = 0.0
+    title = None
+
+    if max_samples is not None and len(y) > max_samples:
+        widths = []
+        for i in range(n_subsamples):
+            idx, _ = train_test_split(np.arange(len(y)), train_size=max_samples,
+                                      stratify=y, random_state=random_state + i)
+            svc_model, w_i = _svm_width(X[idx], y[idx], solver)
+            widths.append(w_i)
+        width = np.mean(widths)
+        if n_subsamples > 1:
+            err = np.std(widths, ddof=1) / np.sqrt(n_subsamples)
+
+        # the figure shows the last subsample, the one svc_model was fit on
+        Xp, yp = X[idx], y[idx]
+        title = 'Subsample {} of {} ({} samples): width = {}, mean width = {}'.format(
+            n_subsamples, n_subsamples, max_samples, round(widths[-1], 3), round(width, 3))
+    else:
+        svc_model, width = _svm_width(X, y, solver)
+        Xp, yp = X, y
 
-    support_vectors = svc_model.support_vectors_
     w = svc_model.coef_[0]
-    p = np.linalg.norm(w, ord=2)
-    width = 2/p
 
     IMG = ''
 
-    if len(support_vectors[1]) == 2 and len(set(y)) == 2:
-        df = pd.DataFrame(X)
+    if X.shape[1] == 2 and len(set(y)) == 2 and (show or figures_enabled()):
+        def draw():
+            df = pd.DataFrame(Xp)
 
-        x_min = np.min(df.iloc[:, 0]) - 0.5
-        x_max = np.max(df.iloc[:,  0]) + 0.5
-        y_min = np.min(df.iloc[:, 1]) - 0.5
-        y_max = np.max(df.iloc[:, 1]) + 0.5
+            x_min = np.min(df.iloc[:, 0]) - 0.5
+            x_max = np.max(df.iloc[:,  0]) + 0.5
+            y_min = np.min(df.iloc[:, 1]) - 0.5
+            y_max = np.max(df.iloc[:, 1]) + 0.5
 
-        x = np.arange(x_min, x_max, 0.1)
-        y0 = -svc_model.intercept_/w[1]-w[0]/w[1]*x
-        y_up = (1-svc_model.intercept_)/w[1]-w[0]/w[1]*x
-        y_down = (-1 - svc_model.intercept_) / w[1] - w[0] / w[1] * x
+            x = np.arange(x_min, x_max, 0.1)
+            y0 = -svc_model.intercept_/w[1]-w[0]/w[1]*x
+            y_up = (1-svc_model.intercept_)/w[1]-w[0]/w[1]*x
+            y_down = (-1 - svc_model.intercept_) / w[1] - w[0] / w[1] * x
 
-        plt.plot(x, y0)
-        plt.plot(x, y_up, linestyle='--')
-        plt.plot(x, y_down, linestyle='--')
-        plt.ylim(y_min, y_max)
-        plt.xlim(x_min, x_max)
+            fig = new_figure(show)
+            ax = fig.add_subplot()
+            ax.plot(x, y0)
+            ax.plot(x, y_up, linestyle='--')
+            ax.plot(x, y_down, linestyle='--')
+            ax.set_ylim(y_min, y_max)
+            ax.set_xlim(x_min, x_max)
 
-        labels = set(y)
+            labels = set(yp)
 
-        for label in labels:
-            cluster = X[np.where(y == label)]
-            plt.scatter(cluster[:, 0], cluster[:, 1])
+            for label in labels:
+                cluster = Xp[np.where(yp == label)]
+                ax.scatter(cluster[:, 0], cluster[:, 1])
 
-        IMG = plt2html(plt)
+            if title is not None:
+                ax.set_title(title)
 
-        if show:
-            plt.show()
-        else:
-            plt.close()
+            return fig
 
+        IMG = _finish_figure(draw, show)
+
+    if return_err:
+        return width, IMG, err
     return width, IMG
 
 
-def IG(X, y, show=False, save_fig=''):
+IG_METHODS = ['knn', 'hist', 'quantile']
+
+
+def binned_mutual_info(X, y, bins=10, strategy='quantile'):
+    '''
+    Feature-wise mutual information (in nats) between binned features and the class labels.
+
+    All features are binned at once and the joint histograms of all features are counted by
+    a single np.bincount, instead of a kNN estimate per feature.
+
+    Parameters
+    ----------
+    bins : number of bins per feature
+    strategy : 'quantile' - equal-frequency bins (tied values stay in the same bin)
+        'hist' - equal-width bins between each feature's min and max
+
+    Note
+    ----
+    This is the plug-in estimate. It is biased upwards by about (bins - 1)(K - 1) / 2n
+    for K classes and n samples, which is the same for all features.
+    '''
+    X = np.asarray(X, dtype=float)
+    n, p = X.shape
+
+    if strategy == 'quantile':
+        rank = scipy.stats.rankdata(X, axis=0, method='min')
+        codes = ((rank - 1) * bins // n).astype(int)
+    elif strategy == 'hist':
+        lo = X.min(axis=0)
+        span = X.max(axis=0) - lo
+        span[span == 0] = 1
+        codes = np.minimum(((X - lo) / span * bins).astype(int), bins - 1)
+    else:
+        raise Exception('Unsupported binning strategy ' + str(strategy))
+
+    classes, yc = np.unique(y, return_inverse=True)
+    K = len(classes)
+
+    # joint counts of (feature, bin, class)
+    flat = (np.arange(p)[None, :] * bins + codes) * K + yc[:, None]
+    joint = np.bincount(flat.ravel(), minlength=p * bins * K).reshape(p, bins, K) / n
+
+    px = joint.sum(axis=2, keepdims=True)
+    py = joint.sum(axis=1, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = joint * np.log(joint / (px * py))
+
+    return np.nansum(terms, axis=(1, 2))
+
+
+# with a random_state, the kNN information gain is estimated on chunks of this many features,
+# each with its own seed, so the result does not depend on n_jobs
+IG_CHUNK = 256
+
+
+def _knn_mutual_info(X, y, n_jobs=None, random_state=None):
+    '''
+    mutual_info_classif() on chunks of features, computed in parallel.
+
+    With an int random_state, the chunks are IG_CHUNK features each, whatever n_jobs is, and
+    chunk k is seeded by the k-th child of SeedSequence(random_state). Otherwise there is one
+    chunk per job.
+    '''
+    p = X.shape[1]
+
+    if random_state is None:
+        if n_jobs is None or n_jobs == 1 or p < 2:
+            return mutual_info_classif(X, y, discrete_features=False)
+        n_chunks = min(p, joblib.cpu_count() if n_jobs < 0 else n_jobs)
+        chunks = np.array_split(np.arange(p), n_chunks)
+        seeds = [None] * n_chunks
+    else:
+        chunks = [np.arange(i, min(i + IG_CHUNK, p)) for i in range(0, p, IG_CHUNK)]
+        seeds = [int(ss.generate_state(1)[0])
+                 for ss in np.random.SeedSequence(random_state).spawn(len(chunks))]
+
+    mis = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(mutual_info_classif)(X[:, c], y, discrete_features=False, random_state=s)
+        for c, s in zip(chunks, seeds))
+    return np.concatenate(mis)
+
+
+def IG(X, y, show=False, save_fig='', method='knn', n_jobs=None, bins=10, random_state=None):
     """
     Return the feature-wise information gains.
     It can be proven that Info Gain = Mutual information
@@ -813,46 +1206,59 @@ def IG(X, y, show=False, save_fig=''):
 
     The term “discrete features” is used instead of naming them “categorical”, because it describes the essence more accurately. For example, pixel intensities of an image are discrete features (but hardly categorical) and you will get better results if mark them as such. Also note, that treating a continuous variable as discrete and vice versa will usually give incorrect results, so be attentive about that.
     True mutual information can’t be negative. If its estimate turns out to be negative, it is replaced by zero.
+
+    Parameters
+    ----------
+    method : 'knn' - mutual_info_classif(), the kNN estimator
+        'hist', 'quantile' - binned_mutual_info() with equal-width or equal-frequency bins.
+        Much faster for thousands of features.
+    n_jobs : for 'knn', number of feature chunks estimated in parallel, as in joblib.Parallel
+    bins : number of bins per feature for 'hist' and 'quantile'
+    random_state : an int seed of the noise that mutual_info_classif() adds to continuous
+        features. Each chunk of IG_CHUNK features gets its own child seed, so the result does
+        not depend on n_jobs.
     """
 
+    if method not in IG_METHODS:
+        raise Exception('Unsupported IG method ' + str(method))
+
     try:
-        mi = mutual_info_classif(X, y, discrete_features=False)
+        if method == 'knn':
+            mi = _knn_mutual_info(X, y, n_jobs, random_state)
+        else:
+            mi = binned_mutual_info(X, y, bins, method)
     except Exception as e:
         print('Exception in mutual_info_classif().', e)
         return None, None
 
-    mi_sorted = np.sort(mi)[::-1]  # sort in desceding order
-    mi_sorted_idx = np.argsort(mi)[::-1]
+    if not (show or save_fig or figures_enabled()):
+        return mi, ''  # a bar per feature is costly for wide data
 
-    if (X.shape[1] > 50):
-        plt.figure(figsize=(20, 3))
-    else:
-        plt.figure()  # use default fig size
+    def draw():
+        mi_sorted = np.sort(mi)[::-1]  # sort in desceding order
+        mi_sorted_idx = np.argsort(mi)[::-1]
 
-    xlabels = []
-    for i, v in enumerate(mi_sorted):
-        xlabels.append("X"+str(mi_sorted_idx[i] + 1))
-        # if (len(mi_sorted) < 20): # don't show text anno if feature number is large
-        plt.text(i-0.001, v+0.001,  str(round(v, 1)))
+        if (X.shape[1] > 50):
+            fig = new_figure(show, figsize=(20, 3))
+        else:
+            fig = new_figure(show)  # use default fig size
+        ax = fig.add_subplot()
 
-    plt.bar(xlabels, mi_sorted, facecolor="none",
-            edgecolor="black", width=0.3, hatch='/')
+        xlabels = []
+        for i, v in enumerate(mi_sorted):
+            xlabels.append("X"+str(mi_sorted_idx[i] + 1))
+            # if (len(mi_sorted) < 20): # don't show text anno if feature number is large
+            ax.text(i-0.001, v+0.001,  str(round(v, 1)))
 
-    plt.title('Info Gain of all features in descending order')
-    # plt.xticks ([])
+        ax.bar(xlabels, mi_sorted, facecolor="none",
+               edgecolor="black", width=0.3, hatch='/')
 
-    if (save_fig != '' and save_fig != None):
-        if save_fig.endswith('.jpg') == False:
-            save_fig += '.jpg'
-        plt.savefig(save_fig)
-        print('figure saved to ' + save_fig)
+        ax.set_title('Info Gain of all features in descending order')
+        # plt.xticks ([])
 
-    IMG = plt2html(plt)
+        return fig
 
-    if show:
-        plt.show()
-    else:
-        plt.close()
+    IMG = _finish_figure(draw, show, save_fig)
 
     return mi, IMG
 
@@ -883,28 +1289,24 @@ def CHISQ(X, y, show=False, save_fig=''):
 
     CHI2s, ps = chi2(X_mm_scaled, y)
 
-    if X.shape[1] > 50:
-        plt.figure(figsize=(20, 3))
-    else:
-        plt.figure()  # use default fig size
+    if not (show or save_fig or figures_enabled()):
+        return ps.tolist(), CHI2s.tolist(), IMG
 
-    plt.bar(range(len(CHI2s)), CHI2s, facecolor="none",
-            edgecolor="black", width=0.3, hatch='/')
-    plt.title('chi squared statistics')
-    # plt.xticks ([])
+    def draw():
+        if X.shape[1] > 50:
+            fig = new_figure(show, figsize=(20, 3))
+        else:
+            fig = new_figure(show)  # use default fig size
+        ax = fig.add_subplot()
 
-    if save_fig != '' and save_fig is not None:
-        if save_fig.endswith('.jpg') == False:
-            save_fig += '.jpg'
-        plt.savefig(save_fig)
-        print('figure saved to ' + save_fig)
+        ax.bar(range(len(CHI2s)), CHI2s, facecolor="none",
+               edgecolor="black", width=0.3, hatch='/')
+        ax.set_title('chi squared statistics')
+        # plt.xticks ([])
 
-    IMG = plt2html(plt)
+        return fig
 
-    if show:
-        plt.show()
-    else:
-        plt.close()
+    IMG = _finish_figure(draw, show, save_fig)
 
     return ps.tolist(), CHI2s.tolist(), IMG
 
@@ -940,18 +1342,7 @@ def KW(X, y, verbose=False):
 
         # Xcis = np.array(Xcis)
 
-        if len(set(y)) == 2:
-            H, p = scipy.stats.kruskal(Xcis[0], Xcis[1], nan_policy='omit')
-        elif len(set(y)) == 3:
-            H, p = scipy.stats.kruskal(
-                Xcis[0], Xcis[1], Xcis[2], nan_policy='omit')
-        elif len(set(y)) == 4:
-            H, p = scipy.stats.kruskal(
-                Xcis[0], Xcis[1], Xcis[2], Xcis[3], nan_policy='omit')
-        elif len(set(y)) >= 5:
-            H, p = scipy.stats.kruskal(
-                Xcis[0], Xcis[1], Xcis[2], Xcis[3], Xcis[4], nan_policy='omit')
-            print("WARN: only the first 5 classes will be analyzed.")
+        H, p = scipy.stats.kruskal(*Xcis, nan_policy='omit')
 
         ps.append(p)
         Hs.append(H)
@@ -1003,25 +1394,28 @@ def T_IND(X, y, verbose=False, show=False, max_plot_num=5):
         ps.append(p)
         Ts.append(T)
 
-        if (cnt < max_plot_num):
-            plt.figure()
-            # plot ith feature of different classes
-            plt.boxplot(Xcis, notch=False, labels=labels)
-            test_result = "independent t test on X{}: T={},p={}".format(
-                i + 1, round(T, 3), round(p, 3))
-            # plt.legend(labels)
-            plt.title(test_result)
-            IMG += plt2html(plt)
-
-            if show:
-                plt.show()
-            else:
-                plt.close()
+        if not (show or figures_enabled()):
+            pass  # figures are not used
+        elif (cnt < max_plot_num):
+            def draw(Xcis=Xcis, labels=labels, T=T, p=p, i=i):
+                fig = new_figure(show)
+                ax = fig.add_subplot()
+                # plot ith feature of different classes
+                ax.boxplot(Xcis, notch=False, labels=labels)
+                test_result = "independent t test on X{}: T={},p={}".format(
+                    i + 1, round(T, 3), round(p, 3))
+                # plt.legend(labels)
+                ax.set_title(test_result)
+                return fig
+
+            IMG += _finish_figure(draw, show)
         elif cnt == max_plot_num:
             IMG += '<p>Showing the first ' + str(max_plot_num) + ' plots.</p>'
         else:
             pass  # plot no more to avoid memory cost
 
+        cnt = cnt + 1
+
     if verbose:
         print('The P values of X in dimensions 1 to {}:{}'.format(
             len(X[0]), ps))
@@ -1059,19 +1453,7 @@ def MedianTest(X, y, verbose=False, show=False):
 
         # Xcis = np.array(Xcis)
 
-        if len(set(y)) == 2:
-            T, p, med, tbl = scipy.stats.median_test(
-                Xcis[0], Xcis[1], ties='ignore')
-        elif len(set(y)) == 3:
-            T, p, med, tbl = scipy.stats.median_test(
-                Xcis[0], Xcis[1], Xcis[2], ties='ignore')
-        elif len(set(y)) == 4:
-            T, p, med, tbl = scipy.stats.median_test(
-                Xcis[0], Xcis[1], Xcis[2], Xcis[3], ties='ignore')
-        elif len(set(y)) >= 5:
-            T, p, med, tbl = scipy.stats.median_test(
-                Xcis[0], Xcis[1], Xcis[2], Xcis[3], Xcis[4], ties='ignore')
-            print("WARN: only the first 5 classes will be analyzed.")
+        T, p, med, tbl = scipy.stats.median_test(*Xcis, ties='ignore')
 
         ps.append(p)
         Ts.append(T)
@@ -1081,48 +1463,47 @@ def MedianTest(X, y, verbose=False, show=False):
         a1 = TBL[0][:, 0]
         a2 = TBL[0][:, 1]
 
-    if len(X[0]) == 2 and len(set(y)) == 2:
+    if len(X[0]) == 2 and len(set(y)) == 2 and (show or figures_enabled()):
 
-        idx = 1
+        def draw():
+            idx = 1
 
-        fig, axes = plt.subplots(1, 2, figsize=(8, 4))
+            fig = new_figure(show, figsize=(8, 4))
+            axes = fig.subplots(1, 2)
 
-        for ax, tbl, m, p, T in zip(axes, TBL, MED, ps, Ts):
+            for ax, tbl, m, p, T in zip(axes, TBL, MED, ps, Ts):
 
-            tick_labels = ["> grand \n median", "< grand \n median"]
+                tick_labels = ["> grand \n median", "< grand \n median"]
 
-            im = ax.imshow(tbl, cmap='Greys')
+                im = ax.imshow(tbl, cmap='Greys')
 
-            # # We want to show all ticks...
-            ax.set_xticks(np.arange(len(tick_labels)))
-            ax.set_yticks(np.arange(len(tick_labels)))
-            # ... and label them with the respective list entries
-            ax.set_xticklabels(tick_labels)
-            ax.set_yticklabels(tick_labels)
+                # # We want to show all ticks...
+                ax.set_xticks(np.arange(len(tick_labels)))
+                ax.set_yticks(np.arange(len(tick_labels)))
+                # ... and label them with the respective list entries
+                ax.set_xticklabels(tick_labels)
+                ax.set_yticklabels(tick_labels)
 
-            # Rotate the tick labels and set their alignment.
-            plt.setp(ax.get_xticklabels(), rotation=0, ha="center", va="top",
-                     rotation_mode="anchor")
-            plt.setp(ax.get_yticklabels(), rotation=0, ha="right",
-                     rotation_mode="anchor")
+                # Rotate the tick labels and set their alignment.
+                matplotlib.artist.setp(ax.get_xticklabels(), rotation=0, ha="center", va="top",
+                                       rotation_mode="anchor")
+                matplotlib.artist.setp(ax.get_yticklabels(), rotation=0, ha="right",
+                                       rotation_mode="anchor")
 
-            # Loop over data dimensions and create text annotations.
-            for i in range(len(tick_labels)):
-                for j in range(len(tick_labels)):
-                    _ = ax.text(j, i, tbl[i, j],
-                                   ha="center", va="center", color="gray")
+                # Loop over data dimensions and create text annotations.
+                for i in range(len(tick_labels)):
+                    for j in range(len(tick_labels)):
+                        _ = ax.text(j, i, tbl[i, j],
+                                       ha="center", va="center", color="gray")
 
-            ax.set_title("Median contingency table (X" + str(idx) +
-                         ")\nCHI2 statistic = " + str(round(T, 3)) + ", p = " + str(round(p, 3)))
-            idx += 1
+                ax.set_title("Median contingency table (X" + str(idx) +
+                             ")\nCHI2 statistic = " + str(round(T, 3)) + ", p = " + str(round(p, 3)))
+                idx += 1
 
-        fig.tight_layout()
-        IMG = plt2html(plt)
+            fig.tight_layout()
+            return fig
 
-        if show:
-            plt.show()
-        else:
-            plt.close()
+        IMG = _finish_figure(draw, show)
 
     if verbose:
         print('The P value of X in dimensions 1 to {}:{}'.format(
@@ -1136,8 +1517,6 @@ def MedianTest(X, y, verbose=False, show=False):
 def ANOVA(X, y, verbose=False, show=False, max_plot_num=5):
     """
     Performa feature-wise ANOVA test. Returns an array of p-values on all the features and its minimum.
-
-    y - support up to 5 classes
     """
 
     if (len(set(y)) < 2):
@@ -1162,16 +1541,7 @@ def ANOVA(X, y, verbose=False, show=False, max_plot_num=5):
         # Xcis = np.array(Xcis)
 
         # equal to ttest_ind() in case of 2 groups
-        f, p = scipy.stats.f_oneway(Xcis[0], Xcis[1])
-
-        if (len(set(y)) == 3):
-            f, p = scipy.stats.f_oneway(Xcis[0], Xcis[1], Xcis[2])
-        elif (len(set(y)) == 4):
-            f, p = scipy.stats.f_oneway(Xcis[0], Xcis[1], Xcis[2], Xcis[3])
-        elif (len(set(y)) >= 5):  # if there are five or more classes
-            f, p = scipy.stats.f_oneway(
-                Xcis[0], Xcis[1], Xcis[2], Xcis[3], Xcis[4])
-            print('WARN: only the first 5 classes will be analyzed.')
+        f, p = scipy.stats.f_oneway(*Xcis)
 
         """
         Alternative implementation using sm.stats.anova_lm
@@ -1193,20 +1563,22 @@ def ANOVA(X, y, verbose=False, show=False, max_plot_num=5):
         ps.append(p)
         Fs.append(f)
 
-        if (cnt < max_plot_num):
+        test_result = "ANOVA on X{}: f={},p={}".format(i+1, f, round(p, 3))
 
-            plt.figure()
-            # plot ith feature of different classes
-            plt.boxplot(Xcis, notch=False, labels=labels)
-            test_result = "ANOVA on X{}: f={},p={}".format(i+1, f, round(p, 3))
-            # plt.legend(labels)
-            plt.title(test_result)
-            IMG += plt2html(plt)
+        if not (show or figures_enabled()):
+            pass  # figures are not used
+        elif (cnt < max_plot_num):
 
-            if show:
-                plt.show()
-            else:
-                plt.close()
+            def draw(Xcis=Xcis, labels=labels, test_result=test_result):
+                fig = new_figure(show)
+                ax = fig.add_subplot()
+                # plot ith feature of different classes
+                ax.boxplot(Xcis, notch=False, labels=labels)
+                # plt.legend(labels)
+                ax.set_title(test_result)
+                return fig
+
+            IMG += _finish_figure(draw, show)
         elif cnt == max_plot_num:
             IMG += '<p>Showing the first ' + str(max_plot_num) + ' plots.</p>'
         else:
@@ -1222,9 +1594,93 @@ def ANOVA(X, y, verbose=False, show=False, max_plot_num=5):
     return ps, Fs, IMG
 
 
+def manova_stats(X, y, tol=1e-8):
+    '''
+    One-way MANOVA of all features by direct linear algebra.
+
+    The total and between-class scatter matrices T = E + H and H are never formed in feature
+    space. X is whitened by its SVD, where T becomes the identity, so the eigenvalues of
+    pinv(T) H are those of the small K x K matrix of the weighted whitened class means.
+    The pseudo-inverse keeps only the components with singular values above tol (relative),
+    and at most n - K - 1 of them, so that E stays non-singular.
+
+    Return
+    ------
+    stats : a dict of "Wilks' lambda", "Pillai's trace", "Hotelling-Lawley trace" and
+        "Roy's greatest root" -> (value, num df, den df, F, p), with the same F approximations
+        as statsmodels' MANOVA
+    rank : the number of (whitened) dimensions tested
+    '''
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y)
+    n = len(y)
+    classes = sorted(set(y))
+    K = len(classes)
+
+    if K < 2 or n - K - 1 < 1:
+        raise Exception('MANOVA needs at least two classes and more than K + 1 samples.')
+
+    Xc = X - X.mean(axis=0)
+    U, S, _ = np.linalg.svd(Xc, full_matrices=False)
+    rank = min(int((S > tol * S[0]).sum()) if S[0] > 0 else 0, n - K - 1)
+    if rank == 0:
+        raise Exception('MANOVA needs non-constant features.')
+    U = U[:, :rank]
+
+    G = np.array([np.sqrt((y == c).sum()) * U[y == c].mean(axis=0) for c in classes])
+    theta = np.clip(np.linalg.eigvalsh(G @ G.T), 0, 1 - 1e-15)  # eigenvalues of pinv(T) H
+    theta = theta[theta > tol]
+
+    p, q, v = rank, K - 1, n - K
+    s = min(p, q)
+    m = (abs(p - q) - 1) / 2
+    nn = (v - p - 1) / 2
+    lam = theta / (1 - theta)  # eigenvalues of pinv(E) H
+
+    stats = {}
+
+    # Wilks' lambda, Rao's F approximation
+    wilks = np.prod(1 - theta)
+    t = np.sqrt((p * p * q * q - 4) / (p * p + q * q - 5)) if p * p + q * q - 5 > 0 else 1
+    df1 = p * q
+    df2 = (v - (p - q + 1) / 2) * t - (p * q - 2) / 2
+    w = wilks ** (1 / t)
+    stats["Wilks' lambda"] = (wilks, df1, df2, (1 - w) / w * df2 / df1)
+
+    # Pillai's trace
+    V = theta.sum()
+    df1 = s * (2 * m + s + 1)
+    df2 = s * (2 * nn + s + 1)
+    stats["Pillai's trace"] = (V, df1, df2, df2 / df1 * V / (s - V))
+
+    # Hotelling-Lawley trace
+    HL = lam.sum()
+    if nn > 1:
+        b = (p + 2 * nn) * (q + 2 * nn) / 2 / (2 * nn + 1) / (nn - 1)
+        df1 = p * q
+        df2 = 4 + (p * q + 2) / (b - 1)
+        c = (df2 - 2) / 2 / nn
+        stats['Hotelling-Lawley trace'] = (HL, df1, df2, df2 / df1 * HL / c)
+    else:
+        df1 = s * (2 * m + s + 1)
+        df2 = s * (s * nn + 1)
+        stats['Hotelling-Lawley trace'] = (HL, df1, df2, df2 / df1 / s * HL)
+
+    # Roy's greatest root, an upper bound of F
+    roy = lam.max() if len(lam) else 0.0
+    r = max(p, q)
+    stats["Roy's greatest root"] = (roy, r, v - r + q, (v - r + q) / r * roy)
+
+    for k, (value, df1, df2, F) in stats.items():
+        stats[k] = (value, df1, df2, F, scipy.stats.f.sf(F, df1, df2))
+
+    return stats, rank
+
+
 def MANOVA(X, y, verbose=False):
     """
-    MANOVA test of the first two features.  
+    One-way MANOVA test of all the features. See manova_stats().
+    Returns the p-value and F of Wilks' lambda, and a log of all four statistics.
 
     For some statisticians the MANOVA doesn’t only compare differences in mean scores between multiple groups but also assumes a cause effect relationship whereby one or more independent, controlled variables (the factors) cause the significant difference of one or more characteristics. The factors sort the data points into one of the groups causing the difference in the mean value of the groups.
     Internally, it uses multivariate regression
@@ -1235,31 +1691,20 @@ def MANOVA(X, y, verbose=False):
         anova_p, anova_F, _ = ANOVA(X, y)
         return anova_p, anova_F, txt
 
-    X1 = X[:, 0]
-    X2 = X[:, 1]
-    df = pd.DataFrame({'X1': X1, 'X2': X2, 'y': y})
-    # Intercept is included by default.
-    mv = manova.MANOVA.from_formula('X1 + X2 ~ y', data=df)
-
     try:
-        r = mv.mv_test()
-    except:  # LinAlgError: Singular matrix
+        stats, rank = manova_stats(X, y)
+    except Exception:  # e.g., too few samples
         return math.nan, math.nan, 'Exception in MANOVA'
 
-    LOG = ''
-    LOG += 'endog: ' + str(mv.endog_names) + '\n'
-    LOG += 'exog: ' + str(mv.exog_names) + '\n\n'
-    LOG += str(r)
-
-    delimiters = "Wilks' lambda", "Pillai's trace"
-    regexPattern = '|'.join(map(re.escape, delimiters))
-    ss = re.split(regexPattern, str(r.results['y']['stat']['Pr > F']))
-    manova_p = float(ss[1].strip())
-
-    ss = re.split(regexPattern, str(r.results['y']['stat']['F Value']))
-    manova_F = float(ss[1].strip())
+    LOG = str(X.shape[1]) + ' features, ' + str(len(set(y))) + ' classes, ' + \
+        str(rank) + ' dimensions tested\n\n'
+    LOG += '{:<25}{:>12}{:>10}{:>12}{:>12}{:>12}\n'.format(
+        '', 'Value', 'Num DF', 'Den DF', 'F Value', 'Pr > F')
+    for k, (value, df1, df2, F, p) in stats.items():
+        LOG += '{:<25}{:>12.4f}{:>10.4f}{:>12.4f}{:>12.4f}{:>12.4g}\n'.format(
+            k, value, df1, df2, F, p)
 
-    # print(manova_F, manova_p) # use one of the four tests (their results are the same for almost all the time)
+    _, _, _, manova_F, manova_p = stats["Wilks' lambda"]
 
     if (manova_p == 0):  # add a very small amount to make log legal
         manova_p = sys.float_info.epsilon
@@ -1309,21 +1754,23 @@ def MWW(X, y, verbose=False, show=False, max_plot_num=5):
         ps.append(p)
         Us.append(U)
 
-        if cnt < max_plot_num:
-            plt.figure()
-            plt.hist(Xcis, bins=min(12, int(len(y)/3)), alpha=0.4, edgecolor='black', label=["$ X_"+str(
-                i+1)+"^{( y_"+str(0)+")} $", "$ X_"+str(i+1)+"^{( y_"+str(1)+")} $"])  # plot ith feature of different classes
-            test_result = "MWW test on X{}: U={},p={}".format(
-                i+1, U, round(p, 3))
-            plt.title('Feature X{} histogram on different classes\n'.format(
-                i+1) + test_result)
-            plt.legend()
-            IMG += plt2html(plt) + '<br/>'
-
-            if show:
-                plt.show()
-            else:
-                plt.close()
+        test_result = "MWW test on X{}: U={},p={}".format(
+            i+1, U, round(p, 3))
+
+        if not (show or figures_enabled()):
+            pass  # figures are not used
+        elif cnt < max_plot_num:
+            def draw(Xcis=Xcis, test_result=test_result, i=i):
+                fig = new_figure(show)
+                ax = fig.add_subplot()
+                ax.hist(Xcis, bins=min(12, int(len(y)/3)), alpha=0.4, edgecolor='black', label=["$ X_"+str(
+                    i+1)+"^{( y_"+str(0)+")} $", "$ X_"+str(i+1)+"^{( y_"+str(1)+")} $"])  # plot ith feature of different classes
+                ax.set_title('Feature X{} histogram on different classes\n'.format(
+                    i+1) + test_result)
+                ax.legend()
+                return fig
+
+            IMG += _finish_figure(draw, show) + '<br/>'
 
         elif cnt == max_plot_num:
             IMG += '<p>Showing the first ' + str(max_plot_num) + ' plots.</p>'
@@ -1381,32 +1828,28 @@ def cohen_d(X, y, show=False, save_fig=''):
 
     d = np.abs(np.mean(Xc1, axis=0) - np.mean(Xc2, axis=0)) / pooled_std
 
-    plt.figure()
+    if not (show or save_fig or figures_enabled()):
+        return d, ''
 
-    d_sorted = np.sort(d)[::-1]  # sort in desceding order
-    d_sorted_idx = np.argsort(d)[::-1]
-    xlabels = []
-    for i, v in enumerate(d_sorted):
-        xlabels.append("X"+str(d_sorted_idx[i] + 1))
-        plt.text(i-0.01, v+0.01,  str(round(v, 1)))
+    def draw():
+        fig = new_figure(show)
+        ax = fig.add_subplot()
 
-    plt.bar(xlabels, d_sorted, facecolor="none",
-            edgecolor="black", width=0.3, hatch="\\")
-    plt.title("Effect Size (Cohen's d) for all features in descending order")
-    # plt.xticks ([])
+        d_sorted = np.sort(d)[::-1]  # sort in desceding order
+        d_sorted_idx = np.argsort(d)[::-1]
+        xlabels = []
+        for i, v in enumerate(d_sorted):
+            xlabels.append("X"+str(d_sorted_idx[i] + 1))
+            ax.text(i-0.01, v+0.01,  str(round(v, 1)))
 
-    if (save_fig != '' and save_fig != None):
-        if save_fig.endswith('.jpg') == False:
-            save_fig += '.jpg'
-        plt.savefig(save_fig)
-        print('figure saved to ' + save_fig)
+        ax.bar(xlabels, d_sorted, facecolor="none",
+               edgecolor="black", width=0.3, hatch="\\")
+        ax.set_title("Effect Size (Cohen's d) for all features in descending order")
+        # plt.xticks ([])
 
-    IMG = plt2html(plt)
+        return fig
 
-    if show:
-        plt.show()
-    else:
-        plt.close()
+    IMG = _finish_figure(draw, show, save_fig)
 
     return d, IMG  # d is a 1xn array. n is feature num
 
@@ -1520,22 +1963,23 @@ def KS(X, y, show=False, max_plot_num=5):
         ps.append(p)
         Ds.append(D)
 
-        if cnt < max_plot_num:
+        if not (show or figures_enabled()):
+            pass  # figures are not used
+        elif cnt < max_plot_num:
 
-            plt.figure()
-            plt.hist(Xcis, cumulative=True, histtype=u'step', bins=min(12, int(len(y)/3)), label=["$ CDF( X_"+str(
-                i+1)+"^{(y_"+str(0)+")} ) $", "$ CDF( X_"+str(i+1)+"^{(y_"+str(1)+")} ) $"])  # plot ith feature of different classes
-            test_result = "KS test on X{}: D={},p={}".format(
-                i+1, D, round(p, 3))
-            plt.title('Feature X{} CDF on the two classes\n'.format(
-                i+1) + test_result)
-            plt.legend(loc='upper left')
-            IMG += plt2html(plt) + '<br/>'
+            def draw(Xcis=Xcis, D=D, p=p, i=i):
+                fig = new_figure(show)
+                ax = fig.add_subplot()
+                ax.hist(Xcis, cumulative=True, histtype=u'step', bins=min(12, int(len(y)/3)), label=["$ CDF( X_"+str(
+                    i+1)+"^{(y_"+str(0)+")} ) $", "$ CDF( X_"+str(i+1)+"^{(y_"+str(1)+")} ) $"])  # plot ith feature of different classes
+                test_result = "KS test on X{}: D={},p={}".format(
+                    i+1, D, round(p, 3))
+                ax.set_title('Feature X{} CDF on the two classes\n'.format(
+                    i+1) + test_result)
+                ax.legend(loc='upper left')
+                return fig
 
-            if show:
-                plt.show()
-            else:
-                plt.close()
+            IMG += _finish_figure(draw, show) + '<br/>'
 
         elif cnt == max_plot_num:
             IMG += '<p>Showing the first ' + str(max_plot_num) + ' plots.</p>'
@@ -1623,16 +2067,18 @@ def ECoL_metrics(X, y):
 
     # ys = map(lambda x : 'Class ' + str(x), y)
     # M = np.hstack((X,np.array(list(ys)).reshape(-1,1)))
-    M = np.hstack((X, y.reshape(-1, 1)))
-    df = pd.DataFrame(M)
-    # rdf = com.convert_to_r_dataframe(df)
-    # rdf = pandas2ri.py2rpy_pandasdataframe(df)
-    pandas2ri.activate()  # To fix NotImplementedError in Raspbian: Conversion 'rpy2py' not defined for objects of type 'rpy2.rinterface.SexpClosure'>'
-    with localconverter(robjects.default_converter + pandas2ri.converter):
-        rdf = robjects.conversion.py2rpy(df)
-    robjects.globalenv['rdf'] = rdf
-
-    metrics = robjects.r('''
+    with span('ECoL.convert', 'r'):
+        M = np.hstack((X, y.reshape(-1, 1)))
+        df = pd.DataFrame(M)
+        # rdf = com.convert_to_r_dataframe(df)
+        # rdf = pandas2ri.py2rpy_pandasdataframe(df)
+        pandas2ri.activate()  # To fix NotImplementedError in Raspbian: Conversion 'rpy2py' not defined for objects of type 'rpy2.rinterface.SexpClosure'>'
+        with localconverter(robjects.default_converter + pandas2ri.converter):
+            rdf = robjects.conversion.py2rpy(df)
+        robjects.globalenv['rdf'] = rdf
+
+    with span('ECoL.compute', 'r'):
+        metrics = robjects.r('''
             # install.packages("ECoL")
 
             # judge and install
@@ -1653,9 +2099,10 @@ def ECoL_metrics(X, y):
 
     rpt = ''
     dic = {}
-    for v in zip(ECoL_METRICS, metrics):
-        rpt += v[0] + "\t" + str(v[1]) + "\n"
-        dic[v[0]] = v[1]
+    with span('ECoL.convert', 'r'):
+        for v in zip(ECoL_METRICS, metrics):
+            rpt += v[0] + "\t" + str(v[1]) + "\n"
+            dic[v[0]] = v[1]
 
     return dic, rpt
 
@@ -1668,7 +2115,724 @@ def analyze_file(fn):
     return get_html(X, y)
 
 
-def get_metrics(X, y):
+# Metric families computed by Analysis. Each entry calls one metric function on (X, y).
+# Keyword arguments come from the options of Analysis, e.g., {'CLF': {'cache': CLFCache()}}.
+METRIC_FAMILIES = {
+    'CLF': lambda X, y, **kwargs: CLF(X, y, **kwargs),
+    'BER': lambda X, y, **kwargs: BER(X, y, **kwargs),
+    'SVM': lambda X, y, **kwargs: SVM_Margin_Width(X, y, **kwargs),
+    'IG': lambda X, y, **kwargs: IG(X, y, **kwargs),
+    'correlate': lambda X, y, **kwargs: correlate(X, y, **kwargs),
+    'cohen_d': lambda X, y, **kwargs: cohen_d(X, y, **kwargs),
+    'T_IND': lambda X, y, **kwargs: T_IND(X, y, **kwargs),
+    'ANOVA': lambda X, y, **kwargs: ANOVA(X, y, **kwargs),
+    'MANOVA': lambda X, y, **kwargs: MANOVA(X, y, **kwargs),
+    'MWW': lambda X, y, **kwargs: MWW(X, y, **kwargs),
+    'KS': lambda X, y, **kwargs: KS(X, y, **kwargs),
+    'CHISQ': lambda X, y, **kwargs: CHISQ(X, y, **kwargs),
+    'KW': lambda X, y, **kwargs: KW(X, y, **kwargs),
+    'MedianTest': lambda X, y, **kwargs: MedianTest(X, y, **kwargs),
+    'ECoL': lambda X, y, **kwargs: ECoL_metrics(X, y, **kwargs),
+}
+
+
+# Key prefix -> metric family. More specific prefixes come first.
+KEY_FAMILIES = [
+    ('classification.BER', 'BER'),
+    ('classification.SVM.Margin', 'SVM'),
+    ('classification.', 'CLF'),
+    ('correlation.IG', 'IG'),
+    ('correlation.', 'correlate'),
+    ('test.ES', 'cohen_d'),
+    ('test.student', 'T_IND'),
+    ('test.ANOVA', 'ANOVA'),
+    ('test.MANOVA', 'MANOVA'),
+    ('test.MWW', 'MWW'),
+    ('test.KS', 'KS'),
+    ('test.CHISQ', 'CHISQ'),
+    ('test.KW', 'KW'),
+    ('test.Median', 'MedianTest'),
+    ('overlapping.', 'ECoL'),
+    ('neighborhood.', 'ECoL'),
+    ('linearity.', 'ECoL'),
+    ('dimensionality.', 'ECoL'),
+    ('balance.', 'ECoL'),
+    ('network.', 'ECoL'),
+]
+
+
+# Multivariate metric families that run on the projected X when Analysis has a dr pre-stage.
+# The per-feature tests always see the original features.
+PROJECTED_FAMILIES = ['CLF', 'BER', 'SVM', 'MANOVA', 'ECoL']
+
+DR_METHODS = {
+    'pca': 'randomized PCA',
+    'svd': 'randomized truncated SVD',
+    'srp': 'sparse random projection',
+}
+
+
+def project(X, dr='pca', n_components=50, random_state=0):
+    '''
+    Project X to a lower dimension once, for the expensive multivariate metrics.
+
+    Parameters
+    ----------
+    dr : 'pca' - randomized PCA (centers X)
+        'svd' - randomized truncated SVD (no centering, suits non-negative spectra)
+        'srp' - sparse random projection (fastest, no fitting)
+    n_components : target dimension. It is capped by the sample and feature counts.
+
+    Return
+    ------
+    Xp : the projected X. X itself if it already has no more than n_components features.
+    model : the fitted projection, or None if X is not projected
+    '''
+    if dr not in DR_METHODS:
+        raise Exception('Unsupported dr method ' + str(dr))
+
+    n, p = X.shape
+    if p <= n_components:
+        return X, None
+
+    if dr == 'pca':
+        model = PCA(n_components=min(n_components, n), svd_solver='randomized',
+                    random_state=random_state)
+    elif dr == 'svd':
+        model = TruncatedSVD(n_components=min(n_components, n - 1),
+                             algorithm='randomized', random_state=random_state)
+    else:
+        model = SparseRandomProjection(n_components=n_components, random_state=random_state)
+
+    return model.fit_transform(X), model
+
+
+def metric_families(keys=None):
+    '''
+    Return the metric families (keys of METRIC_FAMILIES) needed to compute the metric keys,
+    in the canonical computation order. If keys is None, return all families.
+    '''
+    if keys is None:
+        return list(METRIC_FAMILIES)
+
+    needed = set()
+    for key in keys:
+        for prefix, family in KEY_FAMILIES:
+            if key.startswith(prefix):
+                needed.add(family)
+                break
+        else:
+            raise Exception('Unknown metric ' + str(key))
+
+    return [f for f in METRIC_FAMILIES if f in needed]
+
+
+# Metric families that only support two classes. On multi-class data, Analysis runs them
+# on one-vs-rest or one-vs-one binary subproblems.
+BINARY_FAMILIES = ['CLF', 'BER', 'cohen_d', 'T_IND', 'MWW', 'KS']
+
+MULTICLASS_STRATEGIES = ['ovr', 'ovo']
+
+
+def class_pairs(y, strategy='ovr'):
+    '''
+    Split a multi-class problem into binary subproblems, using one class partition.
+
+    Parameters
+    ----------
+    strategy : 'ovr' - one class (label 1) vs the rest (label 0)
+        'ovo' - each pair of classes, the first (label 0) vs the second (label 1)
+
+    Return
+    ------
+    A list of (name, idx, yb). idx are the sample indices of the subproblem
+    (None for all samples) and yb are its 0/1 labels.
+    '''
+    if strategy not in MULTICLASS_STRATEGIES:
+        raise Exception('Unsupported multi-class strategy ' + str(strategy))
+
+    y = np.asarray(y)
+    classes = sorted(set(y))
+    partition = {c: np.flatnonzero(y == c) for c in classes}
+
+    pairs = []
+    if strategy == 'ovr':
+        for c in classes:
+            pairs.append((str(c) + ' vs rest', None, (y == c).astype(int)))
+    else:
+        for i, a in enumerate(classes):
+            for b in classes[i + 1:]:
+                idx = np.concatenate([partition[a], partition[b]])
+                yb = np.r_[np.zeros(len(partition[a]), dtype=int),
+                           np.ones(len(partition[b]), dtype=int)]
+                pairs.append((str(a) + ' vs ' + str(b), idx, yb))
+
+    return pairs
+
+
+def _binary_metrics(X, y, families, options=None):
+    '''
+    Single-value metrics of each family on one binary subproblem
+    '''
+    a = Analysis(X, y, figures=False, options=options)
+    out = {}
+    for family in families:
+        try:
+            dic = a._family_metrics(family)
+        except Exception as e:
+            print('Exception in ' + family + ':', e)
+            dic = {}
+        out[family] = {k: v for k, v in dic.items() if not hasattr(v, '__len__')}
+    return out
+
+
+def pairwise_metrics(X, y, families=None, strategy='ovr', n_jobs=None, options=None):
+    '''
+    Run binary-only metric families on all binary subproblems of a multi-class dataset.
+
+    Parameters
+    ----------
+    families : subset of BINARY_FAMILIES. Default is all.
+    strategy : 'ovr' or 'ovo'. See class_pairs().
+    n_jobs : number of subproblems computed concurrently, as in joblib.Parallel.
+    options : a dict of family -> keyword arguments of its metric function, passed to every
+        subproblem. See Analysis.
+
+    Return
+    ------
+    pairs : names of the subproblems
+    dic : a dict of family -> named metrics. For each single-value metric key k:
+        k : the mean over subproblems (macro average)
+        k.<strategy> : the per-subproblem values
+        k.<strategy>.min, k.<strategy>.max : the extremes over subproblems
+    '''
+    if families is None:
+        families = BINARY_FAMILIES
+
+    pairs = class_pairs(y, strategy)
+    results = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_binary_metrics)(X if idx is None else X[idx], yb, families, options)
+        for _, idx, yb in pairs)
+
+    dic = {}
+    for family in families:
+        keys = []
+        for r in results:
+            keys += [k for k in r[family] if k not in keys]
+
+        fdic = {}
+        for k in keys:
+            v = np.array([r[family].get(k, np.nan) for r in results], dtype=float)
+            empty = np.all(np.isnan(v))  # e.g., p-values of degenerate pairs. nanmean() would warn.
+            fdic[k] = np.nan if empty else np.nanmean(v)
+            fdic[k + '.' + strategy] = v
+            fdic[k + '.' + strategy + '.min'] = np.nan if empty else np.nanmin(v)
+            fdic[k + '.' + strategy + '.max'] = np.nan if empty else np.nanmax(v)
+        dic[family] = fdic
+
+    return [name for name, _, _ in pairs], dic
+
+
+class Analysis:
+    '''
+    Classifiability analysis of one dataset.
+
+    Each metric family is computed at most once, on first use, and its result
+    (including fitted models, logs and figures) is cached. metrics(), html() and json()
+    are different views of the same computation.
+
+    Example
+    -------
+    a = Analysis(X, y)
+    dic, dic_s = a.metrics()
+    html = a.html()  # reuses every metric computed above, only renders the figures
+
+    # wide spectra: run the multivariate metrics on 50 randomized PCA components
+    a = Analysis(X, y, dr='pca', n_components=50)
+    '''
+
+    def __init__(self, X, y, figures=True, fmt=None, dpi=None, dr=None, n_components=50,
+                 multiclass='ovr', n_jobs=None, options=None, trace_memory=False, lazy=False):
+        '''
+        Parameters
+        ----------
+        figures : whether to keep the figures for html(). Set False if only numbers are needed.
+        fmt, dpi : image format and dpi of the figures. See cla.vis.render.
+        dr : None, or a key of DR_METHODS. If set, X is projected once by project() and
+            the families in PROJECTED_FAMILIES run on the projected X.
+        n_components : target dimension of dr
+        multiclass : 'ovr' or 'ovo'. With more than two classes, the families in
+            BINARY_FAMILIES are computed on binary subproblems. See pairwise_metrics().
+        n_jobs : number of binary subproblems computed concurrently
+        options : a dict of family -> keyword arguments of its metric function,
+            e.g., {'CLF': {'cache': CLFCache(), 'md': 0.5}}
+        trace_memory : also record the peak allocation of each family in self.timings.
+            Slows down the computation.
+        lazy : keep how each figure is drawn instead of drawing it, and draw it only when it
+            is rendered or requested. See lazy_html().
+        '''
+        self.X = X
+        self.y = y
+        self.options = options or {}
+        self.multiclass = multiclass
+        self.n_jobs = n_jobs
+        self.pairs = None  # names of the binary subproblems, once computed
+        self.dr = dr
+        self.n_components = n_components
+        self.projected = []  # families that ran on the projected X
+        self._Xp = None
+        self.batch = FigureBatch(fmt=fmt, dpi=dpi, keep=figures, lazy=lazy)
+        self.results = {}  # family -> return value of the metric function, or the exception it raised
+        self._metrics = {}  # family -> named metrics
+        self._html = None
+        self.recorder = Recorder(memory=trace_memory)  # spans of the computations run so far
+
+    @property
+    def timings(self):
+        '''
+        Wall time, CPU time and peak allocation of each metric family and report stage.
+        See instrument.Recorder.timings().
+        '''
+        return self.recorder.timings()
+
+    @property
+    def X_projected(self):
+        '''
+        The projected X, computed on first use. X itself if there is no dr pre-stage
+        or X is already low-dimensional.
+        '''
+        if self._Xp is None:
+            if self.dr is None:
+                self._Xp = self.X
+            else:
+                with self.recorder, span('project.' + self.dr, 'dr'):
+                    self._Xp, _ = project(self.X, self.dr, self.n_components)
+        return self._Xp
+
+    def is_pairwise(self, family):
+        '''
+        Whether the family runs on binary subproblems of this dataset
+        '''
+        return family in BINARY_FAMILIES and len(set(self.y)) > 2
+
+    def _pairwise(self, families):
+        '''
+        Compute binary-only families on all subproblems at once, reusing the class partition
+        '''
+        todo = [f for f in families if self.is_pairwise(f) and f not in self._metrics]
+        projected = [f for f in todo if f in PROJECTED_FAMILIES]
+
+        for group in (projected, [f for f in todo if f not in projected]):
+            if not group:
+                continue
+            X = self.X
+            if group is projected and self.X_projected is not self.X:
+                X = self.X_projected
+            with self.recorder, span('pairwise.' + self.multiclass, 'metric', families=group):
+                self.pairs, dic = pairwise_metrics(X, self.y, group, self.multiclass, self.n_jobs,
+                                                  options=self.options)
+            self._metrics.update(dic)
+            if X is not self.X:
+                self.projected += group
+
+    def _pairwise_html(self, family):
+        '''
+        Report row of a family computed on binary subproblems
+        '''
+        self._pairwise([family])
+
+        log = 'Subproblems: ' + ', '.join(self.pairs) + '\n'
+        for k, v in self._metrics[family].items():
+            if hasattr(v, '__len__'):
+                log += '\n' + k + ': ' + str(np.round(v, 4))
+
+        return '<tr><td> ' + family + ' (' + self.multiclass + ')' + self._dr_note(family) + \
+            '<br/><pre>' + log + '</pre></td><tr>'
+
+    def _family_X(self, family):
+        if family in PROJECTED_FAMILIES and self.X_projected is not self.X:
+            return self.X_projected
+        return self.X
+
+    def _failed(self, family, r):
+        '''
+        Whether a family result is a failure: the exception it raised, or its error return
+        '''
+        if isinstance(r, Exception):
+            return True
+        if family == 'CLF':
+            return r[0] is None
+        if family == 'MANOVA':
+            return r[2] == 'Exception in MANOVA'
+        return False
+
+    def _dr_note(self, family):
+        '''
+        Report note for a family that ran on the projected X
+        '''
+        if family not in self.projected:
+            return ''
+        return ' (on ' + str(self.X_projected.shape[1]) + ' ' + \
+            DR_METHODS[self.dr] + ' components)'
+
+    def result(self, family, strict=True):
+        '''
+        Return the cached result of a metric family, computing it on first use.
+
+        strict : if True, re-raise the exception the family raised. Otherwise return it.
+        '''
+        if family not in self.results:
+            X = self._family_X(family)
+            with self.recorder, span(family, 'metric'), self.batch:
+                try:
+                    self.results[family] = METRIC_FAMILIES[family](
+                        X, self.y, **self.options.get(family, {}))
+                except Exception as e:
+                    self.results[family] = e
+
+            # only families that produced a result count as run on the projected X
+            if X is not self.X and not self._failed(family, self.results[family]):
+                self.projected.append(family)
+
+        r = self.results[family]
+        if strict and isinstance(r, Exception):
+            raise r
+        return r
+
+    def metrics(self, keys=None):
+        '''
+        Return a dict of all metrics and a dict of the single-value metrics.
+        See get_metrics().
+
+        keys : only compute the metric families needed for these keys.
+            The returned dicts may contain other keys of the same families.
+        '''
+        families = metric_families(keys)
+        self._pairwise(families)
+
+        dic = {}
+        for family in families:
+            if family not in self._metrics:
+                self._metrics[family] = self._family_metrics(family)
+            dic.update(self._metrics[family])
+
+        if self.dr is not None:
+            dic['meta.projected'] = [f for f in families if f in self.projected]
+
+        if self.pairs is not None:
+            dic['meta.pairs'] = self.pairs
+
+        dic_s = {}
+
+        for k, v in dic.items():
+            if hasattr(v, "__len__"):  # this is an np array or list
+                dic[k] = list(v)
+            else:  # this only contains single-value metrics
+                dic_s[k] = v
+
+        return dic, dic_s
+
+    def _family_metrics(self, family):
+        '''
+        Convert the result of a metric family into named metrics
+        '''
+
+        X, y = self.X, self.y
+        dic = {}
+
+        if family == 'CLF':
+            r, _, _ = self.result('CLF')
+            if r is not None:
+                dic.update(r)
+
+        elif family == 'BER':
+            ber = 1  # set maximum BER
+            r = self.result('BER', strict=False)
+            if isinstance(r, Exception):
+                print('Exception in GaussianNB.', r)
+            else:
+                ber, _ = r
+            dic['classification.BER'] = ber
+
+        elif family == 'SVM':
+            r = self.result('SVM')
+            dic['classification.SVM.Margin'] = r[0]
+            if len(r) > 2:  # return_err
+                dic['classification.SVM.Margin.err'] = r[2]
+
+        elif family == 'IG':
+            ig, _ = self.result('IG')
+            if ig is not None:
+                dic['correlation.IG'] = ig
+                dic['correlation.IG.max'] = ig.max()
+
+        elif family == 'correlate':
+            dic_cor, _ = self.result('correlate')
+            dic.update(dic_cor)
+
+        elif family == 'cohen_d':
+            es, _ = self.result('cohen_d')
+            dic['test.ES'] = es
+            dic['test.ES.max'] = es.max()
+
+        elif family == 'T_IND':
+            p, T, _ = self.result('T_IND')
+            dic['test.student'] = p
+            dic['test.student.min'] = np.min(p)
+            dic['test.student.min.log10'] = np.log10(np.min(p))
+            dic['test.student.T'] = T
+            dic['test.student.T.max'] = np.max(T)
+
+        elif family == 'ANOVA':
+            p, F, _ = self.result('ANOVA')
+            dic['test.ANOVA'] = p
+            dic['test.ANOVA.min'] = np.min(p)
+            dic['test.ANOVA.min.log10'] = np.log10(np.min(p))
+            dic['test.ANOVA.F'] = F
+            dic['test.ANOVA.F.max'] = np.max(F)
+
+        elif family == 'MANOVA':
+            p, F, log = self.result('MANOVA')
+            if log == 'Exception in MANOVA':
+                pass
+            else:
+                dic['test.MANOVA'] = p
+                dic['test.MANOVA.log10'] = np.log10(p)
+                dic['test.MANOVA.F'] = F
+
+        elif family == 'MWW':
+            p, U, _ = self.result('MWW')
+            dic['test.MWW'] = p
+            dic['test.MWW.min'] = np.min(p)
+            dic['test.MWW.min.log10'] = np.log10(np.min(p))
+            dic['test.MWW.U'] = U
+            dic['test.MWW.U.min'] = np.min(U)
+
+        elif family == 'KS':
+            p, D, _ = self.result('KS')
+            dic['test.KS'] = p
+            dic['test.KS.min'] = np.min(p)
+            dic['test.KS.min.log10'] = np.log10(np.min(p))
+            dic['test.KS.D'] = D
+            dic['test.KS.D.max'] = np.max(D)
+
+        elif family == 'CHISQ':
+            p, C, _ = self.result('CHISQ')
+            dic['test.CHISQ'] = p
+            dic['test.CHISQ.min'] = np.min(p)
+            dic['test.CHISQ.min.log10'] = np.log10(np.min(p))
+            dic['test.CHISQ.CHI2'] = C
+            dic['test.CHISQ.CHI2.max'] = np.max(C)
+
+        elif family == 'KW':
+            # H follows chi2, its critical value of chi2(k-1) at 0.5
+            H = [scipy.stats.chi2.ppf(.5, len(set(y))-1)] * X.shape[1]
+            p = [.5] * X.shape[1]
+            r = self.result('KW', strict=False)
+            if isinstance(r, Exception):
+                print('KW Exception: ', r)
+            else:
+                p, H = r
+            dic['test.KW'] = p
+            dic['test.KW.min'] = np.min(p)
+            dic['test.KW.min.log10'] = np.log10(np.min(p))
+            dic['test.KW.H'] = H
+            dic['test.KW.H.max'] = np.max(H)
+
+        elif family == 'MedianTest':
+            # T follows chi2, its critical value of chi2(k-1) at 0.5
+            T = [scipy.stats.chi2.ppf(.5, len(set(y))-1)] * X.shape[1]
+            p = [.5] * X.shape[1]
+            r = self.result('MedianTest', strict=False)
+            if isinstance(r, Exception):
+                print('MedianTest Exception: ', r)
+            else:
+                p, T, _ = r
+            dic['test.Median'] = p
+            dic['test.Median.min'] = np.min(p)
+            dic['test.Median.min.log10'] = np.log10(np.min(p))
+            dic['test.Median.CHI2'] = T
+            dic['test.Median.CHI2.max'] = np.max(T)
+
+        elif family == 'ECoL':
+            if ENABLE_R:
+                r = self.result('ECoL', strict=False)
+                if isinstance(r, Exception):
+                    print(r)
+                else:
+                    dic.update(r[0])
+
+        return dic
+
+    def json(self):
+        return json.dumps(self.metrics())
+
+    def _build_html(self):
+        '''
+        Build the report with figure placeholders. See html() and lazy_html().
+        '''
+        if self._html is not None:
+            return self._html
+
+        X, y = self.X, self.y
+
+        html = '<table class="table table-striped">'
+
+        tr = '<tr><th> Metric/Statistic </th><tr>'  # <th> Value </th><th> Details </th>
+        html += tr
+
+        if self.is_pairwise('BER'):
+            html += self._pairwise_html('BER')
+        else:
+            r = self.result('BER', strict=False)
+            if isinstance(r, Exception):
+                print('Exception in GaussianNB.')
+            else:
+                ber, ber_img = r
+                # tr = '<tr><td> BER </td><td>' + str(ber) + '</td><td>' + ber_img + '</td><tr>'
+                tr = '<tr><td> BER' + self._dr_note('BER') + ' = ' + str(ber) + '<br/>' + ber_img + '</td><tr>'
+                html += tr
+
+        svm_margin, svm_margin_img = self.result('SVM')[:2]
+
+        tr = '<tr><td> SVM Margin Width' + self._dr_note('SVM') + ' = ' + \
+            str(svm_margin) + '<br/>' + svm_margin_img + '</td><tr>'
+        html += tr
+
+        if self.is_pairwise('CLF'):
+            html += self._pairwise_html('CLF')
+        else:
+            clf, clf_img, clf_log = self.result('CLF')
+
+            # tr = '<tr><td> ACC </td><td>' + str(acc) + '</td><td>' + acc_img + '<br/><pre>' + acc_log + '</pre></td><tr>'
+            clf_note = 'Classification' + self._dr_note('CLF') + '<br/>' if 'CLF' in self.projected else ''
+            tr = '<tr><td>' + clf_note + str(clf) + '<br/>' + str(clf_img or '') + \
+                '<br/><pre>' + str(clf_log or '') + '</pre></td><tr>'
+            html += tr
+
+        ig, ig_img = self.result('IG')
+
+        tr = '<tr><td> IG = ' + str(ig) + '<br/>' + str(ig_img or '') + '</td><tr>'
+        html += tr
+
+        _, corr_log = self.result('correlate')
+        tr = '<tr><td><pre>' + corr_log + '</pre></td><tr>'
+        html += tr
+
+        if self.is_pairwise('T_IND'):
+            html += self._pairwise_html('T_IND')
+        else:
+            t_p, _, t_img = self.result('T_IND')
+
+            tr = '<tr><td> Independent t-test p' + \
+                str(t_p) + '<br/>' + str(t_img or '') + '</td><tr>'
+            html += tr
+
+        anova_p, _, anova_img = self.result('ANOVA')
+
+        tr = '<tr><td> ANOVA p' + str(anova_p) + '<br/>' + anova_img + '</td><tr>'
+        html += tr
+
+        manova_p, _, manova_log = self.result('MANOVA')
+
+        if manova_log == 'Exception in MANOVA':
+            pass
+        else:
+            tr = '<tr><td> MANOVA' + self._dr_note('MANOVA') + ' p = ' + \
+                str(manova_p) + '<br/><pre>' + manova_log + '</pre></td><tr>'
+            html += tr
+
+        if self.is_pairwise('MWW'):
+            html += self._pairwise_html('MWW')
+        else:
+            mww_p, _, mww_img = self.result('MWW')
+
+            tr = '<tr><td> MWW p = ' + str(mww_p) + '<br/>' + mww_img + '</td><tr>'
+            html += tr
+
+        if self.is_pairwise('KS'):
+            html += self._pairwise_html('KS')
+        else:
+            ks_p, _, ks_img = self.result('KS')
+
+            tr = '<tr><td> K-S p = ' + str(ks_p) + '<br/>' + ks_img + '</td><tr>'
+            html += tr
+
+        chi2s_p, _, chi2s_img = self.result('CHISQ')
+
+        tr = '<tr><td> CHISQ p = ' + \
+            str(chi2s_p) + '<br/>' + chi2s_img + '</td><tr>'
+        html += tr
+
+        m_p, _, m_img = self.result('MedianTest')
+
+        tr = '<tr><td> Median test p = ' + str(m_p) + '<br/>' + m_img + '</td><tr>'
+        html += tr
+
+        kw_p, _ = self.result('KW')
+
+        tr = '<tr><td> Kruskal-Wallis test p = ' + str(kw_p) + '</td><tr>'
+        html += tr
+
+        if self.is_pairwise('cohen_d'):
+            html += self._pairwise_html('cohen_d')
+        else:
+            es, es_img = self.result('cohen_d')
+
+            tr = '<tr><td> ES = ' + str(es) + '<br/>' + es_img + '</td><tr>'
+            html += tr
+
+        if ENABLE_R:
+            r = self.result('ECoL', strict=False)
+            if isinstance(r, Exception):
+                print(r)
+            else:
+                tr = '<tr><td> ECoL metrics' + self._dr_note('ECoL') + \
+                    '<br/><br/><pre>' + r[1] + '</pre></td><tr>'
+                html += tr
+
+        # dataset summary
+        tr = '<tr><th> Dataset Summary </th><tr>'
+        html += tr
+
+        tr = '<tr><td>' + str(len(y)) + ' samples, ' + str(X.shape[1]) + ' features, ' + str(len(set(
+            y))) + ' classes. <br/> X shape: ' + str(X.shape) + ', y shape: ' + str(y.shape) + '</td><tr>'
+        html += tr
+
+        if self.projected:
+            tr = '<tr><td>' + ', '.join(self.projected) + ' ran on X projected to ' + \
+                str(self.X_projected.shape[1]) + ' features by ' + DR_METHODS[self.dr] + \
+                '. The other metrics used the original features.</td><tr>'
+            html += tr
+
+        html += "</table>"
+        # html += '<style> td { text-align:center; vertical-align:middle } </style>'
+
+        self._html = html
+        return html
+
+    def html(self, n_jobs=1):
+        '''
+        Return the HTML report with inline images.
+
+        n_jobs : number of worker processes for rendering the figures.
+        '''
+        html = self._build_html()
+        self.batch.n_jobs = n_jobs
+        with self.recorder, span('render', 'render', figures=len(self.batch)):
+            return self.batch.substitute(html)
+
+    def lazy_html(self, figure_url):
+        '''
+        Return the HTML report with img tags pointing to figure_url.
+        Figures are rendered on request by self.batch.image(idx). With Analysis(lazy=True),
+        they are also drawn on request, from the values the report shows. See get_lazy_html().
+        '''
+        return self.batch.link(self._build_html(), figure_url)
+
+
+def get_metrics(X, y, keys=None, dr=None, n_components=50, options=None, timings=False,
+                memory=False, trace=None):
     '''
     Addionally, we can do a PCA for high-dim data to get X beforehand.   
     We assume the covariance matrix is diagnal, i.e.   
@@ -1677,117 +2841,33 @@ def get_metrics(X, y):
 
     This means x1 and x2 are linearly uncorrelated.   
     If we plot two PCs from PCA，the PCs will also be linearly uncorrelated, because they are the projections on two different orthogonal eigenvectors. 
-    '''
 
-    dic, _, _ = CLF(X, y)
-    if dic is None:
-        dic = {}
+    Use Analysis(X, y) instead if you also need the HTML report or JSON of the same data.
 
-    ber = 1  # set maximum BER
-    try:
-        ber, _ = BER(X, y)
-    except Exception as e:
-        print('Exception in GaussianNB.', e)
-    dic['classification.BER'] = ber
-
-    svm_width, _ = SVM_Margin_Width(X, y)
-    dic['classification.SVM.Margin'] = svm_width
-
-    ig, _ = IG(X, y)
-    if ig is not None:
-        dic['correlation.IG'] = ig
-        dic['correlation.IG.max'] = ig.max()
-
-    dic_cor, _ = correlate(X, y)
-    dic.update(dic_cor)
-
-    es, _ = cohen_d(X, y)
-    dic['test.ES'] = es
-    dic['test.ES.max'] = es.max()
-
-    p, T, _ = T_IND(X, y)
-    dic['test.student'] = p
-    dic['test.student.min'] = np.min(p)
-    dic['test.student.min.log10'] = np.log10(np.min(p))
-    dic['test.student.T'] = T
-    dic['test.student.T.max'] = np.max(T)
-
-    p, F, _ = ANOVA(X, y)
-    dic['test.ANOVA'] = p
-    dic['test.ANOVA.min'] = np.min(p)
-    dic['test.ANOVA.min.log10'] = np.log10(np.min(p))
-    dic['test.ANOVA.F'] = F
-    dic['test.ANOVA.F.max'] = np.max(F)
-
-    p, F, log = MANOVA(X, y)
-    if log == 'Exception in MANOVA':
-        pass
-    else:
-        dic['test.MANOVA'] = p
-        dic['test.MANOVA.log10'] = np.log10(p)
-        dic['test.MANOVA.F'] = F
-
-    p, U, _ = MWW(X, y)
-    dic['test.MWW'] = p
-    dic['test.MWW.min'] = np.min(p)
-    dic['test.MWW.min.log10'] = np.log10(np.min(p))
-    dic['test.MWW.U'] = U
-    dic['test.MWW.U.min'] = np.min(U)
-
-    p, D, _ = KS(X, y)
-    dic['test.KS'] = p
-    dic['test.KS.min'] = np.min(p)
-    dic['test.KS.min.log10'] = np.log10(np.min(p))
-    dic['test.KS.D'] = D
-    dic['test.KS.D.max'] = np.max(D)
-
-    p, C, _ = CHISQ(X, y)
-    dic['test.CHISQ'] = p
-    dic['test.CHISQ.min'] = np.min(p)
-    dic['test.CHISQ.min.log10'] = np.log10(np.min(p))
-    dic['test.CHISQ.CHI2'] = C
-    dic['test.CHISQ.CHI2.max'] = np.max(C)
-
-    # H follows chi2, its critical value of chi2(k-1) at 0.5
-    H = [scipy.stats.chi2.ppf(.5, len(set(y))-1)] * X.shape[1]
-    p = [.5] * X.shape[1]
-    try:
-        p, H = KW(X, y)
-    except Exception as e:
-        print('KW Exception: ', e)
-    dic['test.KW'] = p
-    dic['test.KW.min'] = np.min(p)
-    dic['test.KW.min.log10'] = np.log10(np.min(p))
-    dic['test.KW.H'] = H
-    dic['test.KW.H.max'] = np.max(H)
-
-    # T follows chi2, its critical value of chi2(k-1) at 0.5
-    T = [scipy.stats.chi2.ppf(.5, len(set(y))-1)] * X.shape[1]
-    p = [.5] * X.shape[1]
-    try:
-        p, T, _ = MedianTest(X, y)
-    except Exception as e:
-        print('MedianTest Exception: ', e)
-    dic['test.Median'] = p
-    dic['test.Median.min'] = np.min(p)
-    dic['test.Median.min.log10'] = np.log10(np.min(p))
-    dic['test.Median.CHI2'] = T
-    dic['test.Median.CHI2.max'] = np.max(T)
-
-    if ENABLE_R:
-        try:
-            dic_ecol, _ = ECoL_metrics(X, y)
-            dic.update(dic_ecol)
-        except Exception as e:
-            print(e)
+    Parameters
+    ----------
+    keys : only compute the metric families needed for these keys. Default is all.
+    dr : optional dimensionality-reduction pre-stage for wide data, 'pca', 'svd' or 'srp'.
+        CLF, BER, SVM, MANOVA and ECoL then run on X projected to n_components features,
+        and dic['meta.projected'] lists them. See project().
+    n_components : target dimension of dr
+    options : keyword arguments of the metric functions, per family. See Analysis.
+        e.g., {'IG': {'method': 'quantile'}} for the fast binned information gain.
+    timings : if True, dic['meta.timings'] holds the wall time and CPU time of each metric
+        family (and of the R conversion and computation of ECoL).
+        See instrument.Recorder.timings().
+    memory : also record the peak allocation of each family. Slows down the computation.
+    trace : a file path to save the timings as a Chrome trace (chrome://tracing or Perfetto)
+    '''
 
-    dic_s = {}
+    a = Analysis(X, y, figures=False, dr=dr, n_components=n_components, options=options,
+                 trace_memory=memory)
+    dic, dic_s = a.metrics(keys)
 
-    for k, v in dic.items():
-        if hasattr(v, "__len__"):  # this is an np array or list
-            dic[k] = list(v)
-        else:  # this only contains single-value metrics
-            dic_s[k] = v
+    if timings:
+        dic['meta.timings'] = a.timings
+    if trace:
+        a.recorder.save_trace(trace)
 
     return dic, dic_s
 
@@ -1882,184 +2962,304 @@ metric_polarity_dict = {
 
 
 def get_json(X, y):
-    return json.dumps(get_metrics(X, y))
+    return Analysis(X, y, figures=False).json()
 
 
-def get_html(X, y):
+def get_html(X, y, fmt=None, dpi=None, n_jobs=1, dr=None, n_components=50):
     '''
     Generate a summary report in HTML format
-    '''
-    html = '<table class="table table-striped">'
-
-    tr = '<tr><th> Metric/Statistic </th><tr>'  # <th> Value </th><th> Details </th>
-    html += tr
-
-    try:
-        ber, ber_img = BER(X, y, show=False)
-
-        # tr = '<tr><td> BER </td><td>' + str(ber) + '</td><td>' + ber_img + '</td><tr>'
-        tr = '<tr><td> BER = ' + str(ber) + '<br/>' + ber_img + '</td><tr>'
-        html += tr
-    except:
-        print('Exception in GaussianNB.')
-
-    svm_margin, svm_margin_img = SVM_Margin_Width(X, y, show=False)
 
-    tr = '<tr><td> SVM Margin Width = ' + \
-        str(svm_margin) + '<br/>' + svm_margin_img + '</td><tr>'
-    html += tr
+    Parameters
+    ----------
+    fmt : image format of the figures, 'png', 'svg' or 'webp'. Default is render.FIGURE_FORMAT.
+    dpi : image dpi. Default is render.FIGURE_DPI.
+    n_jobs : number of worker processes for rendering the figures.
+    dr, n_components : optional dimensionality-reduction pre-stage. See get_metrics().
+    '''
 
-    clf, clf_img, clf_log = CLF(X, y, show=False)
+    return Analysis(X, y, fmt=fmt, dpi=dpi, dr=dr, n_components=n_components).html(n_jobs=n_jobs)
 
-    # tr = '<tr><td> ACC </td><td>' + str(acc) + '</td><td>' + acc_img + '<br/><pre>' + acc_log + '</pre></td><tr>'
-    tr = '<tr><td>' + str(clf) + '<br/>' + clf_img + \
-        '<br/><pre>' + clf_log + '</pre></td><tr>'
-    html += tr
 
-    ig, ig_img = IG(X, y, show=False)
+def get_lazy_html(X, y, figure_url, fmt=None, dpi=None):
+    '''
+    Generate a progressive HTML report.
 
-    tr = '<tr><td> IG = ' + str(ig) + '<br/>' + ig_img + '</td><tr>'
-    html += tr
+    The numbers are returned right away. Each figure is an img tag pointing to figure_url,
+    and is only drawn and rendered when the browser requests it, by calling batch.image(idx).
+    The figure is drawn from the values computed for the report, so nothing is recomputed.
 
-    _, corr_log = correlate(X, y, verbose=False)
-    tr = '<tr><td><pre>' + corr_log + '</pre></td><tr>'
-    html += tr
+    Parameters
+    ----------
+    figure_url : a format string that takes the figure index, e.g., '/figure/<report_id>/{}'
 
-    t_p, _, t_img = T_IND(X, y)
+    Return
+    ------
+    html : the report
+    batch : the FigureBatch that holds the undrawn figures. Keep it to serve figure_url.
+    '''
 
-    tr = '<tr><td> Independent t-test p' + \
-        str(t_p) + '<br/>' + t_img + '</td><tr>'
-    html += tr
+    a = Analysis(X, y, fmt=fmt, dpi=dpi, lazy=True)
+    return a.lazy_html(figure_url), a.batch
 
-    anova_p, _, anova_img = ANOVA(X, y)
 
-    tr = '<tr><td> ANOVA p' + str(anova_p) + '<br/>' + anova_img + '</td><tr>'
-    html += tr
+def task_seed(seed, md, i):
+    '''
+    Child seed of the (md, repeat i) task of a sweep.
 
-    manova_p, _, manova_log = MANOVA(X, y)
+    The child is keyed by the exact value of md rather than its position in mds, so a task
+    gets the same stream in any grid, order or worker count, and its result can be cached by
+    (seed, md, i).
 
-    if manova_log == 'Exception in MANOVA':
-        pass
-    else:
-        tr = '<tr><td> MANOVA p = ' + \
-            str(manova_p) + '<br/><pre>' + manova_log + '</pre></td><tr>'
-        html += tr
+    Parameters
+    ----------
+    seed : int or SeedSequence of the whole sweep
+    '''
+    root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    md_key = int(np.float64(md).view(np.uint64))
+    return np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + (md_key, i))
 
-    mww_p, _, mww_img = MWW(X, y)
 
-    tr = '<tr><td> MWW p = ' + str(mww_p) + '<br/>' + mww_img + '</td><tr>'
-    html += tr
+def _sweep_task(generator, md, seed, options, kwargs, families=None):
+    '''
+    Draw one dataset and compute its single-value metrics.
+    Top-level function so that it can be pickled to worker processes.
 
-    ks_p, _, ks_img = KS(X, y)
+    seed : None (the global np.random state) or the task's SeedSequence. The dataset, BER's
+        Monte Carlo samples and IG's noise then all come from the task's own Generator.
+    families : only compute these metric families. Default is all.
+    '''
+    rng = None if seed is None else np.random.default_rng(seed)
+    X, y = generator(md=md, rng=rng, **kwargs)
 
-    tr = '<tr><td> K-S p = ' + str(ks_p) + '<br/>' + ks_img + '</td><tr>'
-    html += tr
+    options = dict(options or {})
+    if rng is not None:
+        options['BER'] = dict(options.get('BER', {}), rng=rng)
+        options['IG'] = dict(options.get('IG', {}), random_state=int(rng.integers(2 ** 31)))
 
-    chi2s_p, _, chi2s_img = CHISQ(X, y)
+    keys = None
+    if families is not None:  # one key prefix per family selects exactly that family
+        keys = [prefix for prefix, family in KEY_FAMILIES if family in families]
 
-    tr = '<tr><td> CHISQ p = ' + \
-        str(chi2s_p) + '<br/>' + chi2s_img + '</td><tr>'
-    html += tr
+    a = Analysis(X, y, figures=False, options=options)
+    _, dic_s = a.metrics(keys)
+    return dic_s, a.timings
 
-    m_p, _, m_img = MedianTest(X, y)
 
-    tr = '<tr><td> Median test p = ' + str(m_p) + '<br/>' + m_img + '</td><tr>'
-    html += tr
+def se_targets(target_se, keys):
+    '''
+    Target standard error of each key, np.inf for the keys that are not checked.
 
-    kw_p, _ = KW(X, y)
+    Parameters
+    ----------
+    target_se : a float for all keys, or a dict of key -> target for only those keys
+    '''
+    if isinstance(target_se, dict):
+        return np.array([target_se.get(k, np.inf) for k in keys], dtype=float)
+    return np.full(len(keys), float(target_se))
 
-    tr = '<tr><td> Kruskal-Wallis test p = ' + str(kw_p) + '</td><tr>'
-    html += tr
 
-    es, es_img = cohen_d(X, y)
+def sweep_metrics(generator, mds, repeat=1, seed=None, n_jobs=None, clf_cache=None,
+                  progress=True, desc='sweep', store=None, target_se=None, min_repeat=3,
+                  families=None, **kwargs):
+    '''
+    Draw repeat datasets by generator(md=md, rng=rng, **kwargs) for each md, and average
+    their single-value metrics per md (a trimmed mean if repeat > 10).
+    This is the loop of simulate() and unify.calculate_atom_metrics().
 
-    tr = '<tr><td> ES = ' + str(es) + '<br/>' + es_img + '</td><tr>'
-    html += tr
+    Parameters
+    ----------
+    seed : None uses the global np.random state, in order. An int or SeedSequence gives each
+        (md, repeat) task an independent child stream (see task_seed()), so the result is
+        bit-identical at any n_jobs.
+    n_jobs : number of tasks computed concurrently, as in joblib.Parallel
+    clf_cache : see simulate(). It carries state from task to task, so it requires n_jobs=1.
+    progress : see cla.progress
+    store : a cla.store.SimulationStore that keeps the result of every (md, repeat) task.
+        Tasks already in the store are not computed again, so a sweep can be extended by
+        more mds or repeats. The store must come from a sweep with the same generator,
+        seed and kwargs.
+    target_se : sequential stopping. None runs exactly repeat datasets per md. Otherwise each
+        md starts with min_repeat datasets and gets more, in rounds of half its current count,
+        until the standard error of the (trimmed) mean of every checked key is at most its
+        target (see se_targets()), or repeat datasets are reached. Keys that are nan have
+        no standard error and do not hold a md back. store.repeats() tells how many
+        datasets each md got.
+    min_repeat : see target_se
+    families : only compute these metric families (keys of METRIC_FAMILIES), e.g., the
+        families that have no analytic expectation. Default is all.
+
+    Return
+    ------
+    A dict of metric key -> array over mds, and 'd' -> mds
+    '''
+    if store is None:
+        store = SimulationStore()
+    meta = dict(generator=generator.__name__, seed=seed, params=joblib.hash(kwargs))
+    if families is not None:
+        meta['families'] = sorted(families)
+    store.check(**meta)
+
+    if clf_cache is not None and n_jobs not in (None, 1):
+        print('clf_cache is sequential. Running with n_jobs=1.')
+        n_jobs = 1
+
+    mds = list(mds)
+    counts = np.full(len(mds), repeat if target_se is None else min(min_repeat, repeat))
+    tracker = None
+
+    while True:
+        tasks = [(md, i) for md, r in zip(mds, counts) for i in range(r) if not store.has(md, i)]
+        seeds = [None if seed is None else task_seed(seed, md, i) for md, i in tasks]
+        if tracker is None:
+            tracker = Tracker(len(tasks), progress, desc=desc)
+        else:
+            tracker.total += len(tasks)  # a later round of sequential stopping
+
+        if n_jobs in (None, 1):
+            for (md, i), ss in zip(tasks, seeds):
+                tracker.started(md=md, repeat=i)
+                options = {'CLF': {'cache': clf_cache, 'md': md}} if clf_cache is not None else None
+                dic_s, timings = _sweep_task(generator, md, ss, options, kwargs, families)
+                store.add(md, i, dic_s)
+                tracker.finished(timings=timings, md=md, repeat=i)
+        elif tasks:
+            def submit():
+                for (md, i), ss in zip(tasks, seeds):
+                    tracker.started(md=md, repeat=i)  # queued, a worker may pick it up later
+                    yield joblib.delayed(_sweep_task)(generator, md, ss, None, kwargs, families)
+
+            # pre_dispatch='all' submits every task now, so all task_started events are
+            # emitted in this thread rather than by joblib's dispatch thread
+            outputs = joblib.Parallel(n_jobs=n_jobs, return_as='generator', pre_dispatch='all')(
+                submit())
+            for (md, i), (dic_s, timings) in zip(tasks, outputs):
+                store.add(md, i, dic_s)
+                tracker.finished(timings=timings, md=md, repeat=i)
+
+        if target_se is None:
+            break
+
+        sem = store.aggregate(mds, counts, stat='trimmed_sem')
+        keys = [k for k in sem if k != 'd']
+        targets = se_targets(target_se, keys)
+        short = counts < 2  # no standard error yet
+        for k, t in zip(keys, targets):
+            short |= sem[k] > t  # nan > t is False
+        grow = short & (counts < repeat)
+        if not grow.any():
+            break
+        counts[grow] = np.minimum(counts[grow] + np.maximum(counts[grow] // 2, 1), repeat)
+
+    tracker.close()
+
+    return store.aggregate(mds, counts)
+
+
+def _refinement_scores(dic, sem, keys):
+    '''
+    Score each interval of the md grid by how much of the curves' range changes across it,
+    i.e., the mean over keys of |change| / curve range. The part of a change that is within
+    its standard error does not count, so noisy flat regions are not refined forever.
+    '''
+    scores = []
+    for k in keys:
+        f = np.asarray(dic[k], dtype=float)
+        span = np.nanmax(f) - np.nanmin(f)
+        if not np.isfinite(span) or span == 0:
+            continue
+        se = np.nan_to_num(np.asarray(sem[k], dtype=float))
+        noise = np.sqrt(se[:-1] ** 2 + se[1:] ** 2)
+        scores.append(np.maximum(np.abs(np.diff(f)) - noise, 0) / span)
+
+    if not scores:
+        return np.zeros(len(dic['d']) - 1)
+    return np.nan_to_num(np.mean(scores, axis=0))
+
+
+def adaptive_sweep(generator, mds, repeat=1, keys=None, tol=0.05, budget=None, min_step=None,
+                   per_round=2, store=None, desc='adaptive sweep', **kwargs):
+    '''
+    A sweep_metrics() that starts from a coarse md grid and inserts midpoints where the metric
+    curves change fastest, until every interval holds less than tol of the curves' range, or
+    the budget is spent. Changes within the repeats' standard error do not count, so flat
+    (or only noisy) regions keep the coarse spacing.
 
-    if ENABLE_R:
+    Parameters
+    ----------
+    mds : the initial grid. The refined grid stays within its range.
+    keys : metric keys that drive the refinement. Default is all.
+    tol : interval score below which an interval is not split. See _refinement_scores().
+    budget : maximum number of datasets (i.e., get_metrics() calls) of the final grid,
+        len(mds) * repeat. Default is no limit.
+    min_step : intervals narrower than this are not split. Default is 1/64 of the range.
+    per_round : number of midpoints inserted per round
+    store : a cla.store.SimulationStore. Default is a new one. See sweep_metrics().
+    kwargs : seed, n_jobs, clf_cache, progress and the generator's parameters,
+        as in sweep_metrics()
+
+    Return
+    ------
+    A dict of metric key -> array over the refined grid, and 'd' -> the refined grid
+    '''
+    if store is None:
+        store = SimulationStore()
 
-        try:
-            _, ecol = ECoL_metrics(X, y)
-            tr = '<tr><td> ECoL metrics' + '<br/><br/><pre>' + ecol + '</pre></td><tr>'
-            html += tr
-        except Exception as e:
-            print(e)
+    mds = sorted(set(float(md) for md in mds))
+    if min_step is None:
+        min_step = (mds[-1] - mds[0]) / 64
 
-    # dataset summary
-    tr = '<tr><th> Dataset Summary </th><tr>'
-    html += tr
+    while True:
+        dic = sweep_metrics(generator, mds, repeat, store=store, desc=desc, **kwargs)
+        # with sequential stopping (target_se in kwargs), mds got different numbers of repeats
+        sem = store.aggregate(mds, np.minimum(store.repeats(mds), repeat), stat='sem')
 
-    tr = '<tr><td>' + str(len(y)) + ' samples, ' + str(X.shape[1]) + ' features, ' + str(len(set(
-        y))) + ' classes. <br/> X shape: ' + str(X.shape) + ', y shape: ' + str(y.shape) + '</td><tr>'
-    html += tr
+        scores = _refinement_scores(dic, sem, keys or [k for k in dic if k != 'd'])
+        candidates = [j for j in np.argsort(-scores, kind='stable')
+                      if scores[j] > tol and mds[j + 1] - mds[j] > min_step]
 
-    html += "</table>"
-    # html += '<style> td { text-align:center; vertical-align:middle } </style>'
+        n_new = per_round
+        if budget is not None:
+            n_new = min(n_new, (budget - len(mds) * repeat) // repeat)
+        if not candidates or n_new <= 0:
+            return dic
 
-    return html
+        mds = sorted(mds + [(mds[j] + mds[j + 1]) / 2 for j in candidates[:n_new]])
 
 
-def simulate(mds, repeat=1, nobs=100, dims=2):
+def simulate(mds, repeat=1, nobs=100, dims=2, clf_cache=None, progress=True, seed=None,
+             n_jobs=None, store=None, target_se=None, min_repeat=3, analytic=False):
     '''
     Try different mds (between-group distances)
 
     Parameters
     ----------
     mds : an array. between-classes mean distances    
+    clf_cache : a CLFCache to reuse CLF's regularization strength across repeats and
+        neighboring mds. Default is None, i.e., a full CV search for every dataset.
+    progress : True for a tqdm bar, False, or progress callbacks that also receive
+        the per-family timings of each dataset. See cla.progress.
+    seed : None uses the global np.random state. An int or SeedSequence makes the result
+        reproducible and independent of n_jobs. See sweep_metrics().
+    n_jobs : number of datasets computed concurrently
+    store : a cla.store.SimulationStore to keep the per-repeat values in, and to extend
+        a previous sweep from. See sweep_metrics().
+    target_se : run repeats per md only until the standard error of the averaged metrics
+        reaches this target (a float, or a dict of key -> target), with at least min_repeat
+        and at most repeat datasets. See sweep_metrics().
+    analytic : use the closed-form expectations of cla.expected for the t test, ANOVA,
+        MANOVA, Cohen's d and Pearson r keys, and only simulate the other metric families
     '''
 
-    dic = {}
-
-    # splits (divide 1 std into how many sections) * repeat
-    pbar = tqdm(total=len(mds) * repeat, position=0)
-
-    # only do visualization when repeat == 1 and draw == True
-    #detailed = (repeat == 1 and draw == True)
-
-    for md in mds:
-
-        raw_dic = {}
-
-        for i in range(repeat):
-            X, y = mvg(
-                # mu = mu, # mean, row vector
-                # s = s, # std, row vector
-                nobs=nobs,  # number of observations / samples
-                # distance between means, respect to std, i.e. (mu2 - mu1) / std, or how many stds is the difference.
-                md=md,
-                dims=dims
-            )
-
-            # if detailed:
-            #    print('d = ', round(md,3))
-
-            _, dic1 = get_metrics(X, y)
-            for k, v in dic1.items():
-                if k in raw_dic:
-                    raw_dic[k].append(v)  # dic[k] = dic[k] + v
-                else:
-                    raw_dic[k] = [v]  # v
-
-            pbar.update()
-            ## End of inner iteration ##
-
-        for k, v in raw_dic.items():
-
-            trim_size = int(repeat / 10)
-
-            if (repeat > 10):  # remove the max and min
-                raw_dic[k] = np.mean(sorted(v)[trim_size:-trim_size])
-            else:
-                raw_dic[k] = np.mean(v)
-
-        ## End of outer iteration ##
-
-        for k, v in raw_dic.items():
-            if k in dic:
-                dic[k] = np.append(dic[k], v)
-            else:
-                dic[k] = np.array([v])
+    expected, families = {}, None
+    if analytic:
+        expected = expected_metrics(mds, nobs, mvg_effects(dims))
+        families = [f for f in METRIC_FAMILIES if f not in covered_families(expected)]
 
+    dic = sweep_metrics(mvg, mds, repeat, seed=seed, n_jobs=n_jobs, clf_cache=clf_cache,
+                        progress=progress, desc='simulate', store=store,
+                        target_se=target_se, min_repeat=min_repeat, families=families,
+                        nobs=nobs, dims=dims)
+    dic.update(expected)
     dic['d'] = np.array(mds)
 
     return dic
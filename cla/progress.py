@@ -0,0 +1,187 @@
+'''
+Progress and event callbacks of long-running loops, i.e., simulate(),
+unify.calculate_atom_metrics() and batch.analyze_batch().
+
+A callback is any callable that takes one event dict:
+
+type : 'start', 'task_started', 'task_finished' or 'end'. In parallel runs, 'task_started'
+    is emitted when a task is submitted to the workers, so many tasks may be started at once.
+desc : name of the loop, e.g., 'simulate'
+total, done, failed : task counts. total can grow, e.g., with sequential stopping.
+elapsed : seconds since start
+eta : estimated seconds to finish, None before the first finished task
+task : a dict describing the task, e.g., {'md': 0.5, 'repeat': 2}
+task_failed : on 'task_finished', whether this task failed
+timings : on 'task_finished', the per-family timings of the task if available.
+    See instrument.Recorder.timings().
+
+The progress parameter of the loops accepts True (a tqdm bar, the default), False or None
+(silent), a callback, or a list of callbacks.
+
+Example
+-------
+from cla import progress
+
+# log instead of a progress bar
+dic = metrics.simulate(mds, repeat=10, progress=progress.logging_callback())
+
+# forward the events to a job queue, e.g., for a GUI or a service
+q = queue.Queue()
+dic = metrics.simulate(mds, repeat=10, progress=progress.queue_callback(q))
+
+# aggregate the progress of worker processes in one shared counter
+counter = multiprocessing.Value('i', 0)
+... metrics.simulate(mds, progress=progress.counter_callback(counter)) in each worker ...
+'''
+
+import time
+import logging
+
+from tqdm import tqdm
+
+
+def tqdm_callback(**kwargs):
+    '''
+    A callback that shows a tqdm bar. kwargs are passed to tqdm, e.g., file or leave.
+    '''
+    state = {}
+
+    def callback(event):
+        if event['type'] == 'start':
+            state['bar'] = tqdm(total=event['total'], desc=event['desc'] or None,
+                                position=0, **kwargs)
+        elif event['type'] == 'task_finished':
+            bar = state['bar']
+            if bar.total != event['total']:  # more tasks were added
+                bar.total = event['total']
+            if event['failed']:
+                bar.set_postfix(failed=event['failed'])
+            bar.update()
+        elif event['type'] == 'end':
+            state.pop('bar').close()
+
+    return callback
+
+
+def logging_callback(logger=None, level=logging.INFO, every=1):
+    '''
+    A callback that logs every `every` finished tasks and the end of the loop
+    '''
+    logger = logger or logging.getLogger('cla')
+
+    def callback(event):
+        if event['type'] == 'task_finished' and (event['done'] % every == 0 or
+                                                 event['done'] == event['total']):
+            eta = event['eta']
+            logger.log(level, '%s %d/%d (%d failed), %.1fs elapsed, ETA %s',
+                       event['desc'], event['done'], event['total'], event['failed'],
+                       event['elapsed'], '-' if eta is None else '%.1fs' % eta)
+        elif event['type'] == 'end':
+            logger.log(level, '%s finished %d/%d tasks (%d failed) in %.1fs', event['desc'],
+                       event['done'], event['total'], event['failed'], event['elapsed'])
+
+    return callback
+
+
+def queue_callback(q, types=None):
+    '''
+    A callback that puts the events into a queue.Queue or multiprocessing.Queue
+
+    Parameters
+    ----------
+    types : event types to forward. Default is all.
+    '''
+    def callback(event):
+        if types is None or event['type'] in types:
+            q.put(event)
+
+    return callback
+
+
+def counter_callback(counter, failed_counter=None):
+    '''
+    A callback that increments a shared counter (e.g., multiprocessing.Value('i')) for each
+    finished task, so that a parent process can follow workers running separate loops
+    '''
+    def callback(event):
+        if event['type'] != 'task_finished':
+            return
+        with counter.get_lock():
+            counter.value += 1
+        if failed_counter is not None and event['task_failed']:
+            with failed_counter.get_lock():
+                failed_counter.value += 1
+
+    return callback
+
+
+def callbacks(progress):
+    '''
+    Normalize the progress parameter of the loops into a list of callbacks
+    '''
+    if progress is True:
+        return [tqdm_callback()]
+    if progress is None or progress is False:
+        return []
+    if callable(progress):
+        return [progress]
+    return list(progress)
+
+
+class Tracker:
+    '''
+    Count the tasks of a loop and send the events to the callbacks.
+
+    Example
+    -------
+    with Tracker(len(mds) * repeat, progress, desc='simulate') as tracker:
+        for md in mds:
+            tracker.started(md=md)
+            ...
+            tracker.finished(timings=a.timings, md=md)
+    '''
+
+    def __init__(self, total, progress=True, desc=''):
+        self.total = total
+        self.desc = desc
+        self.callbacks = callbacks(progress)
+        self.done = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+        self._emit('start')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _emit(self, type, task=None, **fields):
+        if not self.callbacks:
+            return
+
+        elapsed = time.perf_counter() - self.start
+        eta = elapsed / self.done * (self.total - self.done) if self.done else None
+        event = {'type': type, 'desc': self.desc, 'total': self.total, 'done': self.done,
+                 'failed': self.failed, 'elapsed': elapsed, 'eta': eta, 'task': task or {}}
+        event.update(fields)
+
+        for callback in self.callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                print('Exception in progress callback.', e)
+
+    def started(self, **task):
+        self._emit('task_started', task)
+
+    def finished(self, timings=None, failed=False, **task):
+        self.done += 1
+        self.failed += bool(failed)
+        self._emit('task_finished', task, timings=timings, task_failed=bool(failed))
+
+    def close(self):
+        if self.callbacks:
+            self._emit('end')
+            self.callbacks = []
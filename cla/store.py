@@ -0,0 +1,256 @@
+'''
+Raw per-repeat results of simulation sweeps.
+
+simulate() and unify.calculate_atom_metrics() only return the per-md averages. Passing a
+SimulationStore keeps every single-value metric of every (md, repeat) dataset in an
+md x repeat x metric cube instead. A later sweep with the same store only computes the
+(md, repeat) tasks it does not have yet, e.g., a finer md grid or more repeats, and the
+averages are re-aggregated from the cube.
+
+Example
+-------
+from cla import metrics
+from cla.store import SimulationStore
+
+store = SimulationStore()
+dic = metrics.simulate(np.linspace(0, 2, 5), repeat=5, seed=0, store=store)
+dic = metrics.simulate(np.linspace(0, 2, 9), repeat=10, seed=0, store=store)  # only the new tasks
+store.save('sim.npz')
+
+store = SimulationStore.load('sim.npz')
+dic = store.aggregate(stat='median')
+'''
+
+import os
+import json
+
+import numpy as np
+
+AGGREGATES = ['trimmed', 'mean', 'median', 'sem', 'trimmed_sem']
+
+
+def _trim(r):
+    '''
+    Number of values cut at each end by the trimmed mean of r repeats
+    '''
+    return int(r / 10) if r > 10 else 0
+
+
+def trimmed_mean(V):
+    '''
+    Mean over axis 0 without the int(r / 10) lowest and highest values when there are
+    more than 10 rows, as simulate() does
+    '''
+    r = len(V)
+    g = _trim(r)
+    if g == 0:
+        return V.mean(axis=0)
+    return np.sort(V, axis=0)[g:r - g].mean(axis=0)
+
+
+def trimmed_sem(V):
+    '''
+    Standard error of trimmed_mean() over axis 0, from the winsorized variance
+    (Tukey and McLaughlin). Without trimming this is the usual standard error of the mean.
+    nan with fewer than 2 rows.
+    '''
+    r = len(V)
+    if r < 2:
+        return np.full(V.shape[1:], np.nan)
+    g = _trim(r)
+    W = np.sort(V, axis=0)
+    W[:g] = W[g]
+    W[r - g:] = W[r - g - 1]
+    return W.std(axis=0, ddof=1) / ((1 - 2 * g / r) * np.sqrt(r))
+
+
+class SimulationStore:
+    '''
+    An md x repeat x metric cube of single-value metrics.
+
+    Attributes
+    ----------
+    mds : md of each row, in insertion order
+    keys : metric key of each column of the last axis
+    values : the cube. Missing entries are nan.
+    filled : md x repeat boolean mask of the computed tasks
+    meta : parameters of the sweep that filled the store, checked by sweeps that extend it
+    '''
+
+    def __init__(self):
+        self.mds = []
+        self.keys = []
+        self.values = np.full((0, 0, 0), np.nan)
+        self.filled = np.zeros((0, 0), dtype=bool)
+        self.meta = {}
+        self._rows = {}
+        self._cols = {}
+
+    def __len__(self):
+        '''
+        Number of stored (md, repeat) results
+        '''
+        return int(self.filled.sum())
+
+    def _grow(self, rows, repeats, cols):
+        M, R, K = self.values.shape
+        if rows <= M and repeats <= R and cols <= K:
+            return
+        shape = (max(rows, M), max(repeats, R), max(cols, K))
+        values = np.full(shape, np.nan)
+        values[:M, :R, :K] = self.values
+        filled = np.zeros(shape[:2], dtype=bool)
+        filled[:M, :R] = self.filled
+        self.values, self.filled = values, filled
+
+    def _row(self, md):
+        md = float(md)
+        if md not in self._rows:
+            self._rows[md] = len(self.mds)
+            self.mds.append(md)
+        return self._rows[md]
+
+    def has(self, md, i):
+        '''
+        Whether the result of repeat i at md is stored
+        '''
+        row = self._rows.get(float(md))
+        return row is not None and i < self.filled.shape[1] and bool(self.filled[row, i])
+
+    def add(self, md, i, dic_s):
+        '''
+        Store the single-value metrics of repeat i at md
+        '''
+        for k in dic_s:
+            if k not in self._cols:
+                self._cols[k] = len(self.keys)
+                self.keys.append(k)
+
+        row = self._row(md)
+        self._grow(len(self.mds), i + 1, len(self.keys))
+        if not self.values.flags.writeable:  # memory-mapped read-only
+            self.values = np.array(self.values)
+
+        for k, v in dic_s.items():
+            try:
+                self.values[row, i, self._cols[k]] = np.nan if v is None else float(v)
+            except (TypeError, ValueError):
+                pass  # not a number
+        self.filled[row, i] = True
+
+    def repeats(self, mds=None):
+        '''
+        Number of stored repeats of each md (default all stored mds, sorted)
+        '''
+        mds = sorted(self.mds) if mds is None else [float(md) for md in mds]
+        return np.array([self.filled[self._rows[md]].sum() if md in self._rows else 0
+                         for md in mds], dtype=int)
+
+    def check(self, **meta):
+        '''
+        Record the parameters of the sweep on first use. Later sweeps must match them,
+        otherwise their results would not be comparable.
+        '''
+        meta = {k: str(v) for k, v in meta.items()}
+        if not self.meta:
+            self.meta = meta
+        elif self.meta != meta:
+            raise Exception('The store was filled by a sweep with different parameters: ' +
+                            str(self.meta) + ' vs ' + str(meta))
+
+    def aggregate(self, mds=None, repeats=None, stat='trimmed'):
+        '''
+        Average the stored metrics per md.
+
+        Parameters
+        ----------
+        mds : the mds to include, in this order. Default is all stored mds, sorted.
+        repeats : only use the first this many repeats. An int, or one int per md.
+            Default is all stored.
+        stat : 'trimmed' - see trimmed_mean()
+            'mean' or 'median'
+            'sem' - standard error of the mean, nan with fewer than 2 repeats
+            'trimmed_sem' - standard error of 'trimmed', see trimmed_sem()
+
+        Return
+        ------
+        A dict of metric key -> array over mds, and 'd' -> the mds
+        '''
+        if stat not in AGGREGATES:
+            raise Exception('Unsupported aggregate ' + str(stat))
+
+        mds = sorted(self.mds) if mds is None else [float(md) for md in mds]
+        if repeats is None:
+            repeats = self.filled.shape[1]
+        R = np.broadcast_to(repeats, (len(mds),))
+
+        out = np.full((len(mds), len(self.keys)), np.nan)
+        for j, md in enumerate(mds):
+            row = self._rows.get(md)
+            if row is None:
+                continue
+            V = self.values[row, :R[j]][self.filled[row, :R[j]]]  # r x K
+            r = len(V)
+            if r == 0:
+                continue
+
+            if stat == 'median':
+                out[j] = np.median(V, axis=0)
+            elif stat == 'sem':
+                if r > 1:
+                    out[j] = V.std(axis=0, ddof=1) / np.sqrt(r)
+            elif stat == 'trimmed_sem':
+                out[j] = trimmed_sem(V)
+            elif stat == 'trimmed':
+                out[j] = trimmed_mean(V)
+            else:
+                out[j] = V.mean(axis=0)
+
+        dic = {k: out[:, c] for c, k in enumerate(self.keys)}
+        dic['d'] = np.array(mds)
+        return dic
+
+    def save(self, path):
+        '''
+        Save to an .npz file, or to a directory of .npy files that load() can memory-map
+        '''
+        arrays = {'mds': np.array(self.mds), 'values': self.values, 'filled': self.filled}
+        header = json.dumps({'keys': self.keys, 'meta': self.meta})
+
+        if path.endswith('.npz'):
+            np.savez(path, header=np.array(header), **arrays)
+            return
+
+        os.makedirs(path, exist_ok=True)
+        for name, a in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), a)
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            f.write(header)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        '''
+        Load a store saved by save().
+
+        mmap_mode : e.g., 'r' to memory-map the cube of a directory store instead of reading it.
+            The cube is copied into memory when the store is extended.
+        '''
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                header = json.loads(str(data['header']))
+                mds, values, filled = data['mds'], data['values'], data['filled']
+        else:
+            with open(os.path.join(path, 'header.json')) as f:
+                header = json.load(f)
+            mds, values, filled = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+                                   for name in ('mds', 'values', 'filled')]
+
+        store = cls()
+        store.mds = [float(md) for md in mds]
+        store.keys = list(header['keys'])
+        store.values = values
+        store.filled = np.array(filled, dtype=bool)
+        store.meta = header['meta']
+        store._rows = {md: i for i, md in enumerate(store.mds)}
+        store._cols = {k: i for i, k in enumerate(store.keys)}
+        return store
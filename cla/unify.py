@@ -4,22 +4,33 @@ A unified classifiability analysis framework based on meta-learner and its appli
 '''
 
 import os
+import json
 from datetime import datetime
-from tqdm import tqdm
 import matplotlib.pyplot as plt
 import IPython.core.display
 import numpy as np
 import pandas as pd
 import scipy
+import scipy.special
 from sklearn.linear_model import LinearRegression, LogisticRegression
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.decomposition import PCA
 import joblib
 
 from .vis.plotComponents2D import plotComponents2D
-from .metrics import get_metrics, visualize_dict, visualize_corr_matrix, generate_html_for_dict
+from .metrics import METRIC_FAMILIES, get_metrics, mvgx, fit_factors, sweep_metrics, adaptive_sweep, se_targets, visualize_dict, visualize_corr_matrix, generate_html_for_dict
+from .vectorized import VECTORIZED_KEYS, two_group_metrics
+from .expected import expected_metrics, mvgx_effects, covered_families
 
-def analyze(X,y,use_filter=True,method='decompose.pca',pkl=None):
+NOISE_MODELS = ['independent', 'factor']
+
+# nan / inf replacements of the atom metric vectors before scoring
+FILL = {'nan': 0.0, 'posinf': 1000.0, 'neginf': -1000.0}
+
+# version of the UnifiedScorer.save() format. load() rejects newer versions.
+ARTIFACT_VERSION = 1
+
+def analyze(X,y,use_filter=True,method='decompose.pca',pkl=None,noise='independent',n_factors=10,adaptive=False,analytic=False,scorer=None,export=None):
     '''
     An include-all function that trains a meta-learner model of unified single metric.
     And use that metric to evaluate the between-class and in-class classifiability.
@@ -33,116 +44,80 @@ def analyze(X,y,use_filter=True,method='decompose.pca',pkl=None):
         'decompose.pca' - decomposition using PCA
         'decompose.lda' - decomposition using LDA
     pkl : a pickle file of pre-computed atom metrics to load.
+    noise : how the reference datasets are simulated from X.
+        'independent' - independent features with the marginal mean and std of X
+        'factor' - correlated features from a low-rank-plus-diagonal covariance fitted to the
+            within-class deviations of X (see metrics.fit_factors()), which is closer to real spectra
+    n_factors : rank of the low-rank part for noise = 'factor'
+    adaptive : start from a coarse md grid and refine it where the metric curves change
+        fastest (see metrics.adaptive_sweep()), instead of a fixed 19-point grid
+    analytic : compute the reference curves of the t test, ANOVA, MANOVA, Cohen's d and
+        Pearson r keys in closed form and only simulate the others (see cla.expected).
+        Only for noise = 'independent'.
+    scorer : a trained UnifiedScorer, or the path of one saved by UnifiedScorer.save().
+        The reference simulation and the training are then skipped.
+    export : a .json or .npz path to save the trained UnifiedScorer to, for scorer
 
     Return
     ------
     umetric_bw : between-class unified metric
     umetric_in : in-class unified metric
-    pkl_file : pickle filepath for persisting the atom metric dict
+    pkl_file : pickle filepath for persisting the atom metric dict. None if scorer is given.
     '''
 
+    if scorer is not None:
+        if isinstance(scorer, str):
+            print('Load the unified scorer from', scorer)
+            scorer = UnifiedScorer.load(scorer)
+        return scorer.score(X, y), scorer.score_in_class(X, y), None
+
     if pkl and os.path.isfile(pkl):
         dic = joblib.load(pkl) # load an existing pkl file
         pkl_file = pkl
         print('Load atom metrics from', pkl_file)
     else:
-        dic = calculate_atom_metrics(mu = X.mean(axis = 0), s = X.std(axis = 0),
-                            mds = np.linspace(0, 6, 7+6*2),
+        if noise == 'independent':
+            mu, s, factors = X.mean(axis = 0), X.std(axis = 0), None
+        elif noise == 'factor':
+            mu, s, factors = fit_factors(X, y, n_factors)
+        else:
+            raise Exception('Unsupported noise model ' + str(noise))
+
+        dic = calculate_atom_metrics(mu = mu, s = s,
+                            mds = np.linspace(0, 6, 7 if adaptive else 7+6*2),
                             repeat = 5, nobs = 100,
-                            show_curve = True, show_html = True)
+                            show_curve = True, show_html = True, factors = factors,
+                            adaptive = adaptive, budget = (7+6*2) * 5 if adaptive else None,
+                            analytic = analytic)
         pkl_file = str(datetime.now()).replace(':','').replace('-','').replace(' ','') + '.pkl'
         joblib.dump(dic, pkl_file) # later we can reload with: dic = joblib.load('x.pkl')
         print('Save atom metrics to', pkl_file)
 
     _, keys, _, M = filter_metrics(dic, threshold = (0.5 if use_filter else None))
-    if method == 'decompose.pca':
-        model, x_min, x_max, slope = train_decomposer_pca(M, dic['d'])
-        umetric_bw, umetric_in = calculate_unified_metric(X, y, model, keys, method)
-
-        # maps to the [0,1] range
-        print('before scaling: ', umetric_bw, umetric_in)
-        print('PC1 range: ', x_min, x_max)
+    scorer = train_scorer(M, dic['d'], keys, method)
+    if export:
+        scorer.save(export)
+        print('Save the unified scorer to', export)
 
-        '''
-        np.interp(x, xp, fp, left=None, right=None)
-
-        left : optional float or complex corresponding to fp
-            Value to return for `x < xp[0]`, default is `fp[0]`.
-
-        right : optional float or complex corresponding to fp
-            Value to return for `x > xp[-1]`, default is `fp[-1]`.
-        
-        Because the default left and right params, we dont need to do extra out-of-range (>max or <min) treatments.
-        '''
-        umetric_bw = np.interp(umetric_bw,[x_min,x_max],[0,1] if slope else [1,0])
-        umetric_in = np.interp(umetric_in,[x_min,x_max],[0,1] if slope else [1,0])
-        print('after scaling: ', umetric_bw, umetric_in)
-
-    elif method == 'meta.logistic':
-        model = train_metalearner_logistic(M, dic['d'])
-        umetric_bw, umetric_in = calculate_unified_metric(X, y, model, keys, method)
-    
-    elif method == 'decompose.lda':
-        model, x_min, x_max, slope = train_decomposer_lda(M, dic['d'])
-        umetric_bw, umetric_in = calculate_unified_metric(X, y, model, keys, method)
+    umetric_bw, umetric_in = calculate_unified_metric(X, y, scorer.model, keys, method)
 
+    if scorer.x_min is not None:
         # maps to the [0,1] range
         print('before scaling: ', umetric_bw, umetric_in)
-        print('C1 range: ', x_min, x_max)
+        print('C1 range: ', scorer.x_min, scorer.x_max)
 
-        umetric_bw = np.interp(umetric_bw, [x_min, x_max], [0, 1] if slope else [1,0])
-        umetric_in = np.interp(umetric_in, [x_min, x_max], [0, 1] if slope else [1,0])
+        umetric_bw = scorer.scale(umetric_bw)
+        umetric_in = scorer.scale(umetric_in)
         print('after scaling: ', umetric_bw, umetric_in)
 
-    elif method == 'meta.linear':
-        model = train_metalearner_linear(M, dic['d'])
-        umetric_bw, umetric_in = calculate_unified_metric(X, y, model, keys, method)
-
-    else:
-        raise Exception('Unsupported method ' + method )
-
     return umetric_bw, umetric_in, pkl_file
 
-def mvgx(
-    mu, # mean, row vector
-    s, # std, row vector
-    md = 2, # distance between means, respect to std, i.e. (mu2 - mu1) / std, or how many stds is the difference.
-    nobs = 15 # number of observations / samples
-    ):
-    '''
-    Generate simulated high-dim (e.g., spectroscopic profiling) data
-    This is an extended version of mvg() that accepts specified mu and s vectors.
-
-    Example
-    -------
-    X,y = mvgx(
-    [-1,0,-1], # mean, row vector
-    [1,2,0.5], # variance, row vector
-    nobs = 5, # number of observations / samples
-    md = 1 # distance between means, respect to std, i.e. (mu2 - mu1) / std, or how many stds is the difference.
-    )
-    '''
-
-    mu = np.array(mu)
-    s = np.array(s)
-
-    N = nobs
-    cov = np.diag(s**2)
-
-    mu1 = mu - s * md / 2
-    mu2 = mu + s * md / 2
-
-    xc1 = np.random.multivariate_normal(mu1, cov, N)
-    xc2 = np.random.multivariate_normal(mu2, cov, N)
-
-    y = np.concatenate((np.zeros(N), np.ones(N))).astype(int)
-    X = np.vstack((xc1,xc2))
-
-    return X, y
-
 def calculate_atom_metrics(mu, s, mds,
 repeat = 3, nobs = 100,
-show_curve = True, show_html = True):
+show_curve = True, show_html = True, clf_cache = None, progress = True,
+seed = None, n_jobs = None, factors = None, store = None,
+adaptive = False, tol = 0.05, budget = None, target_se = None, min_repeat = 3,
+analytic = False):
     '''
     Calculate atom metric values for different mds (between-group distances)
 
@@ -153,6 +128,24 @@ show_curve = True, show_html = True):
     mds : an array. between-classes mean distances (in std). e.g., np.linspace(0,1,10)
     show_curve : whether output each metric curve against the between-class distance
     show_html : whether output an inline HTML table of metrics
+    clf_cache : a metrics.CLFCache to reuse CLF's regularization strength across repeats and neighboring mds
+    progress : True for a tqdm bar, False, or progress callbacks. See cla.progress.
+    seed : None uses the global np.random state. An int or SeedSequence gives every (md, repeat)
+        dataset its own random stream, so the result is reproducible at any n_jobs.
+    n_jobs : number of datasets computed concurrently
+    factors : None for independent features, or a d x k loading matrix of a correlated
+        low-rank-plus-diagonal noise model, where s is the diagonal (residual) std.
+        See metrics.fit_factors() and metrics.mvgx().
+    store : a cla.store.SimulationStore to keep the per-repeat values in, and to extend
+        a previous sweep from. See metrics.sweep_metrics().
+    adaptive : if True, mds is only the initial coarse grid. Midpoints are inserted where the
+        metric curves change fastest. See metrics.adaptive_sweep().
+    tol, budget : stopping rules of the adaptive grid. budget is the maximum number of datasets.
+    target_se, min_repeat : sequential stopping of the repeats. repeat becomes the maximum
+        per md. See metrics.sweep_metrics().
+    analytic : use the closed-form expectations of cla.expected for the t test, ANOVA,
+        MANOVA, Cohen's d and Pearson r keys, and only simulate the other metric families.
+        Requires independent features (factors = None).
 
     Example
     -------
@@ -162,56 +155,30 @@ show_curve = True, show_html = True):
     '''
 
     dic = {}
-
-    ## splits (divide 1 std into how many sections) * repeat
-    pbar = tqdm(total = len(mds) * repeat, position=0)
-
-    ## only do visualization when repeat == 1 and draw == True
-    #detailed = (repeat == 1 and draw == True)
-
     dic['d'] = np.array(mds)
 
-    for md in mds:
-
-        raw_dic = {}
-
-        for i in range(repeat):
-            X,y = mvgx(
-                mu = mu, # mean, row vector
-                s = s, # std, row vector
-                nobs = nobs, # number of observations / samples
-                md = md
-            )
-
-            ## if detailed:
-            #    print('d = ', round(md,3))
-
-            _, raw_dic1 = get_metrics(X,y)
-            for k, v in raw_dic1.items():
-                if k in raw_dic:
-                    raw_dic[k].append(v) # raw_dic[k] = raw_dic[k] + v
-                else:
-                    raw_dic[k] = [v] # v
-
-            pbar.update()
-            ## End of inner iteration ##
+    if analytic and factors is not None:
+        print('The analytic expectations assume independent features. Simulating all metrics.')
+        analytic = False
 
-        for k, v in raw_dic.items():
+    families = None
+    if analytic: # the keys that expected_metrics() returns only depend on nobs and the feature count
+        covered = covered_families(expected_metrics([0], nobs, mvgx_effects(s)))
+        families = [f for f in METRIC_FAMILIES if f not in covered]
 
-            trim_size = int(repeat / 10)
+    sweep_kwargs = dict(seed = seed, n_jobs = n_jobs, clf_cache = clf_cache, progress = progress,
+                        desc = 'calculate_atom_metrics', store = store,
+                        target_se = target_se, min_repeat = min_repeat, families = families,
+                        mu = mu, s = s, nobs = nobs, factors = factors)
 
-            if (repeat > 10): # remove the max and min
-                raw_dic[k] = np.mean(sorted(v)[trim_size:-trim_size])
-            else:
-                raw_dic[k] = np.mean(v)
-
-        ## End of outer iteration ##
+    if adaptive:
+        # 'd' is overwritten by the refined grid
+        dic.update(adaptive_sweep(mvgx, mds, repeat, tol = tol, budget = budget, **sweep_kwargs))
+    else:
+        dic.update(sweep_metrics(mvgx, mds, repeat, **sweep_kwargs))
 
-        for k, v in raw_dic.items():
-            if k in dic:
-                dic[k] = np.append(dic[k], v)
-            else:
-                dic[k] = np.array([v])
+    if analytic:
+        dic.update(expected_metrics(dic['d'], nobs, mvgx_effects(s)))
 
     if show_curve:
         print('visualize_dict()')
@@ -371,6 +338,332 @@ def train_metalearner_logistic(M, d, cutoff = 2):
     print('Coef and Intercept: ', clf.coef_, clf.intercept_)
     return clf
 
+def train_scorer(M, d, keys, method = 'decompose.pca'):
+    '''
+    Train a unified metric model on the atom metric matrix and wrap it as a UnifiedScorer.
+
+    Parameters
+    ----------
+    M, keys : returned by filter_metrics()
+    d : the between-class distances of the rows in M, i.e., dic['d']
+    method : see analyze()
+    '''
+    if method == 'decompose.pca':
+        model, x_min, x_max, slope = train_decomposer_pca(M, d)
+        return UnifiedScorer(model, keys, method, x_min, x_max, slope)
+    elif method == 'decompose.lda':
+        model, x_min, x_max, slope = train_decomposer_lda(M, d)
+        return UnifiedScorer(model, keys, method, x_min, x_max, slope)
+    elif method == 'meta.logistic':
+        return UnifiedScorer(train_metalearner_logistic(M, d), keys, method)
+    elif method == 'meta.linear':
+        return UnifiedScorer(train_metalearner_linear(M, d), keys, method)
+    else:
+        raise Exception('Unsupported method ' + method )
+
+class UnifiedScorer:
+    '''
+    A trained unified metric, ready to score new datasets.
+
+    Bundles the decomposer or meta-learner, the selected atom metric keys and the
+    [x_min, x_max] interpolation range. Only the atom metrics in keys are computed,
+    and score_many() applies the model to all datasets in one call.
+
+    Example
+    -------
+    scorer = train_scorer(M, dic['d'], keys, method = 'decompose.pca')
+    u = scorer.score(X, y)
+    us = scorer.score_many([(X1, y1), (X2, y2)], n_jobs = 4)
+
+    # a small artifact that loads without sklearn objects or retraining
+    scorer.save('scorer.json')
+    scorer = UnifiedScorer.load('scorer.json')
+    '''
+
+    def __init__(self, model, keys, method, x_min = None, x_max = None, slope = True, params = None):
+        '''
+        Parameters
+        ----------
+        model : the trained decomposer or meta-learner. None if params is given.
+        keys : selected metric names, returned by filter_metrics()
+        method : see analyze()
+        x_min, x_max, slope : the reference range of the first component, returned by
+            train_decomposer_pca() or train_decomposer_lda(). None means no scaling.
+        params : the linear form of the model, {'mean', 'coef', 'intercept'}, as loaded by load()
+        '''
+        self.model = model
+        self.keys = list(keys)
+        self.method = method
+        self.x_min = x_min
+        self.x_max = x_max
+        self.slope = slope
+        self.fill = dict(FILL)
+        self.params = params
+
+    def vectorize(self, X, y):
+        '''
+        Compute the selected atom metrics of a dataset. Returns a vector in the order of keys.
+        '''
+        return metric_vector(X, y, self.keys)
+
+    def transform(self, M):
+        '''
+        Apply the model to rows of atom metric vectors and scale the result.
+        '''
+        return self.scale(self.predict(M))
+
+    def predict(self, M):
+        '''
+        Apply the model to rows of atom metric vectors, without scaling.
+        '''
+        M = np.nan_to_num(np.atleast_2d(np.asarray(M, dtype = float)), **self.fill)
+        model, method = self.model, self.method
+
+        if model is None: # loaded from an artifact
+            p = self.params
+            u = (M - p['mean']) @ p['coef'] + p['intercept']
+            if method == 'meta.logistic':
+                u = scipy.special.expit(u)
+        elif method == 'meta.logistic' and isinstance(model, LogisticRegression):
+            u = model.predict_proba(M)[:, 1]
+        elif method == 'decompose.pca' and isinstance(model, PCA):
+            u = model.transform(M)[:, 0]
+        elif method == 'decompose.lda' and isinstance(model, LDA):
+            u = model.transform(M)[:, 0]
+        elif method == 'meta.linear' and isinstance(model, LinearRegression):
+            u = model.predict(M)
+        else:
+            raise Exception('Unsupported method ' + method )
+
+        return u
+
+    def scale(self, u):
+        '''
+        Map raw model outputs to the [0,1] range.
+
+        np.interp(x, xp, fp, left=None, right=None)
+
+        left : optional float or complex corresponding to fp
+            Value to return for `x < xp[0]`, default is `fp[0]`.
+
+        right : optional float or complex corresponding to fp
+            Value to return for `x > xp[-1]`, default is `fp[-1]`.
+
+        Because the default left and right params, we dont need to do extra out-of-range (>max or <min) treatments.
+        '''
+        if self.x_min is None:
+            return u
+        return np.interp(u, [self.x_min, self.x_max], [0, 1] if self.slope else [1, 0])
+
+    def linear_params(self):
+        '''
+        The model as u = (M - mean) @ coef + intercept, the first component of PCA / LDA or
+        the decision function of the meta-learner (before the logistic function for 'meta.logistic')
+        '''
+        if self.model is None:
+            return self.params
+
+        model, method = self.model, self.method
+        n = len(self.keys)
+
+        if method == 'decompose.pca' and isinstance(model, PCA) and not model.whiten:
+            mean, coef, intercept = model.mean_, model.components_[0], 0.0
+        elif method == 'decompose.lda' and isinstance(model, LDA) and model.solver in ('svd', 'eigen'):
+            mean = model.xbar_ if model.solver == 'svd' else np.zeros(n)
+            coef, intercept = model.scalings_[:, 0], 0.0
+        elif method == 'meta.logistic' and isinstance(model, LogisticRegression) and model.coef_.shape[0] == 1:
+            mean, coef, intercept = np.zeros(n), model.coef_[0], model.intercept_[0]
+        elif method == 'meta.linear' and isinstance(model, LinearRegression):
+            mean, coef, intercept = np.zeros(n), model.coef_, model.intercept_
+        else:
+            raise Exception('Cannot export the model of method ' + method)
+
+        return {'mean': np.asarray(mean, dtype = float), 'coef': np.asarray(coef, dtype = float),
+                'intercept': float(intercept)}
+
+    def to_dict(self):
+        '''
+        The scorer as plain numbers and lists: the selected keys, the nan / inf fill values,
+        the linear form of the model (see linear_params()) and the [x_min, x_max] scaling
+        '''
+        p = self.linear_params()
+        return {
+            'format': 'cla.UnifiedScorer',
+            'version': ARTIFACT_VERSION,
+            'method': self.method,
+            'keys': self.keys,
+            'fill': self.fill,
+            'mean': p['mean'].tolist(),
+            'coef': p['coef'].tolist(),
+            'intercept': p['intercept'],
+            'x_min': None if self.x_min is None else float(self.x_min),
+            'x_max': None if self.x_max is None else float(self.x_max),
+            'slope': bool(self.slope),
+        }
+
+    @classmethod
+    def from_dict(cls, dic):
+        '''
+        Rebuild a scorer from to_dict(). It scores with numpy only.
+        '''
+        if dic.get('format') != 'cla.UnifiedScorer':
+            raise Exception('Not a UnifiedScorer artifact')
+        if dic['version'] > ARTIFACT_VERSION:
+            raise Exception('Unsupported UnifiedScorer artifact version ' + str(dic['version']))
+
+        params = {'mean': np.array(dic['mean'], dtype = float), 'coef': np.array(dic['coef'], dtype = float),
+                  'intercept': float(dic['intercept'])}
+        scorer = cls(None, dic['keys'], dic['method'], dic['x_min'], dic['x_max'], dic['slope'], params)
+        scorer.fill = {k: float(v) for k, v in dic['fill'].items()}
+        return scorer
+
+    def save(self, path):
+        '''
+        Save as a .json file, or as an .npz file (the arrays in binary, the rest as a JSON header)
+        '''
+        dic = self.to_dict()
+        if path.endswith('.npz'):
+            arrays = {k: np.array(dic.pop(k)) for k in ('mean', 'coef')}
+            np.savez(path, header = np.array(json.dumps(dic)), **arrays)
+            return
+
+        with open(path, 'w') as f:
+            json.dump(dic, f)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a scorer saved by save()
+        '''
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                dic = json.loads(str(data['header']))
+                dic['mean'], dic['coef'] = data['mean'], data['coef']
+        else:
+            with open(path) as f:
+                dic = json.load(f)
+        return cls.from_dict(dic)
+
+    def score(self, X, y):
+        '''
+        Return the unified metric of one dataset
+        '''
+        return self.transform(self.vectorize(X, y))[0]
+
+    def score_many(self, datasets, n_jobs = None):
+        '''
+        Return the unified metrics of many datasets.
+
+        Parameters
+        ----------
+        datasets : an iterable of (X, y) tuples
+        n_jobs : number of worker processes for computing the atom metrics. None runs serially.
+        '''
+        if n_jobs is None or n_jobs == 1:
+            vectors = [self.vectorize(X, y) for X, y in datasets]
+        else:
+            vectors = joblib.Parallel(n_jobs = n_jobs)(
+                joblib.delayed(self.vectorize)(X, y) for X, y in datasets)
+
+        if len(vectors) == 0:
+            return np.array([])
+        return self.transform(np.vstack(vectors))
+
+    def score_in_class(self, X, y, repeat = 3, n_jobs = None, seed = None, target_se = None, min_repeat = 3):
+        '''
+        Return the in-class unified metric of each class (in sorted label order).
+        See AnalyzeInClass().
+        '''
+        _, vectors = in_class_vectors(X, y, self.keys, repeat, n_jobs, seed, target_se, min_repeat)
+        return [self.scale(np.mean(self.predict(V))) for V in vectors]
+
+def metric_vector(X, y, keys, seed = None):
+    '''
+    Compute the atom metrics in keys for a dataset. Returns a vector in the order of keys.
+
+    seed : None, or a seed of the stochastic metrics (BER's samples and IG's noise)
+    '''
+    options = None
+    if seed is not None:
+        rng = np.random.default_rng(seed)
+        options = {'BER': {'rng': rng}, 'IG': {'random_state': int(rng.integers(2 ** 31))}}
+    _, dic_s = get_metrics(X, y, keys = keys, options = options)
+    return np.array([dic_s.get(k, np.nan) for k in keys], dtype = float)
+
+def in_class_vectors(X, y, keys, repeat = 3, n_jobs = None, seed = None, target_se = None, min_repeat = 3):
+    '''
+    Atom metric vectors of randomly relabeled samples of each class.
+
+    Each class gets an independent random stream spawned from seed, and each
+    (class, repeat) task a child of it for the stochastic metrics.
+    Metrics in VECTORIZED_KEYS are computed for all repeats of a class at once from
+    its sufficient statistics, so adding repeats costs almost nothing for them.
+    The other keys run get_metrics() on the (class, repeat) grid with n_jobs workers.
+
+    target_se : sequential stopping. None runs exactly repeat relabelings per class. Otherwise
+        each class starts with min_repeat and gets more, in rounds of half its current count,
+        until the standard error of the mean of every checked key (a float for all keys, or a
+        dict of key -> target, see metrics.se_targets()) is reached, or repeat relabelings.
+        The relabelings are the first ones of the fixed-repeat run with the same seed.
+
+    Return
+    ------
+    classes : class labels in sorted order
+    vectors : a list of n x len(keys) matrices, one per class. n is repeat, or the number
+        of relabelings that reached target_se.
+    '''
+    keys = list(keys)
+    classes = sorted(set(y))
+    streams = np.random.SeedSequence(seed).spawn(len(classes))
+
+    fast_keys = [k for k in keys if k in VECTORIZED_KEYS]
+    slow_keys = [k for k in keys if k not in VECTORIZED_KEYS]
+    slow_idx = [keys.index(k) for k in slow_keys]
+
+    subsets = []
+    labelings = []
+    vectors = []
+
+    for c, ss in zip(classes, streams):
+        Xc = X[y == c]
+        Z = (np.random.default_rng(ss).random((repeat, len(Xc))) > 0.5).astype(int) # random assign y labels
+
+        V = np.full((repeat, len(keys)), np.nan)
+        for k, v in two_group_metrics(Xc, Z, fast_keys).items():
+            V[:, keys.index(k)] = v
+
+        subsets.append(Xc)
+        labelings.append(Z)
+        vectors.append(V)
+
+    children = [ss.spawn(repeat) for ss in streams]
+    counts = np.full(len(classes), repeat if target_se is None else min(min_repeat, repeat))
+    computed = np.zeros((len(classes), repeat), dtype = bool)
+
+    while True:
+        if slow_keys:
+            tasks = [(i, r) for i in range(len(classes)) for r in range(counts[i]) if not computed[i, r]]
+            results = joblib.Parallel(n_jobs = n_jobs)(
+                joblib.delayed(metric_vector)(subsets[i], labelings[i][r], slow_keys, children[i][r])
+                for i, r in tasks)
+
+            for (i, r), v in zip(tasks, results):
+                vectors[i][r, slow_idx] = v
+                computed[i, r] = True
+
+        if target_se is None:
+            break
+
+        targets = se_targets(target_se, keys)
+        short = np.array([n < 2 or np.any(V[:n].std(axis = 0, ddof = 1) / np.sqrt(n) > targets)
+                          for V, n in zip(vectors, counts)], dtype = bool) # nan > target is False, so a nan key never holds a class back
+        grow = short & (counts < repeat)
+        if not grow.any():
+            break
+        counts[grow] = np.minimum(counts[grow] + np.maximum(counts[grow] // 2, 1), repeat)
+
+    return classes, [V[:n] for V, n in zip(vectors, counts)]
+
 def calculate_unified_metric(X, y, model, keys,method):
     '''
     First, fit a linear regression (meta-learner) model for M on d.
@@ -388,69 +681,37 @@ def AnalyzeBetweenClass(X, y, model, keys, method):
     X_pca = PCA(n_components = 2).fit_transform(X)
     plotComponents2D(X_pca, y)
 
-    _, new_dic = get_metrics(X, y)
-    vec_metrics = []
-
-    for key in keys:
-        vec_metrics.append(new_dic[key])
-
-    vec_metrics = np.nan_to_num(vec_metrics,nan=0,posinf=1000,neginf=-1000)
-    if method == 'meta.logistic' and isinstance(model, LogisticRegression):
-        umetric = model.predict_proba([vec_metrics.T])[0][1]
-    elif method == 'decompose.pca' and isinstance(model, PCA):
-        M = vec_metrics.reshape(1,-1)
-        umetric = model.transform(M)[0][0]
-    elif method == 'decompose.lda' and isinstance(model, LDA):
-        M = vec_metrics.reshape(1,-1)
-        umetric = model.transform(M)[0][0]
-    elif method == 'meta.linear' and isinstance(model, LinearRegression):
-        M = vec_metrics.reshape(1,-1)
-        # M=(M-mean)/std
-        umetric = model.predict(M)
-    else:
-        raise Exception('Unsupported method ' + method )
+    scorer = UnifiedScorer(model, keys, method)
+    umetric = scorer.transform(scorer.vectorize(X, y))[0]
     # print("between-class unified metric = ", umetric[1])
     return umetric
 
-def AnalyzeInClass(X, y, model, keys, method, repeat = 3):
+def AnalyzeInClass(X, y, model, keys, method, repeat = 3, n_jobs = None, seed = None, show = True,
+                   target_se = None, min_repeat = 3):
     '''
     Parameters
     ----------
     repeat : to get in-class metrics, samples of each class are randomly assigned different labels.
         This controls how many times to run to get the averaged result.
+    n_jobs : number of workers for the (class, repeat) grid. None runs serially.
+    seed : seed of the random relabeling. None uses fresh entropy.
+    show : whether to plot the first two PCs of each class
+    target_se : stop relabeling a class once the standard error of the averaged atom metrics
+        reaches this target, after at least min_repeat and at most repeat relabelings.
+        See in_class_vectors().
     '''
 
+    scorer = UnifiedScorer(model, keys, method)
+    classes, vectors = in_class_vectors(X, y, keys, repeat, n_jobs, seed, target_se, min_repeat)
+
     umetrics = []
-    for c in set(y):
-        Xc = X[y == c]
-        d = 0
-
-        for i in range(repeat):
-            yc = (np.random.rand(len(Xc)) > 0.5).astype(int) # random assign y labels
-            _, new_dic = get_metrics(Xc, yc)
-            vec_metrics = []
-            for key in keys:
-                vec_metrics.append(new_dic[key])
-
-            vec_metrics = np.nan_to_num(vec_metrics,nan=0,posinf=1000,neginf=-1000)
-
-            if method == 'meta.logistic' and isinstance(model, LogisticRegression):
-                d += model.predict_proba([vec_metrics.T])[0][1]
-            elif method == 'decompose.pca' and isinstance(model, PCA):
-                M = vec_metrics.reshape(1,-1)
-                d += model.transform(M)[0][0]
-            elif method == 'decompose.lda' and isinstance(model, LDA):
-                M = vec_metrics.reshape(1,-1)
-                d += model.transform(M)[0][0]
-            elif method == 'meta.linear' and isinstance(model, LinearRegression):
-                M = vec_metrics.reshape(1, -1)
-                d += model.predict(M)
-            else:
-                raise Exception('Unsupported method ' + method )
-
-        print("c = ", int(c), ", in-class unified metric = ", d/repeat)
-        X_pca = PCA(n_components = 2).fit_transform(Xc)
-        plotComponents2D(X_pca, y[y == c]) #, tags=range(len(X_pca)))
-        umetrics.append(d/repeat)
-
-    return umetrics
\ No newline at end of file
+    for c, V in zip(classes, vectors):
+        d = np.mean(scorer.transform(V))
+
+        print("c = ", int(c), ", in-class unified metric = ", d)
+        if show:
+            X_pca = PCA(n_components = 2).fit_transform(X[y == c])
+            plotComponents2D(X_pca, y[y == c]) #, tags=range(len(X_pca)))
+        umetrics.append(d)
+
+    return umetrics
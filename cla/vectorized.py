@@ -0,0 +1,240 @@
+'''
+Vectorized feature-wise statistics for many labelings of the same data.
+
+Random relabelings (unify.AnalyzeInClass) and label permutations / resamples only change
+which samples fall in which group. The per-feature sufficient statistics of X are computed
+once, and the group sums for all B labelings come from a single (B x n) @ (n x p) product,
+instead of calling get_metrics() B times.
+'''
+
+import numpy as np
+import scipy
+
+# single-value metrics that two_group_metrics() reproduces exactly
+VECTORIZED_KEYS = [
+    'test.ES.max',
+    'test.student.min',
+    'test.student.min.log10',
+    'test.student.T.max',
+    'test.ANOVA.min',
+    'test.ANOVA.min.log10',
+    'test.ANOVA.F.max',
+    'correlation.r.max',
+    'correlation.r2.max',
+    'correlation.r.p.min',
+]
+
+
+def group_moments(X, Z, W=None):
+    '''
+    Per-feature group sizes, means and variances (ddof=1) for B two-group labelings.
+
+    Parameters
+    ----------
+    X : n x p data matrix
+    Z : B x n 0/1 matrix. Z[b, i] = 1 if sample i is in group 1 (label 1) under labeling b.
+    W : B x n sample multiplicities, e.g., how many times each sample is drawn in
+        bootstrap resample b. Default is 1 for all samples.
+
+    Return
+    ------
+    n0, n1 : B x 1 group sizes
+    m0, m1, v0, v1 : B x p group means and variances
+    '''
+    X = np.asarray(X, dtype=float)
+    Z = np.asarray(Z, dtype=float)
+
+    # center once to avoid cancellation in sum of squares
+    mu = X.mean(axis=0)
+    Xc = X - mu
+
+    if W is None:
+        S = Xc.sum(axis=0)
+        Q = (Xc ** 2).sum(axis=0)
+        n1 = Z.sum(axis=1, keepdims=True)
+        n0 = X.shape[0] - n1
+        S1 = Z @ Xc
+        Q1 = Z @ (Xc ** 2)
+        S0 = S - S1
+        Q0 = Q - Q1
+    else:
+        W = np.asarray(W, dtype=float)
+        Z1 = W * Z
+        Z0 = W - Z1
+        n1 = Z1.sum(axis=1, keepdims=True)
+        n0 = Z0.sum(axis=1, keepdims=True)
+        S1 = Z1 @ Xc
+        Q1 = Z1 @ (Xc ** 2)
+        S0 = Z0 @ Xc
+        Q0 = Z0 @ (Xc ** 2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1 = S1 / n1
+        m0 = S0 / n0
+        v1 = np.maximum(Q1 - n1 * m1 ** 2, 0) / (n1 - 1)
+        v0 = np.maximum(Q0 - n0 * m0 ** 2, 0) / (n0 - 1)
+
+    return n0, n1, m0 + mu, m1 + mu, v0, v1
+
+
+def _weighted_median(Xs, order, W):
+    '''
+    Per-feature medians of b weighted samples (numpy's definition, i.e., the mean of
+    the two middle values for an even count).
+
+    Parameters
+    ----------
+    Xs : n x p column-wise sorted X
+    order : n x p column-wise argsort of X
+    W : b x n integer sample multiplicities
+    '''
+    cw = np.cumsum(W[:, order], axis=1)  # b x n x p
+    m = cw[:, -1, :]
+    lo = (cw <= ((m - 1) // 2)[:, None, :]).sum(axis=1)
+    hi = (cw <= (m // 2)[:, None, :]).sum(axis=1)
+    lo = np.minimum(lo, len(Xs) - 1)
+    hi = np.minimum(hi, len(Xs) - 1)
+    cols = np.arange(Xs.shape[1])
+    return (Xs[lo, cols] + Xs[hi, cols]) / 2
+
+
+def _levene_p(X, Z, W=None, chunk_size=None):
+    '''
+    Levene's test (center = median, scipy's default) p-values for B two-group labelings.
+    Group medians need the raw values, so labelings are processed in chunks of a B x n x p array.
+    W are optional sample multiplicities, as in group_moments().
+    '''
+    X = np.asarray(X, dtype=float)
+    Z = np.asarray(Z).astype(int)
+    n, p = X.shape
+    B = Z.shape[0]
+    W = np.ones((B, n), dtype=int) if W is None else np.asarray(W).astype(int)
+
+    if chunk_size is None:
+        chunk_size = max(1, int(2e7 // max(1, n * p)))
+
+    order = np.argsort(X, axis=0)
+    Xs = np.take_along_axis(X, order, axis=0)
+
+    pv = np.empty((B, p))
+
+    for start in range(0, B, chunk_size):
+        z = Z[start:start + chunk_size]
+        w = W[start:start + chunk_size]
+        w1 = w * z
+        w0 = w - w1
+
+        med1 = _weighted_median(Xs, order, w1)
+        med0 = _weighted_median(Xs, order, w0)
+        A = np.abs(X[None] - np.where(z[:, :, None] == 1, med1[:, None, :], med0[:, None, :]))
+
+        n1 = w1.sum(axis=1, keepdims=True)
+        n0 = w0.sum(axis=1, keepdims=True)
+        N = n0 + n1
+
+        s1 = np.einsum('bn,bnp->bp', w1.astype(float), A)
+        s0 = np.einsum('bn,bnp->bp', w0.astype(float), A)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zbar = (s0 + s1) / N
+            a1 = s1 / n1
+            a0 = s0 / n0
+            numer = n1 * (a1 - zbar) ** 2 + n0 * (a0 - zbar) ** 2
+            dev = np.where(z[:, :, None] == 1, A - a1[:, None, :], A - a0[:, None, :])
+            denom = np.einsum('bn,bnp->bp', w.astype(float), dev ** 2)
+            pv[start:start + chunk_size] = scipy.stats.f.sf((N - 2) * numer / denom, 1, N - 2)
+
+    return pv
+
+
+def _bartlett_p(n0, n1, v0, v1):
+    '''
+    Bartlett's test p-values for two groups
+    '''
+    N = n0 + n1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spsq = ((n0 - 1) * v0 + (n1 - 1) * v1) / (N - 2)
+        numer = (N - 2) * np.log(spsq) - (n0 - 1) * np.log(v0) - (n1 - 1) * np.log(v1)
+        denom = 1 + (1 / (n0 - 1) + 1 / (n1 - 1) - 1 / (N - 2)) / 3
+        T = numer / denom
+    return scipy.stats.chi2.sf(T, 1)
+
+
+def two_group_metrics(X, Z, keys=None, W=None):
+    '''
+    Compute single-value metrics of get_metrics() for B two-group labelings at once.
+
+    The results equal those of get_metrics(X, Z[b]) for each row b:
+    T_IND switches between the pooled and Welch t test with the same Bartlett / Levene rule,
+    cohen_d replaces zero pooled stds with their median, and correlate's Pearson r is the
+    point-biserial correlation with the 0/1 label.
+
+    Parameters
+    ----------
+    X : n x p data matrix
+    Z : B x n 0/1 matrix of labelings
+    keys : subset of VECTORIZED_KEYS to compute. Default is all.
+    W : B x n sample multiplicities. Row b then gives the metrics of the resample that
+        contains sample i W[b, i] times, e.g., a bootstrap resample or a jackknife sample.
+
+    Return
+    ------
+    A dict of key -> length-B array
+    '''
+    if keys is None:
+        keys = VECTORIZED_KEYS
+    keys = [k for k in keys if k in VECTORIZED_KEYS]
+
+    X = np.asarray(X, dtype=float)
+    Z = np.atleast_2d(np.asarray(Z))
+    if W is not None:
+        W = np.atleast_2d(np.asarray(W))
+
+    n0, n1, m0, m1, v0, v1 = group_moments(X, Z, W)
+    n = n0 + n1
+    diff = m0 - m1
+    dof = n - 2
+
+    dic = {}
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        pooled_var = ((n0 - 1) * v0 + (n1 - 1) * v1) / dof
+        T_pooled = diff / np.sqrt(pooled_var * (1 / n0 + 1 / n1))
+        p_pooled = 2 * scipy.stats.t.sf(np.abs(T_pooled), dof)
+
+        if any(k.startswith('test.student') for k in keys):
+            se2 = v0 / n0 + v1 / n1
+            T_welch = diff / np.sqrt(se2)
+            df_welch = se2 ** 2 / ((v0 / n0) ** 2 / (n0 - 1) + (v1 / n1) ** 2 / (n1 - 1))
+            p_welch = 2 * scipy.stats.t.sf(np.abs(T_welch), df_welch)
+
+            equal_var = (_bartlett_p(n0, n1, v0, v1) > 0.5) | (_levene_p(X, Z, W) > 0.5)
+            T = np.where(equal_var, T_pooled, T_welch)
+            p = np.where(equal_var, p_pooled, p_welch)
+
+            dic['test.student.min'] = np.min(p, axis=1)
+            dic['test.student.min.log10'] = np.log10(dic['test.student.min'])
+            dic['test.student.T.max'] = np.max(T, axis=1)
+
+        if any(k.startswith('test.ANOVA') for k in keys):
+            dic['test.ANOVA.min'] = np.min(p_pooled, axis=1)
+            dic['test.ANOVA.min.log10'] = np.log10(dic['test.ANOVA.min'])
+            dic['test.ANOVA.F.max'] = np.max(T_pooled ** 2, axis=1)
+
+        if 'test.ES.max' in keys:
+            pooled_std = np.sqrt(pooled_var)
+            positive = np.where(pooled_std > 0, pooled_std, np.nan)
+            median = np.nanmedian(positive, axis=1, keepdims=True)
+            pooled_std = np.where(pooled_std == 0, median, pooled_std)
+            dic['test.ES.max'] = np.max(np.abs(diff) / pooled_std, axis=1)
+
+        if any(k.startswith('correlation.r') for k in keys):
+            # total (ddof=0) std of each labeling's sample
+            total_var = ((n0 - 1) * v0 + (n1 - 1) * v1 + n0 * n1 * diff ** 2 / n) / n
+            r = -diff * np.sqrt(n0 * n1) / (n * np.sqrt(total_var))
+            dic['correlation.r.max'] = np.max(np.abs(r), axis=1)
+            dic['correlation.r2.max'] = np.max(r ** 2, axis=1)
+            dic['correlation.r.p.min'] = np.min(p_pooled, axis=1)
+
+    return {k: dic[k] for k in keys}
@@ -0,0 +1,314 @@
+'''
+Object-oriented figure rendering for report images.
+
+Unlike plt2base64, nothing in this module goes through the global pyplot state machine.
+Figures are plain matplotlib Figure objects bound to an Agg canvas, so they can be
+rendered in any format / DPI, pickled to worker processes and garbage-collected
+without plt.close().
+'''
+
+import io
+import base64
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# report-wide defaults. Use set_figure_format() or a FigureBatch to change them.
+FIGURE_FORMAT = 'png'
+FIGURE_DPI = None  # None - use the figure's own dpi
+WEBP_QUALITY = 80  # lossy WebP is usually 3-5x smaller than PNG for line / bar charts
+
+MIME_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'webp': 'image/webp',
+    'jpg': 'image/jpeg',
+}
+
+# per-thread stack of active FigureBatch objects. fig2html() defers to the innermost one.
+_local = threading.local()
+
+
+def _batches():
+    if not hasattr(_local, 'batches'):
+        _local.batches = []
+    return _local.batches
+
+
+def figures_enabled():
+    '''
+    Whether a figure created now would be used. False inside a FigureBatch with keep=False,
+    e.g., when Analysis only computes numbers, so that metric functions can skip plotting.
+    '''
+    batches = _batches()
+    return not batches or batches[-1].keep
+
+
+def set_figure_format(fmt='png', dpi=None):
+    '''
+    Set the default image format and DPI for report figures.
+
+    Parameters
+    ----------
+    fmt : 'png', 'svg', 'webp' or 'jpg'
+    dpi : dots per inch. None keeps the figure's own dpi.
+    '''
+    global FIGURE_FORMAT, FIGURE_DPI
+
+    if fmt not in MIME_TYPES:
+        raise Exception('Unsupported figure format ' + str(fmt))
+
+    FIGURE_FORMAT = fmt
+    FIGURE_DPI = dpi
+
+
+def new_figure(show=False, **kwargs):
+    '''
+    Create a figure for a metric plot.
+
+    If show is True, the figure is created by pyplot so that plt.show() can display it.
+    Otherwise, an unmanaged Agg figure is returned. It never enters pyplot's figure
+    registry, so there is nothing to close and it is safe to create in worker threads.
+
+    kwargs are passed to the Figure constructor, e.g., figsize.
+    '''
+    if show:
+        return plt.figure(**kwargs)
+
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def fig2bytes(fig, fmt=None, dpi=None):
+    '''
+    Render a figure to image bytes.
+
+    Parameters
+    ----------
+    fmt : 'png', 'svg', 'webp' or 'jpg'. Default is FIGURE_FORMAT.
+    dpi : Default is FIGURE_DPI.
+    '''
+    fmt = fmt or FIGURE_FORMAT
+    dpi = dpi or FIGURE_DPI
+
+    if not isinstance(fig.canvas, FigureCanvasAgg):
+        FigureCanvasAgg(fig)
+
+    kwargs = {}
+    if fmt == 'webp':
+        kwargs['pil_kwargs'] = {'quality': WEBP_QUALITY}
+    elif fmt == 'svg':
+        kwargs['metadata'] = {'Date': None}  # keep the output deterministic
+
+    pic_io = io.BytesIO()
+    fig.savefig(pic_io, format=fmt, dpi=dpi or 'figure', **kwargs)
+    return pic_io.getvalue()
+
+
+def fig2base64(fig, fmt=None, dpi=None):
+    '''
+    Render a figure to a base64 string
+    '''
+    return bytes.decode(base64.b64encode(fig2bytes(fig, fmt, dpi)))
+
+
+def bytes2html(data, fmt=None):
+    '''
+    Wrap rendered image bytes in an HTML img tag
+    '''
+    fmt = fmt or FIGURE_FORMAT
+    return '<img src="data:' + MIME_TYPES[fmt] + ';base64,' + \
+        bytes.decode(base64.b64encode(data)) + '">'
+
+
+def fig2html(fig, fmt=None, dpi=None):
+    '''
+    Output an HTML img tag for a figure.
+
+    Inside a FigureBatch, the figure is not rendered here.
+    A placeholder is returned instead and the batch renders all its figures at once.
+    '''
+    batches = _batches()
+    if batches:
+        return batches[-1].add(fig)
+
+    fmt = fmt or FIGURE_FORMAT
+    return bytes2html(fig2bytes(fig, fmt, dpi), fmt)
+
+
+def draw2html(draw):
+    '''
+    Output an HTML img tag for the figure returned by draw(), a callable without arguments.
+
+    Inside a lazy FigureBatch, draw is not called here. The batch keeps it and calls it when the
+    figure is rendered or requested, so draw must only use values that it holds.
+    '''
+    batches = _batches()
+    if batches and batches[-1].lazy:
+        return batches[-1].defer(draw)
+
+    return fig2html(draw())
+
+
+def _render_worker(args):
+    '''
+    Top-level function so that it can be pickled to worker processes
+    '''
+    fig, fmt, dpi = args
+    return fig2bytes(fig, fmt, dpi)
+
+
+class FigureBatch:
+    '''
+    Collect the figures created while a report is being built and render them together.
+
+    While the batch is active (used as a context manager), fig2html() registers each figure
+    and returns a placeholder token. Call render() to rasterize all figures, optionally in
+    worker processes, and substitute() to replace the tokens in the report HTML.
+
+    For progressive reports, link() replaces the tokens with img tags pointing to a figure
+    endpoint instead, and the endpoint calls image() to render each figure on first request.
+    Figures that are never requested are never rasterized. A lazy batch also keeps the
+    drawing callables of draw2html() instead of figures, so those are not even drawn.
+
+    Example
+    -------
+    with FigureBatch(fmt='webp', n_jobs=4) as batch:
+        html = metrics.get_html(X, y)
+    html = batch.substitute(html)
+    '''
+
+    TOKEN = '<!--cla-figure-{}-{}-->'
+
+    def __init__(self, fmt=None, dpi=None, n_jobs=1, keep=True, lazy=False):
+        '''
+        Parameters
+        ----------
+        fmt, dpi : image format and dpi. Default to FIGURE_FORMAT and FIGURE_DPI.
+        n_jobs : number of worker processes used by render(). 1 renders in-process.
+        keep : if False, figures are dropped and their tokens render as ''.
+            Use this when the caller only needs the numbers.
+        lazy : keep the callables of draw2html() and draw each figure on first render or request
+        '''
+        self.fmt = fmt or FIGURE_FORMAT
+        self.dpi = dpi or FIGURE_DPI
+        self.n_jobs = n_jobs
+        self.keep = keep
+        self.lazy = lazy
+        self.figures = []
+        self.images = {}  # index -> rendered bytes
+        self._id = id(self)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        _batches().append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _batches().remove(self)
+        return False
+
+    def __len__(self):
+        return len(self.figures)
+
+    def add(self, fig):
+        '''
+        Register a figure and return its placeholder token
+        '''
+        if not self.keep:
+            return ''
+
+        self.figures.append(fig)
+        return self.token(len(self.figures) - 1)
+
+    def defer(self, draw):
+        '''
+        Register a callable that returns a figure and return its placeholder token.
+        draw() is called on the first image() or render() of the token.
+        '''
+        if not self.keep:
+            return ''
+
+        self.figures.append(draw)
+        return self.token(len(self.figures) - 1)
+
+    def _figure(self, idx):
+        '''
+        The figure at idx, drawing it first if it was deferred
+        '''
+        fig = self.figures[idx]
+        if callable(fig):
+            fig = fig()
+        return fig
+
+    def token(self, idx):
+        return self.TOKEN.format(self._id, idx)
+
+    @property
+    def mimetype(self):
+        return MIME_TYPES[self.fmt]
+
+    def render(self, indices=None):
+        '''
+        Rasterize figures that have not been rendered yet.
+
+        Parameters
+        ----------
+        indices : figure indices to render. None renders all.
+
+        Return
+        ------
+        A dict of figure index -> image bytes
+        '''
+        if indices is None:
+            indices = range(len(self.figures))
+
+        todo = [i for i in indices if i not in self.images]
+
+        if self.n_jobs is not None and self.n_jobs > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as pool:
+                tasks = [(self._figure(i), self.fmt, self.dpi) for i in todo]
+                for i, data in zip(todo, pool.map(_render_worker, tasks)):
+                    self.images[i] = data
+                    self.figures[i] = None  # release the figure once rendered
+        else:
+            for i in todo:
+                self.image(i)
+
+        return {i: self.images[i] for i in indices}
+
+    def image(self, idx):
+        '''
+        Return the image bytes of a figure, rendering it on first request.
+        Safe to call from concurrent request handlers.
+        '''
+        with self._lock:
+            if idx not in self.images:
+                self.images[idx] = fig2bytes(self._figure(idx), self.fmt, self.dpi)
+                self.figures[idx] = None  # release the figure once rendered
+            return self.images[idx]
+
+    def link(self, html, url):
+        '''
+        Replace the tokens in html with lazily-loaded img tags.
+
+        Parameters
+        ----------
+        url : a format string that takes the figure index, e.g., '/figure/<report_id>/{}'
+        '''
+        for i in range(len(self.figures)):
+            html = html.replace(self.token(i),
+                                '<img loading="lazy" src="' + url.format(i) + '">')
+        return html
+
+    def substitute(self, html):
+        '''
+        Render all figures and replace their tokens in html with inline img tags
+        '''
+        for i, data in self.render().items():
+            html = html.replace(self.token(i), bytes2html(data, self.fmt))
+        return html
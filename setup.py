@@ -43,6 +43,10 @@ setup(
         "flaskwebgui",
     ],
 
+    entry_points={
+        "console_scripts": ["cla=cla.cli:main"],
+    },
+
     package_data={
         "": ["*.txt", "*.csv", "*.png", "*.jpg", "*.js",  "*.css", "*.html"],
     }